@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+"""
+    Resident memory and open descriptors per resource once every resource
+    of a profile has probed its status and settled.
+
+    Usage: bench/footprint.py [resources...]   (default: 1000 10000)
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from resmon.common import admin_dir
+from resmon.config import load_config
+from resmon.resource import ResourceMachine, MachineState
+from resmon.scheduler import spawn_limiter
+
+ra_script = """#!/bin/sh
+exit 0
+"""
+
+def rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+def write_profile(work_dir, count):
+    ra = os.path.join(work_dir, "ra")
+    with open(ra, "w") as f:
+        f.write(ra_script)
+    os.chmod(ra, 0755)
+    filename = os.path.join(work_dir, "bench.conf")
+    with open(filename, "w") as f:
+        f.write("\n".join([
+            "[General]", "Profile=bench", "LogFile={}/bench.log".format(work_dir), "LogLevel=0", "",
+            "[Resource]", "Name=r@{{1..{}}}".format(count), "Path=" + ra, "MonitorInterval=30", ""]))
+    return filename
+
+def run(count):
+    work_dir = tempfile.mkdtemp(prefix="resmon-bench-")
+    try:
+        profile = load_config(write_profile(work_dir, count), False)
+        rss, fds = rss_kb(), open_fds()
+        start_time = time.time()
+        resources = [ResourceMachine(profile, config) for config in profile.resources]
+        for res in resources:
+            res.start()
+        while any(res.state != MachineState.IDLE for res in resources):
+            time.sleep(0.1)
+        elapsed = time.time() - start_time
+        rss, fds = rss_kb() - rss, open_fds() - fds
+        states = sum(len(res.states) for res in resources)
+
+        for res in resources:
+            res.cancel()
+        for res in resources:
+            res.join()
+        return elapsed, rss, fds, states
+    finally:
+        shutil.rmtree(work_dir)
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    if not os.path.isdir(admin_dir):
+        os.makedirs(admin_dir)
+    spawn_limiter.set_limit(32)
+    for count in counts:
+        elapsed, rss, fds, states = run(count)
+        print "{:>6} resources: {:>7.1f}s to settle, {:>6.1f} KB RSS, {:>5.2f} fds, {:>4.1f} state objects per resource".format(
+            count, elapsed, float(rss) / count, float(fds) / count, float(states) / count)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+
+"""
+    Micro-benchmark of the control socket framing layer (PacketPool).
+
+    Usage: bench/packet_pool.py [reply size in MB]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from resmon.common import PacketPool, payload_to_packet, reply_magic_word
+
+chunk_size = 8192
+
+def feed(packets, chunk_size):
+    stream = b"".join(packets)
+    pool = PacketPool(reply_magic_word)
+    start_time = time.time()
+    for i in range(0, len(stream), chunk_size):
+        pool.feed_buffer(stream[i:i+chunk_size])
+    received = 0
+    payload = pool.get_payload()
+    while payload is not None:
+        received += len(payload)
+        payload = pool.get_payload()
+    return time.time() - start_time, received
+
+def report(title, elapsed, received):
+    rate = received / elapsed / 1024 / 1024 if elapsed > 0 else float("inf")
+    print "{:<40} {:>8.3f}s {:>10.1f} MB/s".format(title, elapsed, rate)
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    large = payload_to_packet(reply_magic_word, os.urandom(size_mb * 1024 * 1024))
+    report("one {}MB reply in {} byte chunks".format(size_mb, chunk_size), *feed([large], chunk_size))
+
+    small = [payload_to_packet(reply_magic_word, os.urandom(200)) for i in range(50000)]
+    report("50000 pipelined 200 byte replies", *feed(small, chunk_size))
+
+    noisy = [os.urandom(37) + p for p in small[:20000]]
+    report("20000 replies with garbage in between", *feed(noisy, chunk_size))
+
+if __name__ == "__main__":
+    main()
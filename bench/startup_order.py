@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+"""
+    Time from daemon start to all resources STARTED, for a profile of which
+    resources depend on each other, with and without Requires= ordering.
+
+    Every resource of a level requires one resource of the previous level;
+    its RA fails to start until that one is started, as a service failing
+    to reach its database does. Without ordering, the resources converge by
+    auto start retries; with it, each starts once its dependency is up.
+
+    Usage: bench/startup_order.py [levels] [resources per level]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from resmon.common import admin_dir
+from resmon.config import load_config
+from resmon.resource import ResourceMachine, ResourceState
+from resmon.depend import StartGate
+
+ra_script = """#!/bin/sh
+dir=$(dirname "$0")
+case "$1" in
+start)
+    if [ -s "$dir/requires-$RESMOND_RESOURCE" ] && [ ! -e "$dir/started-$(cat "$dir/requires-$RESMOND_RESOURCE")" ]; then
+        exit 1
+    fi
+    sleep 0.5
+    touch "$dir/started-$RESMOND_RESOURCE";;
+status)
+    [ -e "$dir/started-$RESMOND_RESOURCE" ] || exit 1;;
+esac
+exit 0
+"""
+
+def write_profile(work_dir, levels, width, ordered):
+    ra = os.path.join(work_dir, "ra")
+    with open(ra, "w") as f:
+        f.write(ra_script)
+    os.chmod(ra, 0755)
+    lines = ["[General]", "Profile=bench", "LogFile={}/bench.log".format(work_dir), "LogLevel=0", ""]
+    for level in range(levels):
+        for i in range(width):
+            name = "r{}_{}".format(level, i)
+            required = "r{}_{}".format(level - 1, (i * 7) % width) if level else ""
+            with open(os.path.join(work_dir, "requires-" + name), "w") as f:
+                f.write(required)
+            lines += ["[Resource]", "Name=" + name, "Path=" + ra, "AutoStart=yes",
+                      "StartRetryTimes=100", "StartRetryInterval=1", "StartTimeout=1",
+                      "MonitorInterval=30"]
+            if ordered and required:
+                lines += ["Requires=" + required]
+            lines += [""]
+    filename = os.path.join(work_dir, "bench.conf")
+    with open(filename, "w") as f:
+        f.write("\n".join(lines))
+    return filename
+
+def run(levels, width, ordered):
+    work_dir = tempfile.mkdtemp(prefix="resmon-bench-")
+    try:
+        profile = load_config(write_profile(work_dir, levels, width, ordered), False)
+        gate = StartGate(profile.general.StartConcurrency)
+        resources = []
+        for config in profile.resources:
+            res = ResourceMachine(profile, config)
+            res.start_gate = gate
+            res.add_listener(gate.resource_event)
+            resources.append(res)
+        gate.set_resources(resources)
+
+        start_time = time.time()
+        for res in resources:
+            res.start()
+        while any(res.res_state != ResourceState.STARTED for res in resources):
+            time.sleep(0.01)
+        elapsed = time.time() - start_time
+        starts = sum(res.counters["starts"] for res in resources)
+
+        for res in resources:
+            res.cancel()
+        for res in resources:
+            res.join()
+        return elapsed, starts
+    finally:
+        shutil.rmtree(work_dir)
+
+def main():
+    levels = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    if not os.path.isdir(admin_dir):
+        os.makedirs(admin_dir)
+    print "{} levels of {} resources".format(levels, width)
+    for ordered in [False, True]:
+        elapsed, starts = run(levels, width, ordered)
+        title = "Requires= ordering" if ordered else "no ordering, retries"
+        print "{:<30} {:>8.3f}s to all STARTED, {:>5} start commands".format(title, elapsed, starts)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import errno
+import socket
+import signal
+import threading
+import subprocess
+from scheduler import scheduler
+from recovery import backoff_delay
+
+""" alerts kept waiting for a sink at most; the oldest are dropped first """
+max_pending_alerts = 10000
+
+""" seconds of the first retry of a failed delivery, doubled each time """
+retry_interval = 2
+max_retry_interval = 300
+
+def alert_json(batch):
+    return json.dumps(batch, separators=(",", ":"))
+
+class ExecSink(object):
+    """ exec:PATH runs PATH with the batch as JSON on stdin """
+    def __init__(self, target, timeout):
+        self.target = target
+        self.timeout = timeout
+
+    def deliver(self, batch):
+        env = dict(os.environ, RESMOND_PROFILE=batch["profile"], RESMOND_ALERTS=str(len(batch["alerts"])))
+        with open(os.devnull, "w") as devnull:
+            proc = subprocess.Popen([self.target], stdin=subprocess.PIPE, stdout=devnull, stderr=devnull,
+                                    close_fds=True, env=env, preexec_fn=os.setpgrp)
+        timer = scheduler.call_later(self.timeout, self.kill, proc.pid, name="alert:exec")
+        try:
+            try:
+                proc.stdin.write(alert_json(batch) + "\n")
+                proc.stdin.close()
+            except IOError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+            ret = proc.wait()
+        finally:
+            timer.cancel()
+        if ret != 0:
+            raise IOError("'{}' returns {}".format(self.target, ret))
+
+    def kill(self, pid):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+class FileSink(object):
+    """ file:PATH appends the batch to PATH as a JSON line """
+    def __init__(self, target, timeout):
+        self.target = target
+
+    def deliver(self, batch):
+        with open(self.target, "a") as f:
+            f.write(alert_json(batch) + "\n")
+
+class UnixSink(object):
+    """ unix:PATH writes the batch as a JSON line to the stream socket """
+    def __init__(self, target, timeout):
+        self.target = target
+        self.timeout = timeout
+
+    def deliver(self, batch):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.target)
+            sock.sendall(alert_json(batch) + "\n")
+        finally:
+            sock.close()
+
+sink_classes = {"exec": ExecSink, "file": FileSink, "unix": UnixSink}
+
+def parse_sink(value):
+    """ returns (kind, target) of an AlertSink value; raises ValueError """
+    kind, sep, target = value.partition(":")
+    if not sep or kind not in sink_classes or not target.startswith("/"):
+        raise ValueError(value)
+    return kind, target
+
+def sink_settings(spec, general):
+    """ a sink is created anew by a reload changing them """
+    return (spec, general.AlertTimeout, general.AlertRateLimit, general.AlertRetryTimes)
+
+class AlertSink(object):
+    """ delivers the batches of a sink one at a time, at most RateLimit a
+        minute; the alerts arriving meanwhile are merged into the next
+        batch, and a failed batch is retried with backoff """
+    def __init__(self, dispatcher, spec, general):
+        self.dispatcher = dispatcher
+        self.spec = spec
+        self.settings = sink_settings(spec, general)
+        kind, target = parse_sink(spec)
+        self.sink = sink_classes[kind](target, general.AlertTimeout)
+        self.interval = 60.0 / general.AlertRateLimit
+        self.retry_max = general.AlertRetryTimes
+        self.lock = threading.Lock()
+        self.pending = []
+        self.retry = 0
+        self.timer = None
+        self.last_sent = 0
+        self.closed = False
+        self.sent = 0
+        self.batches = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def submit(self, alerts):
+        with self.lock:
+            if self.closed:
+                return
+            self.pending.extend(alerts)
+            excess = len(self.pending) - max_pending_alerts
+            if excess > 0:
+                del self.pending[:excess]
+                self.dropped += excess
+            if self.timer is None:
+                delay = self.last_sent + self.interval - time.time()
+                self.timer = scheduler.call_later(delay, self.send, name="alert:" + self.spec)
+
+    def send(self):
+        with self.lock:
+            alerts, self.pending = self.pending, []
+            if self.closed or not alerts:
+                self.timer = None
+                return
+            self.last_sent = time.time()
+        batch = self.dispatcher.batch(alerts)
+        try:
+            self.sink.deliver(batch)
+            error = None
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.timer = None
+            if error is None:
+                self.retry = 0
+                self.sent += len(alerts)
+                self.batches += 1
+                delay = self.interval if self.pending else None
+            elif self.retry < self.retry_max:
+                self.retry += 1
+                self.pending = alerts + self.pending
+                delay = max(backoff_delay(retry_interval, self.retry, 2, max_retry_interval, 20), self.interval)
+            else:
+                self.retry = 0
+                self.failed += len(alerts)
+                delay = self.interval if self.pending else None
+            retrying = self.retry > 0
+            if delay is not None and not self.closed:
+                self.timer = scheduler.call_later(delay, self.send, name="alert:" + self.spec)
+        if error is None:
+            return
+        if retrying:
+            self.dispatcher.log_error("failed to deliver {} alerts to '{}': {}, retry in {:.1f}s".format(
+                len(alerts), self.spec, error, delay))
+        else:
+            self.dispatcher.log_error("failed to deliver {} alerts to '{}': {}, they are dropped".format(
+                len(alerts), self.spec, error))
+
+    def close(self):
+        """ returns the alerts not delivered """
+        with self.lock:
+            self.closed = True
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            return len(self.pending)
+
+    def state(self):
+        with self.lock:
+            return dict(sink=self.spec, sent=self.sent, batches=self.batches, pending=len(self.pending),
+                        failed=self.failed, dropped=self.dropped, retrying=self.retry > 0)
+
+class AlertDispatcher(object):
+    """ takes the alerts of the resources of a profile without blocking
+        them; the alerts raised within AlertBatchWindow seconds of the first
+        one are sent together to every sink of the profile """
+    def __init__(self, general, log, name):
+        self.log = log
+        self.name = name
+        self.lock = threading.Lock()
+        self.collected = []
+        self.timer = None
+        self.sinks = []
+        self.configure(general)
+
+    def log_error(self, msg):
+        self.log.error("[{}:*] {}".format(self.name, msg))
+
+    def configure(self, general):
+        """ the sinks of which the value is unchanged are kept """
+        with self.lock:
+            self.window = general.AlertBatchWindow
+            kept = dict((sink.spec, sink) for sink in self.sinks)
+            sinks = []
+            for spec in general.AlertSink:
+                sink = kept.pop(spec, None)
+                if sink is None or sink.settings != sink_settings(spec, general):
+                    if sink:
+                        sink.close()
+                    sink = AlertSink(self, spec, general)
+                sinks.append(sink)
+            self.sinks = sinks
+        for sink in kept.values():
+            sink.close()
+
+    def alert(self, res, reason):
+        """ called on the thread of the resource; never blocks on a sink """
+        entry = dict(resource=res.name, reason=reason, time=time.time())
+        last_monitor = res.last_monitor
+        if last_monitor:
+            entry["value"] = last_monitor[1]
+        with self.lock:
+            if not self.sinks:
+                return False
+            self.collected.append(entry)
+            if self.timer is None:
+                self.timer = scheduler.call_later(self.window, self.flush, name=self.name + ":alerts")
+        return True
+
+    def flush(self):
+        with self.lock:
+            alerts, self.collected = self.collected, []
+            self.timer = None
+            sinks = self.sinks
+        for sink in sinks:
+            sink.submit(alerts)
+
+    def batch(self, alerts):
+        return dict(profile=self.name, time=time.time(), count=len(alerts), alerts=alerts)
+
+    def close(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            undelivered = len(self.collected)
+            self.collected = []
+            sinks, self.sinks = self.sinks, []
+        undelivered += sum(sink.close() for sink in sinks)
+        if undelivered:
+            self.log_error("{} alerts are not delivered on exit".format(undelivered))
+
+    def state(self):
+        with self.lock:
+            sinks = list(self.sinks)
+            collecting = len(self.collected)
+        return dict(collecting=collecting, sinks=[sink.state() for sink in sinks])
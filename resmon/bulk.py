@@ -0,0 +1,154 @@
+import time
+import fnmatch
+import threading
+import collections
+from resource import MachineState, ResourceState
+from depend import transient_states
+
+""" machine states in which a resource is still being started or stopped """
+starting_states = [MachineState.BEGIN, MachineState.START, MachineState.AUTOSTART, MachineState.RECOVER]
+stopping_states = [MachineState.STOP]
+
+""" extra seconds to wait beyond the command timeout of the resource """
+settle_margin = 5
+
+def select_resources(resources, selectors):
+    """ returns the resources, in profile order, matching any of the
+        selectors: a resource name, a glob pattern or tag:NAME """
+    selected = []
+    for res in resources:
+        short_name = res.config.Name
+        for selector in selectors:
+            if selector.startswith("tag:"):
+                matched = selector[4:] in res.config.Tags
+            else:
+                matched = (fnmatch.fnmatchcase(short_name, selector) or
+                           fnmatch.fnmatchcase(res.name, selector))
+            if matched:
+                selected.append(res)
+                break
+    return selected
+
+def request_start(res):
+    """ returns a message if there is nothing to wait for """
+    if res.res_state == ResourceState.STARTED and res.state not in transient_states:
+        return "already started"
+    if res.state not in starting_states:
+        res.info("resource is to be started by command")
+        res.state = MachineState.START
+    return None
+
+def request_stop(res):
+    """ returns a message if there is nothing to wait for """
+    if (res.res_state == ResourceState.STOPPED and res.state not in starting_states
+            and res.state not in transient_states):
+        return "already stopped"
+    res.info("resource is to be stopped by command")
+    res.state = MachineState.STOP
+    return None
+
+class BulkOperation(object):
+    """ starts or stops the resources, at most `concurrency` of them at the
+        same time; run() yields (resource, result) as soon as each resource
+        settles. A resource is started after the selected resources it
+        depends on (Requires= and After=) are settled, and stopped after
+        the selected resources depending on it are. Past the deadline, if
+        any, the resources not settled yet are reported at once. """
+    def __init__(self, resources, start, concurrency, deadline=None):
+        self.resources = resources
+        self.start = start
+        self.concurrency = max(1, concurrency)
+        self.deadline = deadline
+        self.cond = threading.Condition()
+
+    def settled(self, res):
+        """ the resource state is only updated by the machine thread on
+            leaving a transient state, so it is not final before """
+        busy_states = starting_states if self.start else stopping_states
+        return res.state not in busy_states and res.state not in transient_states
+
+    def result(self, res):
+        return ResourceState.rev_map[res.res_state].lower()
+
+    def timeout(self, res):
+        config = res.config
+        if self.start:
+            return config.StartTimeout + settle_margin
+        return max(config.StartTimeout, config.StopTimeout) + settle_margin
+
+    def blockers(self):
+        """ returns {res: set of the resources to be settled first} """
+        by_name = dict((res.config.Name, res) for res in self.resources)
+        blockers = dict((res, set()) for res in self.resources)
+        for res in self.resources:
+            for name in res.config.Requires + res.config.After:
+                dep = by_name.get(name)
+                if dep is None or dep is res:
+                    continue
+                if self.start:
+                    blockers[res].add(dep)
+                else:
+                    blockers[dep].add(res)
+        return blockers
+
+    def listener(self, res, event):
+        with self.cond:
+            self.cond.notify_all()
+
+    def run(self):
+        blockers = self.blockers()
+        waiters = collections.defaultdict(list) # resource => resources it blocks
+        for res, deps in blockers.items():
+            for dep in deps:
+                waiters[dep].append(res)
+        pending = collections.deque(res for res in self.resources if not blockers[res])
+        active = {} # resource => deadline
+        done = set()
+
+        def settled(res):
+            done.add(res)
+            for waiter in waiters[res]:
+                blockers[waiter].discard(res)
+                if not blockers[waiter]:
+                    pending.append(waiter)
+        for res in self.resources:
+            res.add_listener(self.listener)
+        try:
+            while pending or active:
+                if self.deadline is not None and time.time() >= self.deadline:
+                    for res in self.resources:
+                        if res in active:
+                            yield res, "deadline reached, still {}".format(MachineState.rev_map[res.state])
+                        elif res not in done:
+                            yield res, "deadline reached, not handled"
+                    return
+                while pending and len(active) < self.concurrency:
+                    res = pending.popleft()
+                    message = request_start(res) if self.start else request_stop(res)
+                    if message:
+                        settled(res)
+                        yield res, message
+                    else:
+                        active[res] = time.time() + self.timeout(res)
+
+                results = []
+                with self.cond:
+                    now = time.time()
+                    for res, deadline in active.items():
+                        if self.settled(res):
+                            del active[res]
+                            results.append((res, self.result(res)))
+                        elif deadline <= now:
+                            del active[res]
+                            results.append((res, "timeout, still {}".format(MachineState.rev_map[res.state])))
+                    if not results and active and (not pending or len(active) >= self.concurrency):
+                        wake_time = min(active.values() + ([self.deadline] if self.deadline else []))
+                        self.cond.wait(max(0.01, wake_time - now))
+                """ the consumer may block on a slow client, never yield under
+                    the lock which resource threads notify through """
+                for res, message in results:
+                    settled(res)
+                    yield res, message
+        finally:
+            for res in self.resources:
+                res.remove_listener(self.listener)
@@ -8,9 +8,14 @@ import socket
 import select
 import glob
 import errno
+import time
+import threading
+import Queue
+import json
 from resmon.common import admin_dir, command_magic_word, payload_to_packet, PacketPool, reply_magic_word
-from resmon.command import Command
+from resmon.command import Command, format_json, streamed_commands
 from resmon.config import id_regex
+from resmon.history import history_path, read_history, parse_since, history_states, MONITOR_VALUE
 
 """
     Command packet:
@@ -23,28 +28,83 @@ from resmon.config import id_regex
 """
 
 program_name = "resmon-cli"
+default_timeout = 5
+max_fan_out = 16
+
+options = type("Options", (), dict(timeout=default_timeout, unreachable=False, json=False))
 
 usage = """{0}: command line interface to interact with the running resmon daemons
 
-Usage: {0} show  [profile | profile:resource]
-       {0} start profile:resource
-       {0} stop  [profile | profile:resource]
+Usage: {0} [OPTION] show  [profile | profile:resource]
+       {0} [OPTION] start profile:resource | profile [selector...]
+       {0} [OPTION] stop  [profile:resource | profile [selector...]]
+       {0} [OPTION] watch [profile | profile:resource]
+       {0} [OPTION] reload profile
+       {0} [OPTION] metrics profile:resource [seconds]
+       {0} [OPTION] introspect profile
+       {0} [OPTION] history profile[:resource] [--since=WHEN]
        {0} help | --help | -h
 
+Options:
+       -t SEC, --timeout=SEC
+            seconds to wait for the reply of each daemon (default: {1})
+
+       -u, --unreachable
+            when showing all daemons, list the daemons which could not be
+            reached instead of failing on the first of them
+
+       --json
+            print the replies as JSON records, one per line
+
        show
             show the status of all running daemons, the daemon of which name is
             specified, or the resource of which name is specified.
 
        start
-            start the resource of which name is specified
+            start the resource of which name is specified, all resources of
+            the profile, or the resources of the profile matching any of the
+            selectors. A selector is a resource name, a glob pattern such as
+            'web*', or tag:NAME. Resources are started in parallel and each
+            result is printed as soon as the resource is settled.
 
        stop
-            stop all all running daemons, the daemon of which name is specified,
-            or the resource of which name is specified.
+            stop the resources of all running daemons, of the daemon of which
+            name is specified, the resource of which name is specified, or
+            the resources of the profile matching any of the selectors.
+
+       watch
+            keep printing the state changes and monitor values of all running
+            daemons, the daemon of which name is specified, or the resource
+            of which name is specified, until interrupted
+
+       reload
+            make the daemon of the profile re-read its config file; added
+            resources are started, removed ones are stopped and changed ones
+            are reconfigured, keeping their state and history. Sending
+            SIGHUP to the daemon does the same.
+
+       metrics
+            show the count, last, min, max, mean and 50th, 90th and 99th
+            percentiles of every metric the monitor of the resource
+            reported, over the samples of the last seconds, or all the
+            samples the daemon keeps (see MetricSamples)
+
+       introspect
+            show what the daemon of the profile holds: its threads by role,
+            pending timers, executing commands, open descriptors by type,
+            leftover message files and memory, and the running commands,
+            unconsumed state changes and queue depths of the profile
+
+       history
+            print the monitor values and state changes of the resource, or of
+            all resources of the profile, kept in the history file of the
+            profile, also when the daemon is not running. WHEN is a duration
+            ago such as 300, 15m, 2h or 1d, or a local time such as
+            2024-05-01T12:00; the whole history by default.
 
        help
             show this help
-""".format(program_name)
+""".format(program_name, default_timeout)
 
 def print_error(*args):
     msg = " ".join([str(arg) for arg in args])
@@ -60,58 +120,102 @@ def print_usage(error=None):
 def to_payload(command, data=""):
     return struct.pack("H", command) + data
 
+def profile_socket(profile):
+    return admin_dir + "/profile-{}.sock".format(profile)
+
 def issue_profile_command(profile, command, data=""):
-    domain_name = admin_dir + "/profile-{}.sock".format(profile)
+    domain_name = profile_socket(profile)
     try:
-        reply = issue_command(domain_name, command, data)
+        reply = issue_command(domain_name, command, data, options.timeout, options.json)
+    except socket.timeout:
+        print_error("Timed out waiting for the reply from '{}'".format(profile))
+        sys.exit(errno.ETIMEDOUT)
     except socket.error as e:
         print_error("Failed to connect: ", e)
         sys.exit(e.errno)
     except Exception as e:
         print_error(e)
-        sys.exit(e.errno)
+        sys.exit(1)
     return reply
 
-def issue_command(domain_name, command, data=""):
-    #domain_name = admin_dir + "/profile-{}.sock".format(profile)
-    payload = to_payload(command, data)
-    packet = payload_to_packet(command_magic_word, payload)
-    my_addr = admin_dir + "/cli-{}.sock".format(binascii.b2a_hex(os.urandom(4)))
-    try:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        sock.bind(my_addr)
-        sock.connect(domain_name)
-    except socket.error as e:
-        if os.path.exists(my_addr):
-            os.unlink(my_addr)
-        raise e
+class ControlClient(object):
+    """ a connection to a daemon, reusable for several commands """
+    def __init__(self, domain_name, timeout=None):
+        self.domain_name = domain_name
+        self.timeout = timeout
+        self.pool = PacketPool(reply_magic_word)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            """ abstract namespace: nothing is left in the filesystem """
+            self.sock.bind("\0resmon/cli-{}-{}".format(os.getpid(), binascii.b2a_hex(os.urandom(4))))
+            self.sock.settimeout(timeout)
+            self.sock.connect(domain_name)
+        except:
+            self.sock.close()
+            raise
 
-    pool = PacketPool(reply_magic_word)
-    reply = ""
-    try:
-        sock.sendall(packet)
-        inputs = [sock]
+    def send(self, command, data=""):
+        self.sock.sendall(payload_to_packet(command_magic_word, to_payload(command, data)))
+
+    def receive(self, deadline=None):
+        """ returns the next reply payload, or None if the daemon closed the
+            connection; raises socket.timeout when the deadline is passed """
+        while not self.pool.has_payload():
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise socket.timeout("timed out")
+            readable, writable, exceptional = select.select([self.sock], [], [], timeout)
+            if not readable:
+                raise socket.timeout("timed out")
+            data = self.sock.recv(65536)
+            if len(data) == 0:
+                return None # socket connection broken
+            self.pool.feed_buffer(data)
+        return self.pool.get_payload()
+
+    def deadline(self):
+        return None if self.timeout is None else time.time() + self.timeout
+
+    def request(self, command, data=""):
+        self.send(command, data)
+        reply = self.receive(self.deadline())
+        return "" if reply is None else reply
+
+    def request_stream(self, command, data="", callback=None):
+        """ for the replies streamed by the daemon: returns the joined parts,
+            or passes each part to the callback as soon as it arrives; the
+            timeout applies to each part """
+        self.send(command, data)
+        parts = []
         while True:
-            readable, writable, exceptional = select.select(inputs, [], [])
-            if sock in readable:
-                data = sock.recv(8192)
-                if len(data) == 0:
-                    break # socket connection broken
-                pool.feed_buffer(data)
-                if pool.has_payload():
-                    break
+            reply = self.receive(self.deadline())
+            if not reply:
+                break # an empty payload terminates the stream
+            if callback:
+                callback(reply)
             else:
-                break
-        payload = pool.get_payload()
-        while payload:
-            reply += payload
-            payload = pool.get_payload()
-        os.remove(my_addr)
-    except Exception as e:
-        print_error("internal error:", e)
+                parts.append(reply)
+        return "".join(parts)
+
+    def request_json(self, command, data=""):
+        """ returns the JSON records streamed by the daemon, one per line """
+        return self.request_stream(command | format_json, data)
+
+    def close(self):
+        self.sock.close()
+
+def issue_command(domain_name, command, data="", timeout=None, as_json=False):
+    client = ControlClient(domain_name, timeout)
+    try:
+        if as_json:
+            return client.request_json(command, data)
+        if command in streamed_commands:
+            return client.request_stream(command, data)
+        return client.request(command, data)
     finally:
-        sock.close()
-    return reply
+        client.close()
 
 def print_reply(data):
     if data:
@@ -128,37 +232,164 @@ def show_resource(name):
     reply = issue_profile_command(profile, Command.SHOW_RESOURCE, name)
     print_reply(reply)
 
+def fan_out(domain_names, command, data=""):
+    """ issue the command to every daemon concurrently; returns a list of
+        (domain name, reply, exception) in the order of domain_names """
+    results = [None] * len(domain_names)
+    jobs = Queue.Queue()
+    for i, domain_name in enumerate(domain_names):
+        jobs.put((i, domain_name))
+
+    def worker():
+        while True:
+            try:
+                i, domain_name = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                reply = issue_command(domain_name, command, data, options.timeout, options.json)
+                results[i] = (domain_name, reply, None)
+            except Exception as e:
+                results[i] = (domain_name, None, e)
+
+    threads = [threading.Thread(target=worker) for i in range(min(max_fan_out, len(domain_names)))]
+    for th in threads:
+        th.daemon = True
+        th.start()
+    for th in threads:
+        th.join()
+    return results
+
+def profile_of_socket(domain_name):
+    basename = os.path.basename(domain_name)
+    return basename[len("profile-"):-len(".sock")]
+
 def show_all_profiles():
-    profiles = glob.glob("/var/run/resmon/profile-*.sock")
+    profiles = sorted(glob.glob(profile_socket("*")))
     replies = []
-    for p in profiles:
-        try:
-            reply = issue_command(p, Command.SHOW_PROFILE)
+    unreachable = []
+    for domain_name, reply, e in fan_out(profiles, Command.SHOW_PROFILE):
+        if e is None:
             replies.append(reply)
-        except Exception as e:
-            # The error of ECONNREFUSED will be ignored
-            if e.errno == errno.EACCES:
-                print_error("Permission denied. Are you root?")
-                sys.exit(e.errno)
-            elif e.errno != errno.ECONNREFUSED:
-                print_error(e)
-                sys.exit(e.errno)
+            continue
+        name = profile_of_socket(domain_name)
+        if isinstance(e, socket.timeout):
+            unreachable.append((name, "no reply in {}s".format(options.timeout)))
+        elif getattr(e, "errno", None) == errno.ECONNREFUSED:
+            # a stale socket left by a daemon which is no longer running
+            if options.unreachable:
+                unreachable.append((name, "connection refused"))
+        elif getattr(e, "errno", None) == errno.EACCES and not options.unreachable:
+            print_error("Permission denied. Are you root?")
+            sys.exit(e.errno)
+        else:
+            unreachable.append((name, str(e)))
 
-    if len(replies) == 0:
+    if options.json:
+        for reply in replies:
+            sys.stdout.write(reply)
+        if options.unreachable:
+            for name, reason in unreachable:
+                print json.dumps(dict(type="unreachable", profile=name, reason=reason), separators=(",", ":"))
+    elif len(replies) == 0 and len(unreachable) == 0:
         print "No resmond process is found"
     else:
         for reply in replies:
             if reply is not replies[0]: print
             print_reply(reply)
 
+    if unreachable and not options.unreachable:
+        name, reason = unreachable[0]
+        print_error("Failed to query '{}': {}".format(name, reason))
+        sys.exit(1)
+    if unreachable:
+        if options.json: sys.exit(1)
+        if replies: print
+        print "Unreachable daemons:"
+        for name, reason in unreachable:
+            print "  [{}] {}".format(name, reason)
+        sys.exit(1)
+
+def watch(name=None):
+    if name is None:
+        domain_names = sorted(glob.glob(profile_socket("*")))
+    else:
+        domain_names = [profile_socket(name.split(":")[0])]
+    clients = {}
+    for domain_name in domain_names:
+        try:
+            client = ControlClient(domain_name, options.timeout)
+        except socket.error as e:
+            if name is not None:
+                print_error("Failed to connect: ", e)
+                sys.exit(e.errno)
+            continue # the daemon is no longer running
+        client.sock.settimeout(None)
+        client.send(Command.WATCH | (format_json if options.json else 0), name if name else "")
+        clients[client.sock] = client
+    if not clients:
+        print "No resmond process is found"
+        return
+
+    try:
+        while clients:
+            readable, writable, exceptional = select.select(clients.keys(), [], [])
+            for sock in readable:
+                client = clients[sock]
+                data = sock.recv(65536)
+                if len(data) == 0:
+                    del clients[sock]
+                    client.close()
+                    continue
+                client.pool.feed_buffer(data)
+                payload = client.pool.get_payload()
+                while payload is not None:
+                    sys.stdout.write(payload)
+                    payload = client.pool.get_payload()
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for client in clients.values():
+            client.close()
+
 def start_resource(name):
     index = name.find(':')
     profile = name[:index]
     reply = issue_profile_command(profile, Command.START_RESOURCE, name)
     print_reply(reply)
 
-def stop_profile(name):
-    print "stop profile: is not implemented"
+def issue_bulk_command(profile, command, data=""):
+    """ prints the per-resource results as they are streamed """
+    def print_part(part):
+        sys.stdout.write(part)
+        sys.stdout.flush()
+    if options.json:
+        command |= format_json
+    try:
+        client = ControlClient(profile_socket(profile), options.timeout)
+    except socket.error as e:
+        print_error("Failed to connect: ", e)
+        sys.exit(e.errno)
+    try:
+        """ each result arrives once its resource is settled, which may take
+            as long as the start or stop command does """
+        client.timeout = None
+        client.request_stream(command, data, print_part)
+    finally:
+        client.close()
+
+def start_profile(name, selectors=None):
+    if selectors:
+        issue_bulk_command(name, Command.START_MANY, ",".join(selectors))
+    else:
+        issue_bulk_command(name, Command.START_PROFILE)
+
+def stop_profile(name, selectors=None):
+    if selectors:
+        issue_bulk_command(name, Command.STOP_MANY, ",".join(selectors))
+    else:
+        issue_bulk_command(name, Command.STOP_PROFILE)
 
 def stop_resource(name):
     index = name.find(':')
@@ -166,8 +397,57 @@ def stop_resource(name):
     reply = issue_profile_command(profile, Command.STOP_RESOURCE, name)
     print_reply(reply)
 
+def reload_profile(name):
+    reply = issue_profile_command(name, Command.RELOAD)
+    print_reply(reply)
+
+def show_metrics(name, window=None):
+    profile = name[:name.find(':')]
+    reply = issue_profile_command(profile, Command.METRICS, name + (" " + window if window else ""))
+    print_reply(reply)
+
+def introspect_profile(name):
+    reply = issue_profile_command(name, Command.INTROSPECT)
+    print_reply(reply)
+
+def show_history(name, since=0):
+    profile, sep, resource = name.partition(":")
+    try:
+        records = list(read_history(history_path(profile), resource or None, since))
+    except (IOError, OSError, ValueError) as e:
+        print_error("Unable to read the history of '{}': {}".format(profile, e))
+        sys.exit(1)
+    for when, kind, res_name, value in records:
+        full_name = profile + ":" + res_name
+        if options.json:
+            record = dict(type="history", resource=full_name, time=when)
+            if kind == MONITOR_VALUE:
+                record["value"] = value
+            else:
+                record["state"] = history_states[int(value)]
+            print json.dumps(record, separators=(",", ":"))
+            continue
+        stamp = time.strftime("%b %d %H:%M:%S", time.localtime(when))
+        if kind == MONITOR_VALUE:
+            detail = "monitor value {:g}".format(value)
+        else:
+            detail = "resource is {}".format(history_states[int(value)])
+        print "{} [{}] {}".format(stamp, full_name, detail)
+
 def stop_all_profiles():
-    print "stop all profiles is not implemented"
+    profiles = sorted(glob.glob(profile_socket("*")))
+    options.timeout = None # results arrive as slow as the stop commands
+    failed = False
+    for domain_name, reply, e in fan_out(profiles, Command.STOP_PROFILE):
+        if e is None:
+            sys.stdout.write(reply)
+        elif getattr(e, "errno", None) != errno.ECONNREFUSED:
+            print_error("Failed to stop '{}': {}".format(profile_of_socket(domain_name), e))
+            failed = True
+    if not profiles:
+        print "No resmond process is found"
+    if failed:
+        sys.exit(1)
 
 def is_profile_name(str):
     return id_regex.match(str)
@@ -176,8 +456,37 @@ def is_resource_name(str):
     index = str.find(':')
     return index >= 0 and id_regex.match(str[:index]) and id_regex.match(str[index+1:])
 
+def parsing_options(argv):
+    """ strip the options from argv and store them to the global options """
+    args = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg == "-t" or arg.startswith("--timeout="):
+            if arg == "-t":
+                if i >= len(argv):
+                    print_usage("'{}' needs a value".format(arg))
+                value = argv[i]
+                i += 1
+            else:
+                value = arg[len("--timeout="):]
+            try:
+                options.timeout = float(value)
+            except ValueError:
+                print_usage("invalid timeout: {}".format(value))
+            if options.timeout <= 0:
+                print_usage("invalid timeout: {}".format(value))
+        elif arg == "-u" or arg == "--unreachable":
+            options.unreachable = True
+        elif arg == "--json":
+            options.json = True
+        else:
+            args.append(arg)
+    return args
+
 def parsing_args():
-    argv = sys.argv[1:]
+    argv = parsing_options(sys.argv[1:])
     if len(argv) == 0:
         print_usage()
 
@@ -197,21 +506,72 @@ def parsing_args():
     elif cmd == "start":
         if len(argv) == 0:
             print_usage("'{}' needs one option for resource name".format(cmd))
-        if len(argv) > 1:
-            print_usage("too many options for '{}'".format(cmd))
         if is_resource_name(argv[0]):
+            if len(argv) > 1:
+                print_usage("too many options for '{}'".format(cmd))
             start_resource(argv[0])
+        elif is_profile_name(argv[0]):
+            start_profile(argv[0], argv[1:])
         else:
             print_usage("invalid name for '{}'".format(cmd))
     elif cmd == "stop":
         if len(argv) == 0:
             stop_all_profiles()
+        elif is_resource_name(argv[0]):
+            if len(argv) > 1:
+                print_usage("too many options for '{}'".format(cmd))
+            stop_resource(argv[0])
+        elif is_profile_name(argv[0]):
+            stop_profile(argv[0], argv[1:])
+        else:
+            print_usage("invalid name for '{}'".format(cmd))
+    elif cmd == "watch":
+        if len(argv) == 0:
+            watch()
         elif len(argv) > 1:
             print_usage("too many options for '{}'".format(cmd))
+        elif is_profile_name(argv[0]) or is_resource_name(argv[0]):
+            watch(argv[0])
+        else:
+            print_usage("invalid name for '{}'".format(cmd))
+    elif cmd == "reload":
+        if len(argv) != 1:
+            print_usage("'{}' needs one option for profile name".format(cmd))
         elif is_profile_name(argv[0]):
-            stop_profile(argv[0])
-        elif is_resource_name(argv[0]):
-            stop_resource(argv[0])
+            reload_profile(argv[0])
+        else:
+            print_usage("invalid name for '{}'".format(cmd))
+    elif cmd == "metrics":
+        if len(argv) == 0 or len(argv) > 2:
+            print_usage("'{}' needs a resource name and optional seconds".format(cmd))
+        elif not is_resource_name(argv[0]):
+            print_usage("invalid name for '{}'".format(cmd))
+        elif len(argv) == 2 and not argv[1].isdigit():
+            print_usage("invalid seconds for '{}': {}".format(cmd, argv[1]))
+        else:
+            show_metrics(*argv)
+    elif cmd == "introspect":
+        if len(argv) != 1:
+            print_usage("'{}' needs one option for profile name".format(cmd))
+        elif is_profile_name(argv[0]):
+            introspect_profile(argv[0])
+        else:
+            print_usage("invalid name for '{}'".format(cmd))
+    elif cmd == "history":
+        since = 0
+        names = []
+        for arg in argv:
+            if arg.startswith("--since="):
+                try:
+                    since = parse_since(arg[len("--since="):])
+                except ValueError:
+                    print_usage("invalid time for '--since': {}".format(arg[len("--since="):]))
+            else:
+                names.append(arg)
+        if len(names) != 1:
+            print_usage("'{}' needs one option for profile or resource name".format(cmd))
+        elif is_profile_name(names[0]) or is_resource_name(names[0]):
+            show_history(names[0], since)
         else:
             print_usage("invalid name for '{}'".format(cmd))
     elif cmd == "help" or cmd == "--help" or cmd == "-h":
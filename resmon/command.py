@@ -3,10 +3,17 @@ import threading
 import binascii
 import struct
 import traceback
+import collections
+import json
+import time
 from resource import admin_dir
-from log import LogDebug, LogInfo, LogError, LogFatal
 from common import _enum_, command_magic_word, SocketServer, PacketPool, reply_magic_word, payload_to_packet
 from resource import MachineState, ResourceState
+from worker import WorkerPool
+from bulk import BulkOperation, select_resources, request_start, request_stop
+from probe import probe_cache
+from metrics import summarize, default_percentiles
+from introspect import process_report, profile_report, format_bytes, format_counts
 
 Command = _enum_(
     "SHOW_PROFILE",
@@ -15,28 +22,155 @@ Command = _enum_(
     "START_RESOURCE",
     "STOP_PROFILE",
     "STOP_RESOURCE",
+    "WATCH",
+    "START_MANY",
+    "STOP_MANY",
+    "RELOAD",
+    "METRICS",
+    "INTROSPECT",
 )
 
+""" flag in the command word asking for a reply of JSON records, one per
+    line, streamed in as many packets as needed and terminated by an empty
+    payload """
+format_json = 0x8000
+
+stream_chunk_size = 65536
+max_pending_bytes = 1024 * 1024
+
+""" a watcher with this much unread data gets its events dropped, and is
+    disconnected once it misses too many of them """
+watch_max_pending_bytes = 256 * 1024
+watch_max_dropped = 10000
+
+""" commands which only read or flip in-memory state; they are served by
+    their own lane so they never wait behind expensive ones """
+fast_commands = [
+    Command.SHOW_PROFILE,
+    Command.START_RESOURCE,
+    Command.STOP_RESOURCE,
+    Command.METRICS,
+    Command.INTROSPECT,
+]
+
+""" commands replying a stream of records, as text lines unless JSON is
+    asked; they enforce their own per-resource timeouts """
+streamed_commands = [
+    Command.START_PROFILE,
+    Command.STOP_PROFILE,
+    Command.START_MANY,
+    Command.STOP_MANY,
+]
+
+""" commands which wait for many resources to change state; they are served
+    by a lane of their own, so a few of them never hold every worker and
+    starve the short commands """
+bulk_commands = [
+    Command.START_PROFILE,
+    Command.STOP_PROFILE,
+    Command.START_MANY,
+    Command.STOP_MANY,
+]
+
+""" the workers of the bulk lane of a profile not hosted by a supervisor """
+bulk_workers = 1
+
+def json_record(record):
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+class Request(object):
+    """ a command received from a connection, waiting for its reply """
+    def __init__(self, conn, payload):
+        self.conn = conn
+        self.payload = payload
+        self.packets = collections.deque()
+        self.finished = False
+        self.timer = None
+        self.json = False
+        self.command = None
+        if len(payload) >= 2:
+            word = struct.unpack("H", payload[0:2])[0]
+            self.json = (word & format_json) != 0
+            self.command = word & ~format_json
+
+class Subscription(object):
+    """ the events a WATCH request is interested in """
+    def __init__(self, request, resource=None):
+        self.request = request
+        self.resource = resource
+        self.dropped = 0
+
+    def matches(self, res_name):
+        return self.resource is None or self.resource == res_name
+
+def format_record(record, as_json):
+    if as_json:
+        return json_record(record)
+    if record["type"] == "result":
+        return "[{}] {}\n".format(record["resource"], record["result"])
+    if record["type"] == "error":
+        return "error: {}\n".format(record["message"])
+    return record.get("message", "") + "\n"
+
+def format_event(event, as_json):
+    if as_json:
+        return json_record(dict(event, type="event"))
+    when = time.strftime("%b %d %H:%M:%S", time.localtime(event["time"]))
+    if event["event"] == "state":
+        detail = "resource is {}".format(event["state"])
+    elif event["event"] == "machine_state":
+        detail = "enter {} state".format(event["machine_state"])
+    elif event["event"] == "monitor":
+        detail = "monitor value {}".format(event["value"])
+        if event.get("metrics"):
+            detail += "".join(" {}={:g}".format(k, v) for k, v in sorted(event["metrics"].items()))
+    elif event["event"] == "dropped":
+        detail = "{} events dropped, client is too slow".format(event["count"])
+    else:
+        detail = event["event"]
+    return "{} [{}] {}\n".format(when, event["resource"], detail)
+
 class CommandProcessor(threading.Thread):
-    def __init__(self, daemon):
-        super(CommandProcessor, self).__init__(name="command processor")
+    role = "command processor" # of the thread, for INTROSPECT
+
+    def __init__(self, daemon, workers=None, fast_lane=None, bulk_lane=None):
+        """ the worker pools are created and owned by the processor unless
+            given, e.g. shared by the profiles of a supervisor """
+        super(CommandProcessor, self).__init__(name=daemon.profile.name + ":command processor")
         self.daemon = daemon
         self.profile = daemon.profile
-        self.packet_pool = PacketPool(command_magic_word)
         self.socket_server = None
+        general = self.profile.general
+        self.command_timeout = general.CommandTimeout
+        self.own_pools = workers is None
+        if self.own_pools:
+            workers = WorkerPool(self.profile.name + ":commands", general.CommandWorkers, 64)
+            fast_lane = WorkerPool(self.profile.name + ":fast-commands", 1, 64)
+            bulk_lane = WorkerPool(self.profile.name + ":bulk-commands", bulk_workers, 16)
+        self.workers = workers
+        self.fast_lane = fast_lane
+        self.bulk_lane = bulk_lane
+        self.subscriptions = []
 
     def log_error(self, *args):
-        LogError("[{}] ".format(self.profile.name), *args)
+        self.profile.logfile.error("[{}] ".format(self.profile.name), *args)
 
     def log_debug(self, *args):
-        LogDebug("[{}] ".format(self.profile.name), *args)
+        self.profile.logfile.debug("[{}] ".format(self.profile.name), *args)
 
     def log_info(self, *args):
-        LogInfo("[{}] ".format(self.profile.name), *args)
+        self.profile.logfile.info("[{}] ".format(self.profile.name), *args)
+
+    def find_resource(self, name):
+        index = self.daemon.resource_index
+        res = index.get(name)
+        if res is None and ":" not in name:
+            res = index.get(self.profile.name + ":" + name)
+        return res
 
     def do_show_profile(self):
-        reply = "Profile name: {}\n".format(self.profile.name)
-        reply += "Resources:\n"
+        reply = ["Profile name: {}\n".format(self.profile.name)]
+        reply.append("Resources:\n")
         for res in self.daemon.resources:
             state = ResourceState.rev_map[res.res_state]
             action = ""
@@ -48,46 +182,96 @@ class CommandProcessor(threading.Thread):
                 action = ", under monitoring"
             head = "  [" + res.name + "] "
             pad = " " * (30-len(head)) if len(head) < 30 else ""
-            reply += "{}{}{}{}\n".format(head, pad, state, action)
-        return reply
+            reply.append("{}{}{}{}\n".format(head, pad, state, action))
+        reply.append(self.format_recovery(self.daemon.recovery_limiter.state()))
+        reply.append(self.format_probe_cache(probe_cache.stats()))
+        reply.append(self.format_alerts(self.daemon.alerts.state()))
+        reply.append(self.format_throttle(self.daemon.throttle.state()))
+        return "".join(reply)
+
+    def format_throttle(self, state):
+        if not state["enabled"]:
+            return "Throttle: off\n"
+        if state["factor"] > 1:
+            current = "monitor intervals x{} for {}s ({})".format(state["factor"], state["throttled_for"], state["reason"])
+        else:
+            current = "within limits"
+        return "Throttle: {}, throttled {}s in total\n".format(current, state["throttled_time"])
+
+    def format_alerts(self, state):
+        if not state["sinks"]:
+            return "Alerts: no sink\n"
+        lines = ["Alerts: {} collecting\n".format(state["collecting"])]
+        for sink in state["sinks"]:
+            lines.append("  {}: {} sent in {} batches, {} pending{}, {} failed, {} dropped\n".format(
+                sink["sink"], sink["sent"], sink["batches"], sink["pending"],
+                " (retrying)" if sink["retrying"] else "", sink["failed"], sink["dropped"]))
+        return "".join(lines)
+
+    def format_probe_cache(self, stats):
+        return "Monitor cache: {} hits, {} misses, {} coalesced, {} entries\n".format(
+            stats["hits"], stats["misses"], stats["coalesced"], stats["entries"])
+
+    def format_recovery(self, state):
+        if state["rate"]:
+            rate = "{} a minute, {:.1f} of {} tokens, {} waiting".format(
+                state["rate"], state["tokens"], state["burst"], state["waiting"])
+        else:
+            rate = "not limited"
+        breaker = state["breaker"]
+        if state["breaker_closes_in"] is not None:
+            breaker += " for {}s".format(state["breaker_closes_in"])
+        return "Recoveries: {}, {} held back; breaker {}, tripped {} times, {} recent failures\n".format(
+            rate, state["deferred"], breaker, state["breaker_trips"], state["recent_failures"])
+
+    def json_show_profile(self):
+        resources = self.daemon.resources
+        yield dict(type="profile", profile=self.profile.name, pid=os.getpid(), resources=len(resources))
+        yield dict(self.daemon.recovery_limiter.state(), type="recovery")
+        yield dict(probe_cache.stats(), type="monitor_cache")
+        yield dict(self.daemon.alerts.state(), type="alerts")
+        yield dict(self.daemon.throttle.state(), type="throttle")
+        for res in resources:
+            record = res.summary()
+            record["type"] = "resource"
+            yield record
 
     def do_start_resource(self, name):
-        found = [r for r in self.daemon.resources if r.name == name]
-        if len(found) == 0:
+        res = self.find_resource(name)
+        if res is None:
             return "no such resource"
-
-        res = found[0]
-        if res.res_state == ResourceState.STARTED:
-            return "{} is already started".format(name)
-        conflicted_states = [MachineState.START, MachineState.AUTOSTART, MachineState.RECOVER]
-        if res.state not in conflicted_states and res.res_state != ResourceState.STARTED:
-            res.info("resource is to be started by command")
-            res.state = MachineState.START
-        return "ok"
+        message = request_start(res)
+        return "{} is {}".format(name, message) if message else "ok"
 
     def do_stop_resource(self, name):
-        found = [r for r in self.daemon.resources if r.name == name]
-        if len(found) == 0:
+        res = self.find_resource(name)
+        if res is None:
             return "no such resource"
+        message = request_stop(res)
+        return "{} is {}".format(name, message) if message else "ok"
 
-        res = found[0]
-        if res.res_state == ResourceState.STOPPED:
-            return "{} is already stopped".format(name)
+    def bulk_operation(self, resources, start):
+        operation = BulkOperation(resources, start, self.profile.general.BulkConcurrency)
+        for res, result in operation.run():
+            yield dict(type="result", resource=res.name, result=result)
 
-        res.info("resource is to be stopped by command")
-        res.state = MachineState.STOP
-        return "ok"
+    def bulk_select(self, data, start):
+        selectors = [selector for selector in data.split(",") if selector]
+        if not selectors:
+            return [dict(type="error", message="no resource selector")]
+        resources = select_resources(self.daemon.resources, selectors)
+        if not resources:
+            return [dict(type="error", message="no resource matches")]
+        return self.bulk_operation(resources, start)
 
     def do_show_resource(self, name):
-        found = [r for r in self.daemon.resources if r.name == name]
-        if len(found) == 0:
+        res = self.find_resource(name)
+        if res is None:
             return "no such resource"
 
-        res = found[0]
-
-        reply =  "Profile name:  {}\n".format(self.profile.name)
-        reply += "Resource name: {}\n".format(res.name)
-        reply += "    State:  {}\n".format(ResourceState.rev_map[res.res_state])
+        reply =  ["Profile name:  {}\n".format(self.profile.name)]
+        reply.append("Resource name: {}\n".format(res.name))
+        reply.append("    State:  {}\n".format(ResourceState.rev_map[res.res_state]))
         action = ""
         if res.state is MachineState.AUTOSTART:
             action = " (do atuto-starting)"
@@ -95,12 +279,33 @@ class CommandProcessor(threading.Thread):
             action = " (do recovery)"
         elif res.state is MachineState.MONITOR:
             action = " (do monitoring)"
-        reply += "    Daemon: {}{}\n".format(MachineState.rev_map[res.state], action)
-        reply += "    Events:\n"
-        """ grep the log file """
+        reply.append("    Daemon: {}{}\n".format(MachineState.rev_map[res.state], action))
+        reply.append("    Events:\n")
+        try:
+            for line in self.resource_events(res):
+                reply.append("    " + line)
+        except Exception as e:
+            reply.append("unable to open '{}': {}\n".format(self.profile.logfile.name, e))
+        return "".join(reply)
+
+    def json_show_resource(self, name):
+        res = self.find_resource(name)
+        if res is None:
+            yield dict(type="error", message="no such resource")
+            return
+        record = res.summary()
+        record["type"] = "resource"
+        yield record
         try:
-            filename = self.profile.logfile.name
-            log = open(filename, "r")
+            for line in self.resource_events(res):
+                yield dict(type="event", message=line.rstrip("\n"))
+        except Exception as e:
+            yield dict(type="error", message="unable to open '{}': {}".format(self.profile.logfile.name, e))
+
+    def resource_events(self, res):
+        """ grep the log file for the non-debug lines of the resource written
+            by this process """
+        with open(self.profile.logfile.name, "r") as log:
             current_session = "[{}]: ".format(os.getpid())
             resource_name = "[{}] ".format(res.name)
             debug_pattern = current_session + "<debug>"
@@ -111,45 +316,314 @@ class CommandProcessor(threading.Thread):
                     continue
                 if debug_pattern in line:
                     continue
-                
+
                 index = line.find(current_session)
                 line = line[:index] + line[index+len(current_session):]
                 index = line.find(resource_name)
                 line = line[:index] + line[index+len(resource_name):]
-                reply += "    " + line
-        except Exception as e:
-            reply += "unable to open '{}': {}\n".format(filename, e)
-        return reply
+                yield line
+
+    def metric_summaries(self, data):
+        """ data is "RESOURCE [SECONDS]"; returns (resource, window, [(metric,
+            summary)]) over the samples of the last SECONDS, all if 0 """
+        fields = data.split()
+        if not fields or len(fields) > 2 or (len(fields) == 2 and not fields[1].isdigit()):
+            raise ValueError("invalid metrics query")
+        res = self.find_resource(fields[0])
+        if res is None:
+            raise ValueError("no such resource")
+        window = int(fields[1]) if len(fields) == 2 else 0
+        since = time.time() - window if window else 0
+        windows = res.metric_windows(since)
+        return res, window, [(name, summarize(windows[name])) for name in sorted(windows)]
+
+    def do_metrics(self, data):
+        try:
+            res, window, summaries = self.metric_summaries(data)
+        except ValueError as e:
+            return str(e)
+        columns = ["count", "last", "min", "max", "mean"] + ["p{}".format(p) for p in default_percentiles]
+        reply = ["[{}] {}\n".format(res.name, "last {}s".format(window) if window else "all samples")]
+        if not summaries:
+            reply.append("  no metric is sampled\n")
+            return "".join(reply)
+        width = max(len(name) for name, summary in summaries) + 2
+        reply.append("  {}{}\n".format("metric".ljust(width), "".join(c.rjust(11) for c in columns)))
+        for name, summary in summaries:
+            cells = [str(summary["count"]).rjust(11)]
+            cells += ["{:>11.6g}".format(summary[c]) if c in summary else "-".rjust(11) for c in columns[1:]]
+            reply.append("  {}{}\n".format(name.ljust(width), "".join(cells)))
+        return "".join(reply)
+
+    def json_metrics(self, data):
+        try:
+            res, window, summaries = self.metric_summaries(data)
+        except ValueError as e:
+            yield dict(type="error", message=str(e))
+            return
+        for name, summary in summaries:
+            yield dict(summary, type="metric", resource=res.name, metric=name, window=window)
+
+    def do_introspect(self):
+        process, profile = process_report(), profile_report(self.daemon)
+        timers, spawn, mem = process["timers"], process["spawn"], process["memory"]
+        reply = ["Process {}: rss {}\n".format(process["pid"], format_bytes(mem["rss"]) if mem else "unknown")]
+        reply.append("  threads: {}\n".format(format_counts(process["threads"])))
+        reply.append("  timers: {} pending, {} cancelled, {} running{}\n".format(
+            timers["pending"], timers["cancelled"], timers["running"],
+            ", next due in {}s".format(timers["next_due_in"]) if timers["next_due_in"] is not None else ""))
+        reply.append("  commands executing: {}{}\n".format(
+            spawn["active"], " of {}".format(spawn["limit"]) if spawn["limit"] else ""))
+        reply.append("  fds: {}\n".format(format_counts(process["fds"])))
+        reply.append("  message files: {}, monitor cache entries: {}\n".format(
+            process["message_files"], process["monitor_cache"]))
+        reply.append("Profile {}: {} resources\n".format(profile["profile"], profile["resources"]))
+        reply.append("  commands running: {}\n".format(len(profile["commands"])))
+        for command in profile["commands"]:
+            reply.append("    [{}] '{}' {} for {:.1f}s\n".format(command["resource"], command["command"],
+                "pid {}".format(command["pid"]) if command["pid"] else "plugin call", command["running_for"]))
+        backlog = profile["semaphore_backlog"]
+        reply.append("  unconsumed state changes: {}\n".format(
+            ", ".join("{} {}".format(name, n) for name, n in sorted(backlog.items())) or "none"))
+        for pool in profile["pools"]:
+            reply.append("  {}: {} of {} busy, {} queued{}\n".format(pool["name"], pool["busy"], pool["size"],
+                pool["queued"], "" if pool["running"] else ", not started"))
+        reply.append("  watchers: {}, alerts collecting: {}\n".format(profile["watchers"], profile["alerts_collecting"]))
+        return "".join(reply)
+
+    def json_introspect(self):
+        yield dict(process_report(), type="process")
+        yield dict(profile_report(self.daemon), type="introspect")
+
+    def do_reload(self):
+        succeeded, messages = self.daemon.reload()
+        return "".join(message + "\n" for message in messages)
+
+    def do_json_command(self, command, data):
+        if command == Command.SHOW_PROFILE:
+            return self.json_show_profile()
+        elif command == Command.SHOW_RESOURCE:
+            return self.json_show_resource(data)
+        elif command == Command.START_PROFILE:
+            return self.bulk_operation(self.daemon.resources, True)
+        elif command == Command.STOP_PROFILE:
+            return self.bulk_operation(self.daemon.resources, False)
+        elif command == Command.START_MANY:
+            return self.bulk_select(data, True)
+        elif command == Command.STOP_MANY:
+            return self.bulk_select(data, False)
+        elif command == Command.METRICS:
+            return self.json_metrics(data)
+        elif command == Command.INTROSPECT:
+            return self.json_introspect()
+        elif command == Command.RELOAD:
+            succeeded, messages = self.daemon.reload()
+            return [dict(type="reload", succeeded=succeeded, messages=messages)]
+        else:
+            reply = self.do_command(struct.pack("H", command) + data)
+            return [dict(type="reply", message=reply)]
 
     def do_command(self, payload):
         reply = "Internal error!\n"
         if len(payload) < 2:
             self.log_error("invalid payload: too small")
         else:
-            command = struct.unpack("H", payload[0:2])[0]
+            command = struct.unpack("H", payload[0:2])[0] & ~format_json
             data = payload[2:]
             if command == Command.SHOW_PROFILE:
                 reply = self.do_show_profile()
             elif command == Command.START_RESOURCE:
                 reply = self.do_start_resource(data)
+            elif command == Command.STOP_RESOURCE:
+                reply = self.do_stop_resource(data)
             elif command == Command.SHOW_RESOURCE:
                 reply = self.do_show_resource(data)
+            elif command == Command.RELOAD:
+                reply = self.do_reload()
+            elif command == Command.METRICS:
+                reply = self.do_metrics(data)
+            elif command == Command.INTROSPECT:
+                reply = self.do_introspect()
             elif command in Command.rev_map:
                 self.log_error("unsupported command: ", Command.rev_map[command])
             else:
                 self.log_error("unknown command: ", command)
         return reply
 
-    def socket_server_process_data(self, data):
-        self.packet_pool.feed_buffer(data)
-        payload = self.packet_pool.get_payload()
-        reply = ""
-        while payload:
-            data = self.do_command(payload)
-            packet = payload_to_packet(reply_magic_word, data if data else "")
-            reply += packet
-            payload = self.packet_pool.get_payload()
-        return reply
+    def socket_server_process_data(self, conn, data):
+        """ runs on the socket server thread; commands are handed to the
+            worker pools and replied in the order they were received """
+        if "packet_pool" not in conn.context:
+            conn.context["packet_pool"] = PacketPool(command_magic_word)
+            conn.context["pending"] = collections.deque()
+        packet_pool = conn.context["packet_pool"]
+        packet_pool.feed_buffer(data)
+        payload = packet_pool.get_payload()
+        while payload is not None:
+            request = Request(conn, payload)
+            conn.context["pending"].append(request)
+            self.dispatch(request)
+            payload = packet_pool.get_payload()
+        return None
+
+    def dispatch(self, request):
+        if request.command == Command.WATCH:
+            self.subscribe(request)
+            return
+        if request.command in fast_commands:
+            lane = self.fast_lane
+        elif request.command in bulk_commands:
+            lane = self.bulk_lane
+        else:
+            lane = self.workers
+        if not lane.submit(self.execute, request):
+            self.log_error("command queue is full, reject the client at '{}'".format(request.conn.address))
+            self.fail(request, "Server is busy, try again later")
+            return
+        if request.command not in streamed_commands:
+            request.timer = self.socket_server.call_later(self.command_timeout, self.expire, request)
+
+    def execute(self, request):
+        """ runs on a worker thread """
+        streamed = request.command in streamed_commands
+        if not request.json and not streamed:
+            try:
+                reply = self.do_command(request.payload)
+            except Exception as e:
+                self.log_error(traceback.format_exc())
+                self.socket_server.call_soon(self.fail, request, "internal error: {}".format(e))
+                return
+            self.socket_server.call_soon(self.complete, request, reply)
+            return
+
+        chunk = []
+        size = 0
+        try:
+            for record in self.do_json_command(request.command, request.payload[2:]):
+                line = format_record(record, request.json)
+                chunk.append(line)
+                size += len(line)
+                if size >= stream_chunk_size or streamed:
+                    self.stream(request, "".join(chunk))
+                    chunk = []
+                    size = 0
+        except Exception as e:
+            self.log_error(traceback.format_exc())
+            chunk.append(format_record(dict(type="error", message="internal error: {}".format(e)), request.json))
+        if chunk:
+            self.stream(request, "".join(chunk))
+        self.socket_server.call_soon(self.complete, request, "")
+
+    def stream(self, request, data):
+        """ runs on a worker thread; holds the worker while the client is
+            slow to read what was already sent """
+        conn = request.conn
+        while (conn.pending_bytes > max_pending_bytes and not request.finished
+                and self.socket_server.is_connected(conn)):
+            time.sleep(0.01)
+        self.socket_server.call_soon(self.push, request, data)
+
+    def subscribe(self, request):
+        """ runs on the socket server thread; the request is never finished,
+            events are pushed to it until the client disconnects """
+        name = request.payload[2:]
+        resource = None
+        if name and name != self.profile.name:
+            res = self.find_resource(name)
+            if res is None:
+                self.fail(request, "no such resource")
+                self.socket_server.close_when_flushed(request.conn)
+                return
+            resource = res.name
+        subscription = Subscription(request, resource)
+        self.log_debug("client at '{}' watches {}".format(request.conn.address, name if name else "profile"))
+        self.subscriptions = self.subscriptions + [subscription]
+        for res in self.daemon.resources:
+            if subscription.matches(res.name):
+                summary = res.summary()
+                event = dict(event="state", resource=res.name, state=summary["state"], time=summary["state_since"] or time.time())
+                self.push(request, format_event(event, request.json))
+
+    def resource_event(self, res, event):
+        """ called by resource machines on their own threads """
+        if self.subscriptions and self.socket_server:
+            self.socket_server.call_soon(self.publish, event)
+
+    def publish(self, event):
+        """ runs on the socket server thread """
+        formatted = {}
+        alive = []
+        for subscription in self.subscriptions:
+            request = subscription.request
+            conn = request.conn
+            if not self.socket_server.is_connected(conn):
+                continue
+            alive.append(subscription)
+            if not subscription.matches(event["resource"]):
+                continue
+            if conn.pending_bytes > watch_max_pending_bytes:
+                subscription.dropped += 1
+                if subscription.dropped > watch_max_dropped:
+                    self.log_error("client at '{}' is too slow to watch, disconnect it".format(conn.address))
+                    self.socket_server.close_connection(conn)
+                    alive.pop()
+                continue
+            if subscription.dropped:
+                notice = dict(event="dropped", resource=event["resource"], count=subscription.dropped, time=time.time())
+                self.push(request, format_event(notice, request.json))
+                subscription.dropped = 0
+            if request.json not in formatted:
+                formatted[request.json] = format_event(event, request.json)
+            self.push(request, formatted[request.json])
+        if len(alive) != len(self.subscriptions):
+            self.subscriptions = alive
+
+    def expire(self, request):
+        command = request.command
+        self.log_error("command {} timed out after {}s".format(
+            Command.rev_map.get(command, command), self.command_timeout))
+        self.fail(request, "Command timeout")
+
+    def fail(self, request, message):
+        """ runs on the socket server thread """
+        if request.json or request.command in streamed_commands:
+            self.push(request, format_record(dict(type="error", message=message), request.json))
+            self.complete(request, "")
+        else:
+            self.complete(request, message + "\n")
+
+    def push(self, request, data):
+        """ runs on the socket server thread; queues a part of the reply """
+        if request.finished:
+            return # already replied with timeout, the late result is dropped
+        if request.timer:
+            request.timer.cancel()
+            request.timer = self.socket_server.call_later(self.command_timeout, self.expire, request)
+        request.packets.append(payload_to_packet(reply_magic_word, data))
+        self.flush(request.conn)
+
+    def complete(self, request, reply):
+        """ runs on the socket server thread """
+        if request.finished:
+            return # already replied with timeout, the late result is dropped
+        request.finished = True
+        if request.timer:
+            request.timer.cancel()
+        request.packets.append(payload_to_packet(reply_magic_word, reply if reply else ""))
+        self.flush(request.conn)
+
+    def flush(self, conn):
+        """ write the replies in the order the requests were received """
+        if not self.socket_server.is_connected(conn):
+            return
+        pending = conn.context["pending"]
+        while pending:
+            request = pending[0]
+            while request.packets:
+                self.socket_server.queue_reply(conn, request.packets.popleft())
+            if not request.finished:
+                break
+            pending.popleft()
 
     def run(self):
         sock_server_addr = admin_dir + "/profile-" + self.profile.name + ".sock"
@@ -159,14 +633,17 @@ class CommandProcessor(threading.Thread):
         except:
             self.log_error("unable to bind socket")
 
-        def process_data(data):
-            return self.socket_server_process_data(data)
+        def process_data(conn, data):
+            return self.socket_server_process_data(conn, data)
         def log_error(*args):
             return self.log_error(*args)
         def log_debug(*args):
             return self.log_debug(*args)
         self.socket_server = SocketServer(sock_server_addr, action=process_data, print_info=log_debug, print_error=log_error)
 
+        if self.own_pools:
+            for pool in self.pools():
+                pool.start()
         try:
             self.socket_server.run()
             if os.path.exists(sock_server_addr):
@@ -174,8 +651,16 @@ class CommandProcessor(threading.Thread):
         except Exception as e:
             self.log_error(traceback.format_exc())
             self.log_error("from socket server: ", e)
+        if self.own_pools:
+            for pool in self.pools():
+                pool.cancel()
+            for pool in self.pools():
+                pool.join(self.command_timeout)
         self.log_debug("exiting command processor thread, bye!")
 
+    def pools(self):
+        return [self.workers, self.fast_lane, self.bulk_lane]
+
     def cancel(self):
         if self.socket_server:
             self.socket_server.cancel()
@@ -2,10 +2,14 @@ import os
 import sys
 import socket
 import select
-import tempfile
-import shutil
+import fcntl
+import errno
 import struct
 import binascii
+import collections
+import heapq
+import threading
+import time
 
 admin_dir = "/var/run/resmon"
 command_magic_word = b"\x02\xb7"
@@ -21,62 +25,175 @@ def _enum_(*sequential, **named):
 def payload_to_packet(magic_word, payload):
     assert len(magic_word) == 2
     packet_size = 2 + 4 + len(payload) + 4
-    len_bytes = struct.pack("I", packet_size-1)
-    packet = magic_word + len_bytes + payload
-    crc = struct.pack("I", binascii.crc32(packet) & 0xFFFFFFFF)
-    packet += crc
-    return packet
+    header = magic_word + struct.pack("I", packet_size-1)
+    crc = binascii.crc32(payload, binascii.crc32(header)) & 0xFFFFFFFF
+    return b"".join([header, payload, struct.pack("I", crc)])
 
 class PacketPool(object):
-    # TODO: LogDebug should be replaced by delegate
+    """ 2 bytes MW, 4 bytes LEN, N bytes Payload, 4 bytes CRC
+
+        Incoming data is appended to a growable bytearray and consumed by
+        moving a read offset, so parsing never copies the unread remainder.
+        The consumed head is discarded only when it dominates the buffer.
+    """
+    header_size = 6
+    min_packet_size = 10
+    max_packet_size = 64 * 1024 * 1024
+    compact_threshold = 64 * 1024
+
     def __init__(self, magic_word):
         assert len(magic_word) == 2
-        self.buffer = b""
+        self.buffer = bytearray()
+        self.offset = 0
         self.mw = magic_word
-        self.payloads = []
+        self.payloads = collections.deque()
+        self.dropped_bytes = 0
 
     def feed_buffer(self, buffer):
         self.buffer += buffer
         self.parse_payload()
 
+    def resync(self, start):
+        """ skip to the next magic word after start, keeping a trailing byte
+            which might be the first half of a magic word """
+        index = self.buffer.find(self.mw, start + 1)
+        if index < 0:
+            index = max(start + 1, len(self.buffer) - 1)
+        self.dropped_bytes += index - start
+        self.offset = index
+
     def parse_payload(self):
-        """ 2 bytes MW, 4 bytes LEN, N bytes Payload, 4 bytes CRC """
-        while len(self.buffer) >= 10:
-            """ check magic word """
-            if self.buffer[0:2] != self.mw:
-                #LogDebug("drop all buffer due to incorrect magic word")
-                self.buffer = b"" # drop entire buffer
-
-            """ extract the value from length field """
-            length = struct.unpack("I", self.buffer[2:6])[0] + 1
-            #print "packet len", length, "buffer len", len(self.buffer)
-            if len(self.buffer) < length:
-                #LogDebug("imcompleted packet will be processed later")
-                break
+        buffer = self.buffer
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - self.offset >= PacketPool.min_packet_size:
+                start = self.offset
+                """ check magic word """
+                if buffer[start:start+2] != self.mw:
+                    self.resync(start)
+                    continue
 
-            """ verify the packet CRC """
-            calculated_crc = struct.pack("I", binascii.crc32(self.buffer[:length-4]) & 0xFFFFFFFF)
-            if calculated_crc != self.buffer[length-4:length]:
-                pass
-            else:
-                payload = self.buffer[6:length-4]
-                self.payloads.append(payload)
-            self.buffer = self.buffer[length:]
+                """ extract the value from length field """
+                length = struct.unpack_from("I", buffer, start+2)[0] + 1
+                if length < PacketPool.min_packet_size or length > PacketPool.max_packet_size:
+                    self.resync(start)
+                    continue
+                if len(buffer) - start < length:
+                    break # imcompleted packet will be processed later
+
+                """ verify the packet CRC """
+                end = start + length
+                calculated_crc = binascii.crc32(view[start:end-4]) & 0xFFFFFFFF
+                if calculated_crc != struct.unpack_from("I", buffer, end-4)[0]:
+                    self.resync(start)
+                    continue
+                self.payloads.append(view[start+PacketPool.header_size:end-4].tobytes())
+                self.offset = end
+        finally:
+            del view
+        self.compact()
+
+    def compact(self):
+        if self.offset == 0:
+            return
+        if self.offset == len(self.buffer):
+            del self.buffer[:]
+            self.offset = 0
+        elif self.offset >= PacketPool.compact_threshold and self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
 
     def get_payload(self):
-        if len(self.payloads) > 0:
-            paylod = self.payloads[0]
-            del self.payloads[0]
-            return paylod
+        if self.payloads:
+            return self.payloads.popleft()
         return None
 
     def has_payload(self):
         return len(self.payloads) > 0
 
     def is_empty(self):
-        return (self.buffer) == 0
+        return len(self.buffer) == self.offset
+
+class Poller(object):
+    """ level-triggered readiness notification: epoll where available,
+        poll otherwise """
+    IN = select.POLLIN
+    OUT = select.POLLOUT
+    ERR = select.POLLERR | select.POLLHUP
+
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.impl = select.epoll()
+            self.scale = 1.0
+        else:
+            self.impl = select.poll()
+            self.scale = 1000.0
+
+    def register(self, fd, events):
+        self.impl.register(fd, events)
+
+    def modify(self, fd, events):
+        self.impl.modify(fd, events)
+
+    def unregister(self, fd):
+        try:
+            self.impl.unregister(fd)
+        except (IOError, OSError, KeyError):
+            pass
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = timeout * self.scale
+        try:
+            return self.impl.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self.impl, "close"):
+            self.impl.close()
+
+def printable_address(address):
+    """ an abstract socket address begins with a NUL byte, shown as '@' like
+        ss and netstat do, so it is not written raw to the log """
+    if address.startswith("\0"):
+        return "@" + address[1:]
+    return address
+
+class Connection(object):
+    """ state of one client connection held by SocketServer """
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = printable_address(address)
+        self.out_queue = collections.deque()
+        self.out_offset = 0
+        self.pending_bytes = 0
+        self.events = Poller.IN
+        self.closing = False
+        self.context = {} # per-connection state owned by the action delegate
+
+class ScheduledCall(object):
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
 
 class SocketServer(object):
+    max_rx_len = 65536
+    max_tx_len = 262144
+
     @staticmethod
     def default_print_info(*args):
         print " ".join([str(arg) for arg in args])
@@ -85,120 +202,234 @@ class SocketServer(object):
     def default_print_error(*args):
         print >>sys.stderr, " ".join([str(arg) for arg in args])
 
-    def make_self_pipe(self):
-        try:
-            self.tmpdir = tempfile.mkdtemp()
-            pipe_name = os.path.join(self.tmpdir, "fifo")
-            os.mkfifo(pipe_name)
-            self.self_pipe = open(pipe_name, "r+b", 0)
-        except Exception as e:
-            raise RuntimeError("failed to start socket server: " + str(e))
-
-    def __init__(self, server_addr, action, print_info=None, print_error=None):
+    def __init__(self, server_addr, action, print_info=None, print_error=None, max_connections=256):
+        """ action(connection, data) is called on every receipt and returns
+            the bytes to reply or None """
         self.server_addr = server_addr
         self.running = False
         self.action = action
-        self.self_pipe = None
+        self.max_connections = max_connections
+        self.conns = {}
+        self.poller = None
+        self.wakeup_pipe = None
+        self.calls = collections.deque()
+        self.calls_lock = threading.Lock()
+        self.timers = []
         self.log_info = SocketServer.default_print_info if (print_info is None) else print_info
         self.log_error = SocketServer.default_print_error if (print_error is None) else print_error
 
+    def make_wakeup_pipe(self):
+        rfd, wfd = os.pipe()
+        for fd in (rfd, wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.wakeup_pipe = (rfd, wfd)
+
+    def wakeup(self):
+        pipe = self.wakeup_pipe
+        if pipe:
+            try:
+                os.write(pipe[1], b"x")
+            except OSError:
+                pass # pipe is full, the loop is going to wake up anyway
+
+    def drain_wakeup_pipe(self):
+        try:
+            while os.read(self.wakeup_pipe[0], 4096):
+                pass
+        except OSError:
+            pass
+
     def cancel(self):
         self.running = False
-        if self.self_pipe:
-            self.self_pipe.write("x")
+        self.wakeup()
+
+    def call_soon(self, fn, *args):
+        """ thread-safe: run fn(*args) on the server thread """
+        with self.calls_lock:
+            self.calls.append((fn, args))
+        self.wakeup()
+
+    def call_later(self, delay, fn, *args):
+        """ must be called from the server thread; returns a handle whose
+            cancel() prevents the call """
+        timer = ScheduledCall(time.time() + delay, fn, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def send(self, conn, data):
+        """ thread-safe: queue data to a connection unless it is closed """
+        def send_on_server_thread():
+            if self.conns.get(conn.fd) is conn:
+                self.queue_reply(conn, data)
+        self.call_soon(send_on_server_thread)
+
+    def is_connected(self, conn):
+        return self.conns.get(conn.fd) is conn
+
+    def run_calls(self):
+        with self.calls_lock:
+            calls, self.calls = self.calls, collections.deque()
+        now = time.time()
+        while self.timers and self.timers[0].when <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                calls.append((timer.fn, timer.args))
+        for fn, args in calls:
+            try:
+                fn(*args)
+            except Exception as e:
+                self.log_error("error in scheduled call: ", e)
+
+    def next_timeout(self):
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0, self.timers[0].when - time.time())
+
+    def watch(self, conn, events):
+        if conn.events != events:
+            conn.events = events
+            self.poller.modify(conn.fd, events)
+
+    def close_connection(self, conn):
+        self.poller.unregister(conn.fd)
+        self.conns.pop(conn.fd, None)
+        try:
+            conn.sock.close()
+        finally:
+            self.log_info("close connection with the client at '{}'".format(conn.address))
+
+    def accept_connections(self, server):
+        while True:
+            try:
+                sock, client_addr = server.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                self.log_error("error in accepting connection: ", e)
+                return
+            if len(self.conns) >= self.max_connections:
+                self.log_error("too many connections ({}), refuse the client at '{}'".format(len(self.conns), printable_address(client_addr)))
+                sock.close()
+                continue
+            sock.setblocking(0)
+            conn = Connection(sock, client_addr)
+            self.conns[conn.fd] = conn
+            self.poller.register(conn.fd, conn.events)
+            self.log_info("connection is established with the client at '{}'".format(conn.address))
+
+    def receive(self, conn):
+        try:
+            data = conn.sock.recv(SocketServer.max_rx_len)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.log_error("error in receiving data: ", e)
+            self.close_connection(conn)
+            return
+        if not data:
+            self.close_connection(conn)
+            return
+        reply = self.action(conn, data)
+        if reply:
+            self.queue_reply(conn, reply)
+
+    def queue_reply(self, conn, data):
+        """ must be called from the server thread """
+        conn.out_queue.append(data)
+        conn.pending_bytes += len(data)
+        self.transmit(conn)
+
+    def transmit(self, conn):
+        """ write as much as the socket accepts; the rest is kept with its
+            offset and sent when the socket becomes writable again """
+        queue = conn.out_queue
+        while queue:
+            head = queue[0]
+            chunk = memoryview(head)[conn.out_offset:conn.out_offset+SocketServer.max_tx_len]
+            try:
+                sent = conn.sock.send(chunk)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.log_error("error in sending data: ", e)
+                self.close_connection(conn)
+                return
+            finally:
+                del chunk
+            conn.out_offset += sent
+            conn.pending_bytes -= sent
+            if conn.out_offset >= len(head):
+                queue.popleft()
+                conn.out_offset = 0
+            elif sent == 0:
+                break
+        if not self.is_connected(conn):
+            return
+        if not queue and conn.closing:
+            self.close_connection(conn)
+            return
+        self.watch(conn, (Poller.IN | Poller.OUT) if queue else Poller.IN)
+
+    def close_when_flushed(self, conn):
+        """ must be called from the server thread """
+        conn.closing = True
+        self.transmit(conn)
 
     def run(self):
         try:
             server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             server.bind(self.server_addr)
-            server.listen(5)
+            server.listen(128)
+            server.setblocking(0)
         except:
             raise RuntimeError("unable to bind socket to " + self.server_addr)
 
         self.log_info("socket server is bound to {}".format(self.server_addr))
-        self.make_self_pipe()
-        inputs = [server, self.self_pipe]
-        outputs = []
-        conns = {}
-
-        def close_connection(x):
-            if x in inputs: inputs.remove(x)
-            if x in outputs: outputs.remove(x)
-            x.close()
-            if x in conns:
-                self.log_info("close connection with the client at '{}'".format(conns[x].address))
-                del conns[x]
-            else:
-                self.log_info("connection is closed")
-
-        def Connection(conn, address):
-            instance = dict(conn=conn, address=address, reply_queue=[])
-            return type("Connection", (), instance)
+        try:
+            self.make_wakeup_pipe()
+        except Exception as e:
+            server.close()
+            raise RuntimeError("failed to start socket server: " + str(e))
+        self.poller = Poller()
+        self.poller.register(server.fileno(), Poller.IN)
+        self.poller.register(self.wakeup_pipe[0], Poller.IN)
+        server_fd = server.fileno()
+        wakeup_fd = self.wakeup_pipe[0]
 
         self.running = True
-        while self.running:
-            readable, writable, exceptional = select.select(inputs, outputs, inputs)
-            """ dealing with connection closing """
-            for x in exceptional:
-                if x is server:
-                    self.running = True
-                    self.log_error("error in socket server, aborting service...")
-                elif x in conns:
-                    close_connection(x)
-                elif x in inputs:
-                    inputs.remove(x)
-            """ dealing with data-receiving or connection accept """
-            for x in readable:
-                if x is server:
-                    conn, client_addr = server.accept()
-                    conn.setblocking(0)
-                    inputs.append(conn)
-                    conns[conn] = Connection(conn, client_addr)
-                    self.log_info("connection is established with the client at '{}'".format(client_addr))
-                elif x in conns:
-                    self.log_info("select: ", readable, exceptional)
-                    try:
-                        data = x.recv(8192)
-                    except socket.error as e:
-                        self.log_error("error in receiving data: ", e)
-                        close_connection(x)
-                        continue
-                    if data:
-                        reply = self.action(data)
-                        if reply:
-                            conns[x].reply_queue.append(reply)
-                            outputs.append(x)
-                    else:
-                        close_connection(x)
-                elif x in inputs:
-                    inputs.remove(x)
-            """ dealing with sending data """
-            for x in writable:
-                if x in conns:
-                    queue = conns[x].reply_queue
-                    if len(queue) == 0:
-                        """ nothing to write, stop watching """
-                        if x in outputs:
-                            outputs.remove(x)
-                    else:
-                        max_tx_len = 8192
-                        if len(queue[0]) > max_tx_len:
-                            reply = queue[0][:max_tx_len]
-                            queue[0] = queue[0][max_tx_len:]
-                        else:
-                            reply = queue[0]
-                            del queue[0]
-                        try:
-                            x.sendall(reply)
-                        except socket.error as e:
-                            self.log_error("error in sending data: ", e)
-                            close_connection(x)
-                elif x in outputs:
-                    outputs.remove(x)
-            """ end of while loop """
-
         try:
-            server.close()
-            shutil.rmtree(self.tmpdir)
+            while self.running:
+                for fd, events in self.poller.poll(self.next_timeout()):
+                    if fd == server_fd:
+                        if events & Poller.ERR:
+                            self.running = False
+                            self.log_error("error in socket server, aborting service...")
+                        else:
+                            self.accept_connections(server)
+                        continue
+                    if fd == wakeup_fd:
+                        self.drain_wakeup_pipe()
+                        continue
+                    conn = self.conns.get(fd)
+                    if conn is None:
+                        continue
+                    if events & Poller.IN:
+                        self.receive(conn)
+                    elif events & Poller.ERR:
+                        self.close_connection(conn)
+                        continue
+                    if events & Poller.OUT and self.is_connected(conn):
+                        self.transmit(conn)
+                self.run_calls()
         finally:
+            for conn in self.conns.values():
+                self.close_connection(conn)
+            self.poller.close()
+            server.close()
+            for fd in self.wakeup_pipe:
+                os.close(fd)
+            self.wakeup_pipe = None
             self.log_info("socket service exited")
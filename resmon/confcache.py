@@ -0,0 +1,82 @@
+import os
+import hashlib
+import cPickle as pickle
+from common import admin_dir
+
+cache_dir = admin_dir + "/config-cache"
+
+""" bumped whenever the parsed objects change their layout """
+cache_version = 2
+
+class ConfigCache(object):
+    """ the parsed fragments of a profile, i.e. its config file and the files
+        it includes, kept across loads; a fragment is parsed again only if
+        its content is changed. The cache is best effort: it is silently
+        left out if it cannot be read or written. """
+    def __init__(self, filename):
+        key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        self.filename = os.path.join(cache_dir, key + ".cache")
+        self.entries = {} # fragment filename => (stamp, digest, pickled fragment)
+        self.dirty = False
+        self.pending = None # (filename, stamp, digest) of the fragment being parsed
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(self.filename, "rb") as f:
+                version, entries = pickle.load(f)
+            if version == cache_version:
+                self.entries = entries
+        except Exception:
+            pass
+
+    def read(self, filename):
+        """ returns (content, fragment); content is None if the fragment is
+            taken from the cache, fragment is None if it must be parsed """
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+        entry = self.entries.get(filename)
+        if entry and entry[0] == stamp:
+            self.hits += 1
+            return None, pickle.loads(entry[2])
+        with open(filename, "r") as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()
+        if entry and entry[1] == digest:
+            """ touched but not changed """
+            self.entries[filename] = (stamp, digest, entry[2])
+            self.dirty = True
+            self.hits += 1
+            return None, pickle.loads(entry[2])
+        self.misses += 1
+        self.pending = (filename, stamp, digest)
+        return content, None
+
+    def store(self, filename, fragment):
+        """ keeps the fragment just parsed from the content read() returned """
+        if self.pending is None or self.pending[0] != filename:
+            return
+        stamp, digest = self.pending[1:]
+        self.entries[filename] = (stamp, digest, pickle.dumps(fragment, pickle.HIGHEST_PROTOCOL))
+        self.dirty = True
+
+    def save(self, filenames):
+        """ drops the fragments no longer included and writes the cache """
+        for filename in self.entries.keys():
+            if filename not in filenames:
+                del self.entries[filename]
+                self.dirty = True
+        if not self.dirty:
+            return
+        tmp_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp_filename, "wb") as f:
+                pickle.dump((cache_version, self.entries), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, self.filename)
+            self.dirty = False
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
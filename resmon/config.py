@@ -1,20 +1,67 @@
 import os
 import sys
 import re
+import glob
+import time
+import threading
 import log
+from confcache import ConfigCache
+from depend import find_cycle
+from rules import compile_rule, RuleError
+from alert import parse_sink
+from plugin import plugin_regex, load_plugin
 
 config_dir_path = "/etc/resmon"
 default_log = "/var/log/resmon.log"
 default_log_level = 1
 default_timeout = 30
+default_command_workers = 4
+default_command_timeout = 10
+default_bulk_concurrency = 8
+default_snapshot_interval = 30
+default_snapshot_max_age = 300
+default_shutdown_timeout = 20
+default_breaker_window = 60
+default_breaker_pause = 300
+default_retry_max_interval = 600
+default_metric_samples = 120
+default_history_records = 65536
+default_alert_batch_window = 5
+default_alert_rate_limit = 6
+default_alert_retry_times = 3
+default_alert_timeout = 10
+default_plugin_workers = 4
+default_throttle_max_factor = 4
 
 id_regex = re.compile("^[_a-zA-Z]\\w{0,62}$")
 
+""" Name=prefix@{first..last} expands a resource to one per number """
+instance_regex = re.compile("^([_a-zA-Z]\\w*)@\\{(\\d+)\\.\\.(\\d+)\\}$")
+max_instances = 100000
+
+class ConfigError(Exception):
+    """ raised on the first error which makes the config unusable; messages
+        are what is reported up to it when they are collected """
+    def __init__(self, messages=()):
+        super(ConfigError, self).__init__("\n".join(messages) or "invalid config")
+        self.messages = list(messages)
+
+""" the messages of the config being loaded by collect_config() in this
+    thread, None while they are printed """
+report = threading.local()
+
+def report_message(msg, color):
+    messages = getattr(report, "messages", None)
+    if messages is not None:
+        messages.append(msg)
+    else:
+        sys.stderr.write("\033[{}m{}\033[0m\n".format(color, msg))
+
 def print_error(msg):
-    sys.stderr.write("\033[91m%s\033[0m\n" % msg)
+    report_message(msg, 91)
 
 def print_warn(msg):
-    sys.stderr.write("\033[93m%s\033[0m\n" % msg)
+    report_message(msg, 93)
 
 def config_error(fn, ln, msg):
     print_error("Line {}, {}: {}".format(ln, fn, msg))
@@ -42,22 +89,50 @@ class GeneralConfig(object):
         def _assert(condition, msg):
             if not condition:
                 config_error(self.filename, line, msg)
-                sys.exit(1)
+                raise ConfigError()
 
         def icmp(a, b):
             return a.lower() == b.lower()
 
+        if icmp(key, "Include"):
+            """ may be given many times; resolved by load_config() """
+            self.config[key] = self.config["Include"] + [value] if key in self.config else [value]
+            return
+        if icmp(key, "AlertSink"):
+            """ may be given many times """
+            try:
+                parse_sink(value)
+            except ValueError:
+                _assert(False, "'{}' is not valid for '{}', expect exec:PATH, file:PATH or unix:PATH".format(value, key))
+            self.config[key] = self.config["AlertSink"] + [value] if key in self.config else [value]
+            return
         _assert(key not in self.config, "'{}' is already specified".format(key))
         if icmp(key, "Profile"):
             _assert(id_regex.match(value), "'{}' is not a valid profile name".format(value))
-        elif icmp(key, "LogFile"):
+        elif icmp(key, "LogFile") or icmp(key, "HistoryFile") or icmp(key, "TraceFile"):
             """ path validation left out to complete() """
             pass
+        elif (icmp(key, "MaxConcurrentCommands") or icmp(key, "StartConcurrency")
+                or icmp(key, "SnapshotInterval") or icmp(key, "RecoverRate") or icmp(key, "HistoryRecords")
+                or icmp(key, "SelfReportInterval") or icmp(key, "ThrottleLoad")
+                or icmp(key, "AlertBatchWindow") or icmp(key, "AlertRetryTimes")):
+            _assert(value.isdigit(), "'{}' is not valid for '{}'".format(value, key))
+            value = int(value)
+        elif icmp(key, "RecoverBreaker") or icmp(key, "ThrottlePressure") or icmp(key, "ThrottleMemory"):
+            _assert(value.isdigit() and int(value) <= 100, "'{}' is not valid for '{}'".format(value, key))
+            value = int(value)
+        elif icmp(key, "StopOnExit"):
+            _assert(value.lower() in ["yes", "no"], "'{}' is not valid for '{}'".format(value, key))
+            value = value.lower() == "yes"
         elif icmp(key, "LogLevel"):
             _assert(value.isdigit() and int(value)>=0 and int(value)<=3,
                 "'{}' is not valid for '{}'".format(value, key))
             value = int(value)
-        elif icmp(key, "DefaultTimeout"):
+        elif (icmp(key, "DefaultTimeout") or icmp(key, "CommandWorkers") or icmp(key, "CommandTimeout")
+                or icmp(key, "BulkConcurrency") or icmp(key, "SnapshotMaxAge") or icmp(key, "ShutdownTimeout")
+                or icmp(key, "RecoverBurst") or icmp(key, "RecoverBreakerWindow") or icmp(key, "RecoverBreakerPause")
+                or icmp(key, "AlertRateLimit") or icmp(key, "AlertTimeout") or icmp(key, "PluginWorkers")
+                or icmp(key, "ThrottleMaxFactor")):
             _assert(value.isdigit() and int(value) > 0,
                 "'{}' is not valid for '{}'".format(value, key))
             value = int(value)
@@ -69,7 +144,7 @@ class GeneralConfig(object):
         def _assert(condition, msg):
             if not condition:
                 print_error("In [General] session, " + msg)
-                sys.exit(1)
+                raise ConfigError()
         def exists(key):
             return key in self.config
 
@@ -86,7 +161,70 @@ class GeneralConfig(object):
             self.config["LogLevel"] = default_log_level
         if not exists("DefaultTimeout"):
             self.config["DefaultTimeout"] = default_timeout
-
+        if not exists("CommandWorkers"):
+            self.config["CommandWorkers"] = default_command_workers
+        if not exists("CommandTimeout"):
+            self.config["CommandTimeout"] = default_command_timeout
+        if not exists("SelfReportInterval"):
+            self.config["SelfReportInterval"] = 0
+        for key in ("ThrottleLoad", "ThrottlePressure", "ThrottleMemory"):
+            if not exists(key):
+                self.config[key] = 0
+        if not exists("ThrottleMaxFactor"):
+            self.config["ThrottleMaxFactor"] = default_throttle_max_factor
+        if not exists("PluginWorkers"):
+            self.config["PluginWorkers"] = default_plugin_workers
+        if not exists("MaxConcurrentCommands"):
+            self.config["MaxConcurrentCommands"] = 0
+        if not exists("StartConcurrency"):
+            self.config["StartConcurrency"] = 0
+        if not exists("SnapshotInterval"):
+            self.config["SnapshotInterval"] = default_snapshot_interval
+        if not exists("ShutdownTimeout"):
+            self.config["ShutdownTimeout"] = default_shutdown_timeout
+        if not exists("StopOnExit"):
+            self.config["StopOnExit"] = False
+        if not exists("SnapshotMaxAge"):
+            self.config["SnapshotMaxAge"] = default_snapshot_max_age
+        if not exists("RecoverRate"):
+            self.config["RecoverRate"] = 0
+        if not exists("RecoverBurst"):
+            self.config["RecoverBurst"] = max(self.config["RecoverRate"], 1)
+        if not exists("RecoverBreaker"):
+            self.config["RecoverBreaker"] = 0
+        if not exists("RecoverBreakerWindow"):
+            self.config["RecoverBreakerWindow"] = default_breaker_window
+        if not exists("RecoverBreakerPause"):
+            self.config["RecoverBreakerPause"] = default_breaker_pause
+        if not exists("HistoryRecords"):
+            self.config["HistoryRecords"] = default_history_records
+        if not exists("HistoryFile"):
+            self.config["HistoryFile"] = None
+        if not exists("TraceFile"):
+            self.config["TraceFile"] = None
+        if not exists("AlertSink"):
+            self.config["AlertSink"] = []
+        if not exists("AlertBatchWindow"):
+            self.config["AlertBatchWindow"] = default_alert_batch_window
+        if not exists("AlertRateLimit"):
+            self.config["AlertRateLimit"] = default_alert_rate_limit
+        if not exists("AlertRetryTimes"):
+            self.config["AlertRetryTimes"] = default_alert_retry_times
+        if not exists("AlertTimeout"):
+            self.config["AlertTimeout"] = default_alert_timeout
+        if not exists("BulkConcurrency"):
+            self.config["BulkConcurrency"] = default_bulk_concurrency
+        if not exists("Include"):
+            self.config["Include"] = []
+
+        for key in ("HistoryFile", "TraceFile"):
+            filename = self.config[key]
+            if filename is None:
+                continue
+            _assert(os.path.isabs(filename), "'{}' must be an absolute path".format(key))
+            _assert(not os.path.isdir(filename), "'{}' cannot be a directory!".format(filename))
+            _assert(os.path.isdir(os.path.dirname(filename)),
+                "the directory of '{}' does not exist!".format(filename))
         _assert(not os.path.isdir(self.config["LogFile"]),
             "'{}' cannot be a directory!".format(self.config["LogFile"]))
         try:
@@ -98,24 +236,42 @@ class GeneralConfig(object):
 
 class ResConfig(object):
     int_keys = [
-        "StartDelay", "StartRetryInterval", "MonitorDelay", "MonitorInterval", "MonitorTimes"]
+        "StartDelay", "StartRetryInterval", "MonitorDelay", "MonitorInterval", "MonitorTimes", "MonitorCache",
+        "MetricSamples"]
     positive_int_keys = [
         "StartRetryTimes", "MonitorTimeout", "RecoverTimeout", "RecoverRetryTimes", "RecoverRetryInterval",
-        "StartTimeout", "StopTimeout", "RestartTimeout", "StatusTimeout"]
+        "StartTimeout", "StopTimeout", "RestartTimeout", "StatusTimeout", "RetryMaxInterval"]
+
+    """ the instance number, for the resources expanded from a range """
+    Instance = None
 
-    def __init__(self, filename, line):
+    """ the compiled MonitorRule values, set by complete() """
+    rules = ()
+
+    def __init__(self, filename, line, template=False):
         self.config = IDict()
         self.filename = filename
         self.start_line = line
+        self.template = template # a [Template] session
 
     def __getattr__(self, key):
         return self.config[key]
 
+    def as_dict(self):
+        """ the effective values, to tell if a reloaded resource is changed """
+        return dict(self.config)
+
+    def apply_template(self, template):
+        """ the values of the template not given in the resource """
+        for key, value in template.config.items():
+            if key != "name" and key not in self.config:
+                self.config[key] = list(value) if isinstance(value, list) else value
+
     def add(self, line, key, value):
         def _assert(condition, msg):
             if not condition:
                 config_error(self.filename, line, msg)
-                sys.exit(1)
+                raise ConfigError()
 
         def verify_int_value(key, value, lower=0, upper=2**64-1):
             _assert(value.isdigit() and int(value) >= lower and int(value) <= upper,
@@ -130,6 +286,14 @@ class ResConfig(object):
                 if icmp(k, key): return True
             return False
 
+        if icmp(key, "MonitorRule"):
+            """ may be given many times; compiled again by complete() """
+            try:
+                compile_rule(value)
+            except RuleError as e:
+                _assert(False, "'{}' is not a valid rule: {}".format(value, e))
+            self.config[key] = self.config["MonitorRule"] + [value] if key in self.config else [value]
+            return
         _assert(key not in self.config, "'{}' is already specified".format(key))
 
         if imatch(key, ResConfig.int_keys):
@@ -138,11 +302,27 @@ class ResConfig(object):
             value = verify_int_value(key, value, 1)
         elif icmp(key, "MonitorThreshold"):
             value = verify_int_value(key, value, 1, 100)
+        elif icmp(key, "RetryBackoff"):
+            value = verify_int_value(key, value, 1, 10)
+        elif icmp(key, "RetryJitter"):
+            value = verify_int_value(key, value, 0, 100)
         elif icmp(key, "MonitorDefault"):
             value = verify_int_value(key, value, 0, 100)
         elif icmp(key, "Name"):
-            _assert(id_regex.match(value), "'{}' is not a valid name".format(value))
-        elif icmp(key, "AutoStart") or icmp(key, "Monitor"):
+            m = instance_regex.match(value)
+            if m and not self.template:
+                first, last = int(m.group(2)), int(m.group(3))
+                _assert(first <= last and last - first < max_instances and id_regex.match(m.group(1) + m.group(3)),
+                    "'{}' is not a valid instance range".format(value))
+            else:
+                _assert(id_regex.match(value), "'{}' is not a valid name".format(value))
+        elif icmp(key, "MonitorCacheKey"):
+            _assert(id_regex.match(value), "'{}' is not a valid cache key".format(value))
+        elif icmp(key, "Template"):
+            _assert(not self.template, "'Template' is not valid in a template")
+            _assert(id_regex.match(value), "'{}' is not a valid template name".format(value))
+        elif (icmp(key, "AutoStart") or icmp(key, "Monitor") or icmp(key, "Critical")
+                or icmp(key, "IgnoreThrottledTimeouts")):
             if value.lower() == "yes":
                 value = True
             elif value.lower() == "no":
@@ -152,6 +332,16 @@ class ResConfig(object):
         elif icmp(key, "Path"):
             """ path validation left out to complete() """
             pass
+        elif icmp(key, "Plugin"):
+            _assert(plugin_regex.match(value), "'{}' is not valid for 'Plugin', expect module:Class".format(value))
+        elif icmp(key, "Tags"):
+            value = [tag for tag in value.split(",") if tag]
+            for tag in value:
+                _assert(id_regex.match(tag), "'{}' is not a valid tag".format(tag))
+        elif icmp(key, "Requires") or icmp(key, "After"):
+            value = [name for name in value.split(",") if name]
+            for name in value:
+                _assert(id_regex.match(name), "'{}' is not a valid resource name".format(name))
         elif icmp(key, "Action"):
             value = value.lower()
             _assert(value in ["none", "recover", "alert"],
@@ -173,16 +363,9 @@ class ResConfig(object):
             _assert(False, "'{}' is not a valid key".format(key))
         self.config[key] = value
 
-    def complete(self, common):
-        """ Apply default values """
-        def exists(key):
-            return key in self.config
-
-        def _assert(condition, msg):
-            if not condition:
-                config_error(self.filename, self.start_line, "in this resource, " + msg)
-                sys.exit(1)
-        default_values = [
+    @staticmethod
+    def default_values(common):
+        return [
             ("Name",           None), # None implies the value must be specifed
             ("AutoStart",      False),
             ("StartDelay",     0),
@@ -192,18 +375,47 @@ class ResConfig(object):
             ("StopTimeout",    common.DefaultTimeout),
             ("StatusTimeout",  common.DefaultTimeout),
             ("Monitor",        False),
+            ("Critical",       False),
+            ("IgnoreThrottledTimeouts", False),
             ("MonitorTimes",   9999),
             ("Action",         "alert"),
             ("MonitorThreshold",50),
             ("MonitorThresholdTimes", (1, 1)),
             ("StartRetryTimes", 1),
             ("RecoverRetryTimes", 1),
-            ("MonitorDefault",    0)
+            ("RetryBackoff",      1),
+            ("RetryMaxInterval",  default_retry_max_interval),
+            ("RetryJitter",       0),
+            ("MonitorDefault",    0),
+            ("MonitorCache",      0),
+            ("MonitorCacheKey",   ""),
+            ("MetricSamples",     default_metric_samples),
+            ("MonitorRule",       []),
+            ("Tags",              []),
+            ("Requires",          []),
+            ("After",             [])
         ]
+
+    def complete(self, common, default_values=None, path_checks=None):
+        """ Apply default values; default_values and path_checks may be
+            shared by the resources of a profile, so that the defaults are
+            resolved once and every RA file is checked once """
+        def exists(key):
+            return key in self.config
+
+        def _assert(condition, msg):
+            if not condition:
+                config_error(self.filename, self.start_line, "in this resource, " + msg)
+                raise ConfigError()
+        if default_values is None:
+            default_values = ResConfig.default_values(common)
+        if path_checks is None:
+            path_checks = {}
         for key, value in default_values:
             if not exists(key):
-                _assert(value is not None, "'{}' must be specified".format(key))
-                self.config[key] = value
+                if value is None:
+                    _assert(False, "'{}' must be specified".format(key))
+                self.config[key] = list(value) if isinstance(value, list) else value
         if self.config["Monitor"] is True:
             _assert(exists("MonitorInterval"), "'MonitorInterval' must be specified")
 
@@ -220,36 +432,71 @@ class ResConfig(object):
         """ second-level dependant default values """
         if not exists("MonitorDelay"):
             self.config["MonitorDelay"] = self.config["MonitorInterval"]
+        if not exists("Plugin"):
+            self.config["Plugin"] = None
+
+        self.rules = [compile_rule(text) for text in self.config["MonitorRule"]]
 
         """ Validate values """
         # Fails or just warn?
-        _assert(os.path.isfile(self.config["Path"]),
-            "path '{}' is not existent".format(self.config["Path"]))
-        _assert(os.access(self.config["Path"], os.X_OK),
-            "file '{}' is not executable".format(self.config["Path"]))
+        plugin = self.config["Plugin"]
+        if plugin is not None:
+            """ the class is loaded by the resource, it is to be loadable """
+            if plugin not in path_checks:
+                try:
+                    load_plugin(plugin)
+                    path_checks[plugin] = None
+                except Exception as e:
+                    path_checks[plugin] = str(e) or e.__class__.__name__
+            _assert(path_checks[plugin] is None, "plugin '{}' cannot be loaded: {}".format(plugin, path_checks[plugin]))
+        else:
+            path = self.config["Path"]
+            if path not in path_checks:
+                path_checks[path] = (os.path.isfile(path), os.access(path, os.X_OK))
+            is_file, executable = path_checks[path]
+            if not is_file:
+                _assert(False, "path '{}' is not existent".format(path))
+            if not executable:
+                _assert(False, "file '{}' is not executable".format(path))
         _assert(self.config["MonitorInterval"] >= self.config["MonitorTimeout"],
             "'MonitorInterval' must not less than 'MonitorTimeout'") 
         _assert(self.config["RecoverRetryInterval"] >= self.config["RecoverTimeout"],
             "'RecoverRetryInterval' must not less than 'RecoverTimeout'")
 
-def load_config(filename):
+class ResInstance(object):
+    """ a resource expanded from Name=prefix@{first..last}; the config of
+        the block is shared by all of its instances and is never changed,
+        only the name and the instance number are their own """
+    __slots__ = ["base", "Name", "Instance"]
+
+    def __init__(self, base, name, instance):
+        self.base = base
+        self.Name = name
+        self.Instance = instance
+
+    def __getattr__(self, key):
+        return getattr(self.base, key)
+
+    def as_dict(self):
+        values = self.base.as_dict()
+        values["name"] = self.Name
+        values["instance"] = self.Instance
+        return values
+
+def parse_config(filename, content, included):
+    """ returns (general, resources, errors) of one file, before the default
+        values are applied; an included file has only [Resource] sessions """
     general = None
     resource = None
     resources = []
 
-    try:
-        f = open(filename, 'r')
-    except IOError as e:
-        print_error("Failed to open file: {}".format(e))
-        sys.exit(1)
-
     space_re = re.compile("^\s*$")
     session_re = re.compile("^\[(.*)\]\s*$")
     leading_space_re = re.compile("^\s+\S+")
     equation_re = re.compile("^([_a-zA-Z]\w*)=(\S*)\s*$")
     errors = 0
 
-    for i, line in enumerate(f.readlines()):
+    for i, line in enumerate(content.splitlines(True)):
         if errors >= 10:
             break
 
@@ -272,18 +519,21 @@ def load_config(filename):
         if m:
             inner = m.group(1)
             if inner.lower() == "general":
+                if included:
+                    config_error(filename, i+1, "[General] session is not allowed in an included file")
+                    raise ConfigError()
                 if resource:
                     resources += [resource]
                     resource = None
                 if general:
                     config_error(filename, i+1, "[General] session is already defined")
-                    sys.exit(1)
+                    raise ConfigError()
                 general = GeneralConfig(filename)
-            elif inner.lower() == "resource":
+            elif inner.lower() == "resource" or inner.lower() == "template":
                 if resource:
                     resources += [resource]
                     resource = None
-                resource = ResConfig(filename, i+1)
+                resource = ResConfig(filename, i+1, inner.lower() == "template")
             else:
                 config_error(filename, i+1, "illegal session "+m.group(0))
                 errors += 1
@@ -312,25 +562,165 @@ def load_config(filename):
         resources += [resource]
         resource = None
 
+    return general, resources, errors
+
+def include_files(filename, pattern):
+    """ the files an Include value names: a file, every *.conf file in a
+        directory, or the files matching a glob pattern, relative to the
+        directory of the including file """
+    path = os.path.join(os.path.dirname(os.path.abspath(filename)), pattern)
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.conf")))
+    if glob.has_magic(path):
+        return sorted(f for f in glob.glob(path) if os.path.isfile(f))
+    if not os.path.isfile(path):
+        print_error("Included file '{}' of {} is not existent".format(pattern, filename))
+        raise ConfigError()
+    return [path]
+
+def dump_fragment(fragment):
+    """ plain data to be cached, free of the classes of this module """
+    general, resources, errors = fragment
+    if general:
+        general = dict(general.config)
+    return general, [(r.filename, r.start_line, dict(r.config), r.template) for r in resources], errors
+
+def load_fragment(filename, data):
+    general_data, resources_data, errors = data
+    general = None
+    if general_data is not None:
+        general = GeneralConfig(filename)
+        general.config.update(general_data)
+    resources = []
+    for res_filename, start_line, config, template in resources_data:
+        resource = ResConfig(res_filename, start_line, template)
+        resource.config.update(config)
+        resources.append(resource)
+    return general, resources, errors
+
+def read_config(filename, cache, included=False):
+    try:
+        if cache:
+            content, data = cache.read(filename)
+            if data is not None:
+                return load_fragment(filename, data)
+        else:
+            with open(filename, "r") as f:
+                content = f.read()
+    except (IOError, OSError) as e:
+        print_error("Failed to open file: {}".format(e))
+        raise ConfigError()
+    fragment = parse_config(filename, content, included)
+    if cache and fragment[2] == 0:
+        """ a fragment with errors is parsed, and reported, every time """
+        cache.store(filename, dump_fragment(fragment))
+    return fragment
+
+def load_config(filename, use_cache=True):
+    """ prints the errors and exits if the config is invalid """
+    try:
+        return parse_profile(filename, use_cache)
+    except ConfigError:
+        sys.exit(1)
+
+def collect_config(filename, use_cache=True):
+    """ prints nothing; raises ConfigError carrying the errors if the config
+        is invalid, or returns the profile of which `messages` are the errors
+        of the lines skipped and the warnings """
+    report.messages = []
+    try:
+        profile = parse_profile(filename, use_cache)
+        profile.messages = report.messages
+        return profile
+    except ConfigError:
+        raise ConfigError(report.messages)
+    finally:
+        report.messages = None
+
+def parse_profile(filename, use_cache):
+    started = time.time()
+    cache = ConfigCache(filename) if use_cache else None
+
+    general, resources, errors = read_config(filename, cache)
     if errors > 1000: # <<<<<<<<<<<<<<<<<<<<<
         print_error("Exit on error!")
-        sys.exit(1)
+        raise ConfigError()
 
     """ second-pass compilation for general config """
     if not general:
         print_error("[General] session is not defined!")
-        sys.exit(1)
+        raise ConfigError()
     general.complete()
 
+    """ the resources of the included files follow those of the profile """
+    filenames = [filename]
+    for pattern in general.Include:
+        for included in include_files(filename, pattern):
+            if included in filenames:
+                continue
+            filenames.append(included)
+            resources = resources + read_config(included, cache, True)[1]
+    if cache:
+        cache.save(filenames)
+
+    """ templates may be used in any file of the profile """
+    templates = {}
+    for r in resources:
+        if r.template:
+            if "Name" not in r.config:
+                config_error(r.filename, r.start_line, "in this template, 'Name' must be specified")
+                raise ConfigError()
+            if r.Name in templates:
+                print_error("Multiple template '{}' defined".format(r.Name))
+                raise ConfigError()
+            templates[r.Name] = r
+    resources = [r for r in resources if not r.template]
+
     """ second-pass compilation for resource configs """
-    res_names = []
+    default_values = ResConfig.default_values(general)
+    path_checks = {}
+    res_names = set()
+    expanded = []
     for r in resources:
-        r.complete(general)
+        if "Template" in r.config:
+            if r.Template not in templates:
+                config_error(r.filename, r.start_line, "template '{}' is not defined".format(r.Template))
+                raise ConfigError()
+            r.apply_template(templates[r.Template])
+        m = instance_regex.match(r.Name) if "Name" in r.config else None
+        if m:
+            """ completed once, with the prefix as the name so the default
+                path is shared too """
+            r.config["Name"] = m.group(1)
+            r.complete(general, default_values, path_checks)
+            expanded += [ResInstance(r, m.group(1) + str(n), n) for n in xrange(int(m.group(2)), int(m.group(3)) + 1)]
+        else:
+            r.complete(general, default_values, path_checks)
+            expanded.append(r)
+    for r in expanded:
         if r.Name in res_names:
             print_error("Multiple resource '{}' defined".format(r.Name))
-            sys.exit(1)
-        res_names += [r.Name]
+            raise ConfigError()
+        res_names.add(r.Name)
+    resources = expanded
 
+    """ dependencies must name the resources of the profile, without loops """
+    for r in resources:
+        for name in r.Requires + r.After:
+            if name not in res_names:
+                config_error(r.filename, r.start_line, "in this resource, '{}' is not a resource of the profile".format(name))
+                raise ConfigError()
+    cycle = find_cycle(resources) if any(r.Requires or r.After for r in resources) else None
+    if cycle:
+        print_error("Dependency loop: {}".format(" => ".join(cycle)))
+        raise ConfigError()
+
+    stats = dict(files=len(filenames),
+                 cached=cache.hits if cache else 0,
+                 seconds=time.time() - started)
     return type("Profile", (), dict(name      = general.profile, 
                                     logfile   = general.LogFile,
+                                    general   = general,
+                                    filename  = filename,
+                                    stats     = stats,
                                     resources = resources))
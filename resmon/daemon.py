@@ -6,15 +6,48 @@ import fcntl
 import traceback
 import threading
 import errno
-from resource import ResourceMachine
+from resource import ResourceMachine, remove_stale_message_files
 from common import admin_dir
 from log import LogDebug, LogInfo, LogError, LogFatal
 from command import CommandProcessor
+from depend import StartGate
+from shutdown import ShutdownCoordinator
+from config import collect_config, ConfigError
+from scheduler import scheduler, spawn_limiter
+from recovery import RecoveryLimiter
+from throttle import Throttle
+from history import HistoryFile, history_path
+from tracing import Tracer
+from worker import WorkerPool
+from alert import AlertDispatcher
+from introspect import process_report, profile_report, self_report_line
+from snapshot import snapshot_path, config_digest, read_snapshot, write_snapshot
 
 def print_error(msg):
     sys.stderr.write("\033[91m%s\033[0m\n" % msg)
     sys.exit(1)
 
+""" descriptors a running command holds in the daemon, the pipe reporting
+    the exec failure of the child included """
+fds_per_command = 2
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+def max_open_files():
+    try:
+        with open("/proc/self/limits") as f:
+            for line in f:
+                if line.startswith("Max open files"):
+                    value = line.split()[3]
+                    return int(value) if value.isdigit() else None
+    except (IOError, OSError):
+        pass
+    return None
+
 def create_folder(dir):
     if os.path.exists(dir):
         if not os.path.isdir(dir):
@@ -49,27 +82,319 @@ class Lock(object):
         fcntl.flock(self.handle, fcntl.LOCK_UN)
         os.remove(self.filename)
 
-class Daemon(object):
-    def __init__(self, profile):
+class ProfileService(object):
+    """ the resource machines, the control socket and the lock of a profile,
+        whether it runs in a daemon of its own or under a supervisor """
+    def __init__(self, profile, workers=None, fast_lane=None, bulk_lane=None):
         self.profile = profile
+        self.log = profile.logfile
         self.threads = []
         self.resources = []
-        self.exit_sem = threading.Semaphore(0)
+        self.resource_index = {}
+        self.lock = None
+        self.cp = None
+        self.start_gate = StartGate(profile.general.StartConcurrency)
+        self.recovery_limiter = RecoveryLimiter(profile.general, self.log, profile.name)
+        self.alerts = AlertDispatcher(profile.general, self.log, profile.name)
+        self.throttle = Throttle(profile.general, self.log, profile.name)
+        self.snapshot_timer = None
+        self.report_timer = None
+        self.history = None
+        self.tracer = None
+        self.plugin_pool = WorkerPool(profile.name + ":plugins", profile.general.PluginWorkers)
+        self.workers = workers
+        self.fast_lane = fast_lane
+        self.bulk_lane = bulk_lane
+        self.standalone = workers is None # not hosted by a supervisor
+        self.reload_lock = threading.Lock()
+        self.renamed = False # the config file names another profile now
+
+    def acquire(self):
+        """ returns False if another process is serving the profile """
+        self.lock = Lock(admin_dir + "/profile-{}.lock".format(self.profile.name))
+        return self.lock.acquire(False)
+
+    def prepare(self):
+        self.cp = CommandProcessor(self, self.workers, self.fast_lane, self.bulk_lane)
+
+    def create_resource(self, res_config):
+        res = ResourceMachine(self.profile, res_config)
+        res.start_gate = self.start_gate
+        res.recovery_limiter = self.recovery_limiter
+        res.alerts = self.alerts
+        res.throttle = self.throttle
+        res.tracer = self.tracer
+        res.plugin_pool = self.plugin_pool
+        if res_config.Plugin is not None:
+            self.plugin_pool.start()
+        if self.history:
+            res.add_listener(self.history.resource_event)
+        res.add_listener(self.start_gate.resource_event)
+        res.add_listener(self.cp.resource_event)
+        return res
+
+    def add_resource(self, res_config):
+        res = self.create_resource(res_config)
+        self.threads = self.threads + [res]
+        self.resources = self.resources + [res]
+        self.resource_index[res.name] = res
+        return res
+
+    def remove_resource(self, res):
+        self.resources = [r for r in self.resources if r is not res]
+        self.threads = [th for th in self.threads if th is not res]
+        del self.resource_index[res.name]
+        res.cancel()
+
+    def start(self):
+        self.threads += [self.cp]
+        self.open_history()
+        self.tracer = self.open_tracer(self.profile.general)
+        for res_config in self.profile.resources:
+            self.add_resource(res_config)
+        self.start_gate.set_resources(self.resources)
+        self.recovery_limiter.set_resources(len(self.resources))
+        self.restore()
+        remove_stale_message_files()
+        self.report_fd_budget()
+
+        for th in self.threads:
+            th.start()
+        self.schedule_snapshot()
+        self.schedule_self_report()
+
+    def open_history(self):
+        """ HistoryFile elsewhere than the admin dir is linked from there,
+            where resmon-cli looks for it """
+        general = self.profile.general
+        if general.HistoryRecords == 0:
+            return
+        default_path = history_path(self.profile.name)
+        filename = general.HistoryFile or default_path
+        history = HistoryFile(filename, general.HistoryRecords)
+        try:
+            if filename != default_path:
+                if os.path.islink(default_path) or os.path.exists(default_path):
+                    os.remove(default_path)
+                os.symlink(filename, default_path)
+            kept = history.open()
+        except (IOError, OSError) as e:
+            self.log.error("[{}:*] unable to open the history file '{}': {}".format(self.profile.name, filename, e))
+            return
+        if not kept:
+            self.log.info("[{}:*] history file '{}' is created for {} records".format(
+                self.profile.name, filename, general.HistoryRecords))
+        self.history = history
+
+    def open_tracer(self, general):
+        """ returns None if tracing is off or the file cannot be opened """
+        if general.TraceFile is None:
+            return None
+        tracer = Tracer(general.TraceFile, self.profile.name)
+        try:
+            tracer.open()
+        except IOError as e:
+            self.log.error("[{}:*] unable to open the trace file '{}': {}".format(self.profile.name, general.TraceFile, e))
+            return None
+        self.log.info("[{}:*] spans are traced to '{}'".format(self.profile.name, general.TraceFile))
+        return tracer
+
+    def retrace(self, general):
+        """ the spans begun before are ended in the new file """
+        old_tracer = self.tracer
+        self.tracer = self.open_tracer(general)
+        for res in self.resources:
+            res.tracer = self.tracer
+        if old_tracer:
+            old_tracer.close()
+
+    def report_fd_budget(self):
+        """ a resource holds no descriptor but while its command runs """
+        opened, limit = open_fds(), max_open_files()
+        if opened is None or limit is None:
+            return
+        commands = len(self.resources)
+        if spawn_limiter.limit > 0:
+            commands = min(commands, spawn_limiter.limit)
+        needed = opened + commands * fds_per_command
+        message = "[{}:*] fd budget: {} open, {} more for {} commands at once, limit {}".format(
+            self.profile.name, opened, commands * fds_per_command, commands, limit)
+        if needed > limit:
+            self.log.error(message + "; lower MaxConcurrentCommands or raise the limit")
+        else:
+            self.log.info(message)
+
+    def restore(self):
+        """ resources of which the snapshot is fresh and of the same config
+            begin in their saved state; their status is verified one by one
+            in the next SnapshotInterval seconds instead of all upfront """
+        general = self.profile.general
+        if general.SnapshotInterval == 0:
+            return
+        entries = read_snapshot(snapshot_path(self.profile.name), general.SnapshotMaxAge)
+        restored = [(res, entries[res.config.Name]) for res in self.resources
+                    if res.config.Name in entries and entries[res.config.Name].get("config") == config_digest(res.config)]
+        count = 0
+        for i, (res, entry) in enumerate(restored):
+            if res.restore(entry, general.SnapshotInterval * (i + 1) / float(len(restored))):
+                count += 1
+        if count:
+            self.log.info("[{}:*] {} of {} resources are restored from the snapshot".format(
+                self.profile.name, count, len(self.resources)))
+
+    def save_snapshot(self):
+        try:
+            write_snapshot(snapshot_path(self.profile.name), self.resources)
+        except (IOError, OSError) as e:
+            self.log.error("[{}:*] failed to write the snapshot: {}".format(self.profile.name, e))
+
+    def snapshot_task(self):
+        self.snapshot_timer = None
+        self.save_snapshot()
+        self.schedule_snapshot()
+
+    def schedule_snapshot(self):
+        interval = self.profile.general.SnapshotInterval
+        if interval > 0 and self.snapshot_timer is None:
+            self.snapshot_timer = scheduler.call_later(interval, self.snapshot_task, name=self.profile.name + ":snapshot")
+
+    def self_report_task(self):
+        self.report_timer = None
+        self.log.info("[{}:*] self report: {}".format(self.profile.name,
+                      self_report_line(process_report(), profile_report(self))))
+        self.schedule_self_report()
+
+    def schedule_self_report(self):
+        interval = self.profile.general.SelfReportInterval
+        if interval > 0 and self.report_timer is None:
+            self.report_timer = scheduler.call_later(interval, self.self_report_task,
+                                                     name=self.profile.name + ":self report")
+
+    def reload(self):
+        """ re-read the config file and apply the differences to the running
+            resources; returns (succeeded, messages) """
+        with self.reload_lock:
+            return self.do_reload()
+
+    def do_reload(self):
+        name = self.profile.name
+        try:
+            profile = collect_config(self.profile.filename)
+        except ConfigError as e:
+            messages = e.messages
+            self.log.error("[{}:*] failed to reload '{}', keep running the current config".format(name, self.profile.filename))
+            for line in messages:
+                self.log.error("[{}:*] {}".format(name, line))
+            return False, ["failed to reload, the current config is kept"] + messages
+        if profile.name != name:
+            profile.logfile.fp.close()
+            self.renamed = True
+            return False, ["profile name cannot be changed by reload ('{}' => '{}')".format(name, profile.name)]
+
+        """ the log object is kept, resources hold it """
+        logfile, new_logfile = self.log, profile.logfile
+        logfile.log_level = new_logfile.log_level
+        if new_logfile.name == logfile.name:
+            new_logfile.fp.close()
+        else:
+            logfile.fp, old_fp = new_logfile.fp, logfile.fp
+            logfile.name = new_logfile.name
+            old_fp.close()
+        profile.general.config["LogFile"] = logfile
+        messages = list(profile.messages) # the lines skipped and the warnings
+        general = self.profile.general
+        if (general.HistoryFile, general.HistoryRecords) != (profile.general.HistoryFile, profile.general.HistoryRecords):
+            messages.append("HistoryFile and HistoryRecords take effect on restart")
+        retrace = general.TraceFile != profile.general.TraceFile
+        self.profile.general = profile.general
+        self.cp.command_timeout = profile.general.CommandTimeout
+        self.start_gate.concurrency = profile.general.StartConcurrency
+        self.recovery_limiter.configure(profile.general)
+        self.throttle.configure(profile.general)
+        self.alerts.configure(profile.general)
+        report_timer = self.report_timer
+        if report_timer and general.SelfReportInterval != profile.general.SelfReportInterval:
+            report_timer.cancel()
+            self.report_timer = None
+        self.schedule_self_report()
+        if retrace:
+            self.retrace(profile.general)
+            messages.append("tracing to {}".format(profile.general.TraceFile) if self.tracer else "tracing is off")
+        self.schedule_snapshot()
+        if self.standalone:
+            spawn_limiter.set_limit(profile.general.MaxConcurrentCommands)
+
+        configs = dict((name + ":" + c.Name, c) for c in profile.resources)
+        for res in list(self.resources):
+            if res.name not in configs:
+                self.remove_resource(res)
+                messages.append("removed {}".format(res.name))
+        added = []
+        for res_name, config in [(name + ":" + c.Name, c) for c in profile.resources]:
+            res = self.resource_index.get(res_name)
+            if res is None:
+                added.append(self.add_resource(config))
+                messages.append("added {}".format(res_name))
+            elif res.config.as_dict() != config.as_dict():
+                res.reconfigure(config)
+                messages.append("reconfigured {}".format(res_name))
+        self.start_gate.set_resources(self.resources)
+        self.recovery_limiter.set_resources(len(self.resources))
+        if any(res.config.Plugin is not None for res in self.resources):
+            self.plugin_pool.start()
+        for res in added:
+            res.start()
+        self.profile.resources = profile.resources
+        if not messages:
+            messages.append("no resource is changed")
+        self.log.info("[{}:*] config is reloaded: {}".format(name, ", ".join(messages)))
+        return True, messages
+
+    def stop(self, deadline=None):
+        """ returns the threads still running at the deadline, by default
+            ShutdownTimeout seconds from now """
+        self.log.debug("[{}:*] start to terminate everything".format(self.profile.name))
+        if deadline is None:
+            deadline = time.time() + self.profile.general.ShutdownTimeout
+        snapshot_timer = self.snapshot_timer
+        if snapshot_timer:
+            snapshot_timer.cancel()
+        report_timer = self.report_timer
+        if report_timer:
+            report_timer.cancel()
+        stragglers = ShutdownCoordinator(self, deadline).run()
+        self.alerts.close()
+        if self.history:
+            self.history.close()
+        if self.tracer:
+            self.tracer.close()
+        self.plugin_pool.cancel()
+        self.lock.release()
+        return stragglers
+
+class Daemon(object):
+    def __init__(self, profile):
+        self.profile = profile
+        self.service = ProfileService(profile)
+        self.exiting = False
+        self.reload_requested = False
         def signal_handler(signal, frame):
-            LogInfo("[{}:*] signal is caught, terminating process".format(self.profile.name))
-            self.exit_sem.release()
+            profile.logfile.info("[{}:*] signal is caught, terminating process".format(self.profile.name))
+            self.exiting = True
+        def reload_handler(signal, frame):
+            self.reload_requested = True
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
+        signal.signal(signal.SIGHUP, reload_handler)
 
     def start(self):
         create_folder(admin_dir)
 
-        self.lock = Lock(admin_dir + "/profile-{}.lock".format(self.profile.name))
-        if self.lock.acquire(False) is False:
+        if self.service.acquire() is False:
             print_error("Process for profile '{}' is already running, exit!".format(self.profile.name))
 
         try:
-            self.cp = CommandProcessor(self)
+            self.service.prepare()
         except Exception as e:
             print_error(traceback.format_exc())
 
@@ -86,27 +411,21 @@ class Daemon(object):
             LogFatal(traceback.format_exc())
 
     def run(self):
-        LogInfo("process {} spawned for profile '{}'".format(os.getpid(), self.profile.name))
-        self.threads += [self.cp]
-        for res_config in self.profile.resources:
-            res = ResourceMachine(self.profile, res_config)
-            self.threads += [res]
-            self.resources += [res]
-
-        for th in self.threads:
-            th.start()
+        log = self.profile.logfile
+        log.info("process {} spawned for profile '{}'".format(os.getpid(), self.profile.name))
+        spawn_limiter.set_limit(self.profile.general.MaxConcurrentCommands)
+        self.service.start()
 
         """ waiting to exit main thread """
-        while self.exit_sem.acquire(False) is False:
+        while not self.exiting:
             time.sleep(999) # intends to be interrupted by signal
+            if self.reload_requested and not self.exiting:
+                self.reload_requested = False
+                self.service.reload()
 
         """ main thread is waiting here for the completions of created threads """
-        LogDebug("[{}:*] start to terminate everything".format(self.profile.name))
-        for th in self.threads:
-            th.cancel()
-        for th in self.threads:
-            th.join()
-        LogInfo("[{}:*] main thread terminated".format(self.profile.name))
-
-        self.lock.release()
-        sys.exit(0)
+        stragglers = self.service.stop()
+        log.info("[{}:*] main thread terminated".format(self.profile.name))
+        """ the log is unbuffered; leave without waiting for the stragglers
+            or the scheduler """
+        os._exit(1 if stragglers else 0)
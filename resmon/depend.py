@@ -0,0 +1,143 @@
+import threading
+import collections
+from resource import MachineState, ResourceState
+
+""" machine states in which a resource is still being started """
+starting_states = [None, MachineState.BEGIN, MachineState.START, MachineState.AUTOSTART, MachineState.RECOVER]
+
+""" machine states on the way to update the resource state """
+transient_states = [MachineState.STARTED, MachineState.STOPPED, MachineState.FAILED]
+
+def dependencies(config):
+    """ the names of the resources to be settled before the resource starts """
+    return config.Requires + [name for name in config.After if name not in config.Requires]
+
+def find_cycle(configs):
+    """ returns the names of a dependency cycle, or None """
+    deps = dict((c.Name, dependencies(c)) for c in configs)
+    visiting, done = set(), set()
+    for root in deps:
+        if root in done:
+            continue
+        path = []
+        stack = [(root, iter(deps[root]))]
+        visiting.add(root)
+        path.append(root)
+        while stack:
+            name, children = stack[-1]
+            for child in children:
+                if child in visiting:
+                    return path[path.index(child):] + [child]
+                if child not in done:
+                    visiting.add(child)
+                    path.append(child)
+                    stack.append((child, iter(deps[child])))
+                    break
+            else:
+                stack.pop()
+                path.pop()
+                visiting.discard(name)
+                done.add(name)
+    return None
+
+class StartGate(object):
+    """ holds back the auto start of the resources of a profile until what
+        they depend on is settled: the resources of Requires= must be
+        STARTED, those of After= only have to be done with starting. At
+        most `concurrency` resources are starting at the same time, 0 for
+        no limit. Resources are admitted in the order they are ready. """
+    def __init__(self, concurrency=0):
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.resources = {} # short name => ResourceMachine
+        self.dependents = {} # short name => [short names depending on it]
+        self.blocked = {} # short name => (res, callback)
+        self.ready = collections.deque()
+        self.active = set()
+
+    def set_resources(self, resources):
+        with self.lock:
+            self.resources = dict((res.config.Name, res) for res in resources)
+            dependents = collections.defaultdict(list)
+            for res in resources:
+                for name in dependencies(res.config):
+                    dependents[name].append(res.config.Name)
+            self.dependents = dict(dependents)
+            blocked = self.blocked.values()
+        for res, callback in blocked:
+            self.check(res)
+
+    def admit(self, res, callback):
+        """ callback(error) is called once the resource may be started, with
+            error None, or once it never can, with the reason """
+        with self.lock:
+            self.blocked[res.config.Name] = (res, callback)
+        self.check(res)
+
+    def cancel(self, res):
+        with self.lock:
+            self.blocked.pop(res.config.Name, None)
+            self.ready = collections.deque(e for e in self.ready if e[0] is not res)
+        self.release(res)
+
+    def release(self, res):
+        """ the resource is done with starting, its slot is free """
+        with self.lock:
+            self.active.discard(res.config.Name)
+        self.run_ready()
+
+    def state(self, res, name, required):
+        """ returns True if the dependency is met, False if it has to be
+            waited for, or the reason it never will be """
+        dep = self.resources.get(name)
+        if dep is None:
+            return True # removed by a reload
+        if dep.res_state == ResourceState.STARTED and dep.state not in starting_states:
+            return True
+        if dep.state in starting_states or dep.state in transient_states or name in self.active:
+            return False
+        if required:
+            return "required resource '{}' is {}".format(name, ResourceState.rev_map[dep.res_state])
+        return True
+
+    def check(self, res):
+        name = res.config.Name
+        with self.lock:
+            entry = self.blocked.get(name)
+            if entry is None:
+                return
+            error = None
+            for dep in dependencies(res.config):
+                state = self.state(res, dep, dep in res.config.Requires)
+                if state is False:
+                    return
+                if state is not True:
+                    error = state
+                    break
+            del self.blocked[name]
+            if error is None:
+                self.ready.append(entry)
+        if error is not None:
+            entry[1](error)
+        else:
+            self.run_ready()
+
+    def run_ready(self):
+        admitted = []
+        with self.lock:
+            while self.ready and (self.concurrency <= 0 or len(self.active) < self.concurrency):
+                res, callback = self.ready.popleft()
+                self.active.add(res.config.Name)
+                admitted.append(callback)
+        for callback in admitted:
+            callback(None)
+
+    def resource_event(self, res, event):
+        """ the listener of every resource of the profile """
+        if event["event"] != "machine_state" and event["event"] != "state":
+            return
+        with self.lock:
+            waiting = [self.blocked[name][0] for name in self.dependents.get(res.config.Name, [])
+                       if name in self.blocked]
+        for dependent in waiting:
+            self.check(dependent)
@@ -0,0 +1,147 @@
+import os
+import re
+import mmap
+import time
+import struct
+import threading
+from common import admin_dir
+
+"""
+    History file: a ring of fixed-size records mapped in memory
+
+    [HEADER][RECORD 0][RECORD 1]...[RECORD capacity-1]
+
+    HEADER, 64 bytes: magic, version, record size, capacity, and the
+    sequence number of the next record, which is written last so a reader
+    never sees a record before it is complete.
+
+    RECORD, 88 bytes: sequence number + 1 (0 for an empty slot), time, value,
+    kind, and the resource name. The record of sequence number N is in slot
+    N % capacity.
+"""
+
+history_magic = "RESMONH1"
+history_version = 1
+header_format = "<8sIIQQ"
+header_size = 64
+record_format = "<QddB63s"
+record_size = struct.calcsize(record_format)
+next_offset = struct.calcsize("<8sIIQ") # offset of the next sequence number
+
+""" kinds of record """
+MONITOR_VALUE = 1
+STATE_CHANGE = 2
+
+""" the states of a STATE_CHANGE record, by value """
+history_states = ["STARTED", "STOPPED", "FAILED", "NONE"]
+
+def history_path(profile_name):
+    return admin_dir + "/profile-{}.history".format(profile_name)
+
+class HistoryFile(object):
+    """ the monitor values and state changes of the resources of a profile,
+        kept across restarts. An append writes to the mapped file, without
+        a system call; the kernel writes the pages back. """
+    def __init__(self, filename, capacity):
+        self.filename = filename
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.fp = None
+        self.map = None
+        self.next = 0
+
+    def open(self):
+        """ returns True if the records of the file are kept, False if it is
+            created anew; raises IOError or OSError """
+        size = header_size + self.capacity * record_size
+        fp = open(self.filename, "a+b")
+        try:
+            fp.seek(0)
+            header = fp.read(header_size)
+            kept = False
+            if len(header) == header_size:
+                magic, version, rec_size, capacity, next = struct.unpack_from(header_format, header)
+                kept = (magic == history_magic and version == history_version and
+                        rec_size == record_size and capacity == self.capacity)
+            if not kept:
+                fp.truncate(0)
+                next = 0
+            fp.truncate(size)
+            self.map = mmap.mmap(fp.fileno(), size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        except:
+            fp.close()
+            raise
+        self.fp = fp
+        self.next = next
+        struct.pack_into(header_format, self.map, 0, history_magic, history_version, record_size, self.capacity, next)
+        return kept
+
+    def append(self, kind, name, value, when=None):
+        with self.lock:
+            if self.map is None:
+                return
+            seq = self.next
+            struct.pack_into(record_format, self.map, header_size + (seq % self.capacity) * record_size,
+                             seq + 1, when or time.time(), value, kind, name)
+            self.next = seq + 1
+            struct.pack_into("<Q", self.map, next_offset, self.next)
+
+    def resource_event(self, res, event):
+        """ the listener of every resource of the profile """
+        if event["event"] == "monitor":
+            self.append(MONITOR_VALUE, res.config.Name, event["value"], event["time"])
+        elif event["event"] == "state":
+            self.append(STATE_CHANGE, res.config.Name, history_states.index(event["state"]), event["time"])
+
+    def close(self):
+        with self.lock:
+            if self.map is None:
+                return
+            self.map.flush()
+            self.map.close()
+            self.fp.close()
+            self.map = None
+            self.fp = None
+
+def read_history(filename, name=None, since=0):
+    """ yields (time, kind, resource name, value) of the records of the
+        resource, all if name is None, written at or after `since`, oldest
+        first; raises IOError, OSError or ValueError """
+    with open(filename, "rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size < header_size:
+            raise ValueError("not a history file")
+        view = mmap.mmap(fp.fileno(), size, mmap.MAP_SHARED, mmap.PROT_READ)
+    try:
+        magic, version, rec_size, capacity, next = struct.unpack_from(header_format, view)
+        if magic != history_magic or version != history_version or rec_size != record_size:
+            raise ValueError("not a history file of this version")
+        if size < header_size + capacity * record_size:
+            raise ValueError("truncated history file")
+        for seq in xrange(max(0, next - capacity), next):
+            offset = header_size + (seq % capacity) * record_size
+            stamp, when, value, kind, res_name = struct.unpack_from(record_format, view, offset)
+            if stamp != seq + 1:
+                continue # overwritten since the header was read
+            res_name = res_name.rstrip("\0")
+            if when < since or (name is not None and res_name != name):
+                continue
+            yield when, kind, res_name, value
+    finally:
+        view.close()
+
+duration_regex = re.compile("^(\\d+)([smhd]?)$")
+duration_units = dict(s=1, m=60, h=3600, d=86400)
+
+def parse_since(value, now=None):
+    """ the time of "300", "15m", "2h", "1d" ago, or of a local time as
+        "2024-05-01T12:00[:00]"; raises ValueError """
+    m = duration_regex.match(value)
+    if m:
+        return (now or time.time()) - int(m.group(1)) * duration_units[m.group(2) or "s"]
+    for layout in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, layout))
+        except ValueError:
+            pass
+    raise ValueError(value)
@@ -0,0 +1,112 @@
+import os
+import glob
+import time
+import threading
+import collections
+import psutil
+from common import admin_dir
+from scheduler import scheduler, spawn_limiter
+from probe import probe_cache
+
+"""
+    What the daemon itself holds, for INTROSPECT and the self report. The
+    process part (threads, timers, descriptors, memory) is shared by the
+    profiles a supervisor hosts; the profile part is of one profile.
+"""
+
+def thread_roles():
+    """ the live threads by the role they are created with """
+    roles = collections.Counter()
+    for th in threading.enumerate():
+        if isinstance(th, threading._MainThread):
+            roles["main"] += 1
+        else:
+            roles[getattr(th, "role", "other")] += 1
+    return dict(roles)
+
+def fd_types():
+    """ the open descriptors by what they refer to """
+    types = collections.Counter()
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    for fd in fds:
+        try:
+            target = os.readlink("/proc/self/fd/" + fd)
+        except OSError:
+            continue # the descriptor listing the directory, closed since
+        if target.startswith("socket:"):
+            types["socket"] += 1
+        elif target.startswith("pipe:"):
+            types["pipe"] += 1
+        elif target.startswith("anon_inode:"):
+            types[target[len("anon_inode:"):].strip("[]")] += 1
+        elif target.startswith("/dev/"):
+            types["device"] += 1
+        else:
+            types["file"] += 1
+    return dict(types)
+
+def message_files():
+    """ the message and value files of this process not removed yet """
+    return len(glob.glob("{}/*-{}-*.tmp".format(admin_dir, os.getpid())))
+
+def memory():
+    try:
+        info = psutil.Process(os.getpid()).memory_info()
+        return dict(rss=info.rss, vms=info.vms)
+    except Exception:
+        return None
+
+def semaphore_backlog(sem):
+    """ the releases of a state machine not consumed yet """
+    return getattr(sem, "_Semaphore__value", getattr(sem, "_value", 0))
+
+def process_report():
+    return dict(pid=os.getpid(), threads=thread_roles(), timers=scheduler.stats(),
+                spawn=dict(active=spawn_limiter.active, limit=spawn_limiter.limit),
+                fds=fd_types(), message_files=message_files(), memory=memory(),
+                monitor_cache=probe_cache.stats()["entries"])
+
+def profile_report(service):
+    """ the commands running, the machines with unconsumed state changes
+        and the queues of a ProfileService """
+    now = time.time()
+    commands = []
+    backlog = {}
+    for res in service.resources:
+        running = res.running_command
+        if running:
+            command, pid, start_time = running
+            commands.append(dict(resource=res.name, command=command, pid=pid, running_for=round(now - start_time, 3)))
+        pending = semaphore_backlog(res.sem)
+        if pending:
+            backlog[res.name] = pending
+    cp = service.cp
+    pools = [pool.stats() for pool in cp.pools()] + [service.plugin_pool.stats()]
+    return dict(profile=service.profile.name, resources=len(service.resources), commands=commands,
+                semaphore_backlog=backlog, pools=pools, watchers=len(cp.subscriptions),
+                alerts_collecting=service.alerts.state()["collecting"])
+
+def format_bytes(count):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if count < 1024 or unit == "GiB":
+            return "{:.1f}{}".format(count, unit) if unit != "B" else "{}B".format(count)
+        count /= 1024.0
+
+def format_counts(counts):
+    if counts is None:
+        return "unknown"
+    return "{} ({})".format(sum(counts.values()),
+                            ", ".join("{} {}".format(n, k) for k, n in sorted(counts.items())) or "none")
+
+def self_report_line(process, profile):
+    """ a single line of the figures to watch for leaks """
+    timers = process["timers"]
+    mem = process["memory"]
+    return ("threads {}, timers {} ({} cancelled, {} running), commands {}, state backlog {}, "
+            "fds {}, message files {}, rss {}").format(
+        sum(process["threads"].values()), timers["pending"], timers["cancelled"], timers["running"],
+        len(profile["commands"]), sum(profile["semaphore_backlog"].values()), format_counts(process["fds"]),
+        process["message_files"], format_bytes(mem["rss"]) if mem else "unknown")
@@ -10,18 +10,17 @@ class DefaultLogFile(object):
 defaultLog = DefaultLogFile()
 
 class LogFile(object):
+    """ every profile has its own log file; the first one opened also takes
+        the messages not bound to any profile """
     instance = defaultLog
     banners = ["<fatal> ", "<error> ", "", "<debug> "]
 
-    def __new__(cls, *args):
-        if LogFile.instance is defaultLog:
-            LogFile.instance = object.__new__(cls, *args)
-        return LogFile.instance
-
     def __init__(self, fp, log_level, name):
         self.fp = fp
         self.log_level = log_level
         self.name = name
+        if LogFile.instance is defaultLog:
+            LogFile.instance = self
 
     def printf(self, msg_level, msg, *args):
         if msg_level > self.log_level:
@@ -35,6 +34,18 @@ class LogFile(object):
             sring += "\n"
         self.fp.write(sring)
 
+    def fatal(self, msg, *args):
+        self.printf(0, msg, *args)
+
+    def error(self, msg, *args):
+        self.printf(1, msg, *args)
+
+    def info(self, msg, *args):
+        self.printf(2, msg, *args)
+
+    def debug(self, msg, *args):
+        self.printf(3, msg, *args)
+
 def LogFatal(msg, *args):
     LogFile.instance.printf(0, msg, *args)
 
@@ -6,9 +6,12 @@ import config
 from log import LogFatal
 from daemon import Daemon
 from config import load_config
+from supervisor import Supervisor
 
 program_name = "resmond"
 
+options = type("Options", (), dict(supervise=False, max_commands=0, check=False))
+
 def print_error(msg):
     sys.stderr.write("\033[91m%s\033[0m\n" % msg)
 
@@ -20,9 +23,19 @@ def print_usage(error=None):
         print_error("Error: {}".format(error))
         print
     print "Usage: {0} [OPTION] [CONFIG_FILE]".format(program_name)
+    print "       {0} --supervise [--max-commands=N] CONFIG_DIR".format(program_name)
+    print "       {0} --check CONFIG_FILE".format(program_name)
     print ""
     print "Options:"
-    print "  -h, --help    Show this help"
+    print "  -h, --help        Show this help"
+    print "  --supervise       Host the profiles of all *.conf files in CONFIG_DIR in one"
+    print "                    process; files added, changed or removed later are"
+    print "                    picked up without restarting the other profiles;"
+    print "                    SIGHUP reloads them all at once"
+    print "  --max-commands=N  The most resource commands executing at the same time"
+    print "                    across all supervised profiles, 0 for no limit (default)"
+    print "  --check           Parse the config file and the files it includes, report"
+    print "                    the time spent and exit without starting the daemon"
     print ""
     sys.exit(1 if error else 0) 
 
@@ -39,6 +52,15 @@ def parsing_args():
                 print_usage("Options are not legal after filename: {}".format(arg))
             if arg == "--help" or arg == "-h":
                 flag_help = True;
+            elif arg == "--check":
+                options.check = True
+            elif arg == "--supervise":
+                options.supervise = True
+            elif arg.startswith("--max-commands="):
+                value = arg[len("--max-commands="):]
+                if not value.isdigit():
+                    print_usage("Invalid value for --max-commands: {}".format(value))
+                options.max_commands = int(value)
             else:
                 print_usage("Unknown option: {}".format(arg))
         else:
@@ -54,13 +76,28 @@ def parsing_args():
     if flag_help:
         print_usage()
 
+    if options.max_commands and not options.supervise:
+        print_usage("--max-commands is only for --supervise, use MaxConcurrentCommands in the config file")
+    if options.check and (options.supervise or not filename):
+        print_usage("--check needs a config file")
+    if options.supervise and not filename:
+        print_usage("--supervise needs a config directory")
+
     return filename
 
 def resmond():
     global program_name
     program_name = os.path.split(sys.argv[0])[1]
     config_filename = parsing_args()
+    if options.supervise:
+        Supervisor(config_filename, options.max_commands).start()
+        return
     profile = load_config(config_filename)
+    if options.check:
+        stats = profile.stats
+        print "Profile '{}' is valid: {} resources in {} files ({} unchanged), parsed in {:.3f}s".format(
+            profile.name, len(profile.resources), stats["files"], stats["cached"], stats["seconds"])
+        sys.exit(0)
     if len(profile.resources) == 0:
         print_warn("No resource specified in profile '{}', process is stopped!".format(profile.name))
         sys.exit(0)
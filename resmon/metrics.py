@@ -0,0 +1,103 @@
+import re
+import math
+import array
+
+""" the metrics a resource keeps at most, the monitor value included """
+max_metrics = 32
+
+metric_regex = re.compile("^[_a-zA-Z][\\w.]{0,62}$")
+
+default_percentiles = [50, 90, 99]
+
+def parse_monitor_output(content):
+    """ returns (value, {metric: number}) of what the RA wrote into the value
+        file: an integer, the monitor value, and/or name=number pairs, e.g.
+        "12 latency_ms=3.5 queue=340". The value is on the first line, the
+        pairs may be on the next ones too, where anything else is ignored as
+        it used to be. Without a value the poll counts as 0. Raises
+        ValueError. """
+    value = None
+    metrics = {}
+    for i, line in enumerate(content.split("\n")):
+        for token in line.split():
+            name, sep, number = token.partition("=")
+            if not sep:
+                if i > 0:
+                    continue
+                if value is not None or not token.isdigit():
+                    raise ValueError(token)
+                value = int(token)
+                continue
+            if not metric_regex.match(name) or name in metrics:
+                raise ValueError(token)
+            number = float(number)
+            if math.isnan(number) or math.isinf(number):
+                raise ValueError(token)
+            metrics[name] = number
+    if value is None and not metrics:
+        raise ValueError(content)
+    return (0 if value is None else value), metrics
+
+class Series(object):
+    """ the recent samples of a metric: the times and the values are kept
+        in two arrays of doubles, used as a ring once `capacity` samples are
+        kept, so a sample costs 16 bytes and no object """
+    __slots__ = ["capacity", "times", "values", "head"]
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array("d")
+        self.values = array.array("d")
+        self.head = 0 # the oldest sample once the arrays are full
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, when, value):
+        if len(self.times) < self.capacity:
+            self.times.append(when)
+            self.values.append(value)
+            return
+        self.times[self.head] = when
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+
+    def ordered(self):
+        """ (times, values) from the oldest sample """
+        head = self.head
+        return self.times[head:] + self.times[:head], self.values[head:] + self.values[:head]
+
+    def resize(self, capacity):
+        times, values = self.ordered()
+        self.times = times[-capacity:]
+        self.values = values[-capacity:]
+        self.capacity = capacity
+        self.head = 0
+
+    def window(self, since):
+        """ the values sampled at or after `since`, in time order """
+        times, values = self.ordered()
+        lo, hi = 0, len(times)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[mid] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return values[lo:]
+
+def percentile(ordered_values, p):
+    """ nearest-rank percentile of sorted values """
+    rank = int(math.ceil(p / 100.0 * len(ordered_values)))
+    return ordered_values[min(max(rank, 1), len(ordered_values)) - 1]
+
+def summarize(values, percentiles=default_percentiles):
+    """ count, last, min, max, mean and the percentiles of the values """
+    if not len(values):
+        return dict(count=0)
+    ordered = sorted(values)
+    summary = dict(count=len(values), last=values[-1], min=ordered[0], max=ordered[-1],
+                   mean=math.fsum(values) / len(values))
+    for p in percentiles:
+        summary["p{}".format(p)] = percentile(ordered, p)
+    return summary
@@ -0,0 +1,141 @@
+import os
+import re
+import sys
+import time
+import threading
+import importlib
+import traceback
+
+"""
+    Plugin=module:Class runs the commands of a resource in the daemon
+    instead of forking its RA: the class has a method per command, status,
+    start, stop, monitor and recover, each taking a PluginContext, called
+    on the plugin workers of the profile. A method returns None, True or 0
+    for success, False or an exit code otherwise; monitor returns the
+    monitor value, a {metric: number} dict which may hold "value", or both
+    as (value, metrics). Raising fails the command.
+
+    There is no process to kill on timeout: the context expires and the
+    method is expected to return soon, which it notices by ctx.expired(),
+    ctx.check() or ctx.sleep(). The class is instantiated once per resource
+    with the resource name and instance number.
+"""
+
+plugin_regex = re.compile("^([_a-zA-Z][\\w.]*):([_a-zA-Z]\\w*)$")
+
+""" the modules of plugins are looked for here first """
+plugin_dir = "/etc/resmon/plugins"
+
+plugin_commands = ["status", "start", "stop", "monitor", "recover"]
+
+""" the exit code of a plugin call which does not return in time """
+TIMEOUT_CODE = -1
+
+class PluginTimeout(Exception):
+    pass
+
+def load_plugin(spec):
+    """ returns the class of module:Class; raises ImportError,
+        AttributeError or ValueError """
+    m = plugin_regex.match(spec)
+    if not m:
+        raise ValueError("expect module:Class")
+    if plugin_dir not in sys.path:
+        sys.path.insert(0, plugin_dir)
+    cls = getattr(importlib.import_module(m.group(1)), m.group(2))
+    missing = [command for command in plugin_commands if not callable(getattr(cls, command, None))]
+    if missing:
+        raise AttributeError("'{}' has no {} method".format(spec, ", ".join(missing)))
+    return cls
+
+class PluginContext(object):
+    """ what a plugin method knows of its call """
+    __slots__ = ["resource", "instance", "command", "deadline", "event"]
+
+    def __init__(self, resource, instance, command, timeout):
+        self.resource = resource
+        self.instance = instance
+        self.command = command
+        self.deadline = time.time() + timeout
+        self.event = threading.Event() # set on timeout or cancel
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.time())
+
+    def expired(self):
+        return self.event.is_set() or time.time() >= self.deadline
+
+    def check(self):
+        """ raises PluginTimeout once the call is timed out or cancelled """
+        if self.expired():
+            raise PluginTimeout(self.command)
+
+    def sleep(self, seconds):
+        """ returns early, raising PluginTimeout, if the call expires """
+        self.event.wait(min(seconds, self.remaining()))
+        self.check()
+
+def monitor_output(result):
+    """ the text an RA would write to the value file for what the monitor
+        method returns; raises ValueError """
+    value, metrics = None, {}
+    if isinstance(result, tuple):
+        value, metrics = result
+    elif isinstance(result, dict):
+        metrics = dict(result)
+        value = metrics.pop("value", None)
+    else:
+        value = result
+    tokens = [] if value is None else [str(int(value))]
+    tokens += ["{}={!r}".format(name, float(number)) for name, number in sorted(metrics.items())]
+    if not tokens:
+        raise ValueError("monitor returns nothing")
+    return " ".join(tokens)
+
+class PluginCall(object):
+    """ a command of a plugin, run on a worker while the thread of the
+        resource waits for it """
+    __slots__ = ["context", "done", "code", "error"]
+
+    def __init__(self, context):
+        self.context = context
+        self.done = threading.Event()
+        self.code = TIMEOUT_CODE
+        self.error = None
+
+    def run(self, method, value_file):
+        ctx = self.context
+        if ctx.expired():
+            """ given up on while queued; running it late could undo what
+                the resource did since, e.g. stop after a new start """
+            self.code = TIMEOUT_CODE
+            self.done.set()
+            return
+        try:
+            result = method(ctx)
+            if ctx.event.is_set():
+                code = TIMEOUT_CODE # given up on, the value file is gone
+            elif ctx.command == "monitor":
+                with open(value_file, "w") as f:
+                    f.write(monitor_output(result))
+                code = 0
+            elif result is None or result is True:
+                code = 0
+            elif result is False:
+                code = 1
+            else:
+                code = int(result)
+        except PluginTimeout:
+            code = TIMEOUT_CODE
+        except Exception:
+            self.error = traceback.format_exc().strip().split("\n")[-1]
+            code = 1
+        self.code = code
+        self.done.set()
+
+    def wait(self):
+        """ returns False if the call is not done in time """
+        return self.done.wait(self.context.remaining()) or self.done.is_set()
+
+    def cancel(self):
+        self.context.event.set()
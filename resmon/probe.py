@@ -0,0 +1,71 @@
+import time
+import threading
+
+class Probe(object):
+    """ a monitor command in flight, waited for by the resources asking
+        for the same key meanwhile """
+    __slots__ = ["done", "result", "failed"]
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False # the command was cancelled, the result is not known
+
+class ProbeCache(object):
+    """ the monitor results of the resources probing the same target with
+        MonitorCache=: a result is reused for MonitorCache seconds, and the
+        resources asking for a key while its command runs wait for that one
+        instead of running their own """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {} # key => (time, result)
+        self.probes = {} # key => Probe in flight
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, ttl, probe, aborted):
+        """ returns the result of probe() for the key, run by this thread or
+            another one, or None if aborted() becomes true while waiting """
+        while True:
+            with self.lock:
+                cached = self.results.get(key)
+                if cached and time.time() - cached[0] < ttl:
+                    self.hits += 1
+                    return cached[1]
+                pending = self.probes.get(key)
+                if pending is None:
+                    pending = self.probes[key] = Probe()
+                    self.misses += 1
+                    break
+                self.coalesced += 1
+            while not pending.done.wait(0.5):
+                if aborted():
+                    return None
+            if not pending.failed:
+                return pending.result
+            # the command was cancelled with its resource, run one anew
+
+        try:
+            result = probe()
+            pending.result = result
+            with self.lock:
+                self.results[key] = (time.time(), result)
+            return result
+        except BaseException:
+            pending.failed = True
+            raise
+        finally:
+            with self.lock:
+                del self.probes[key]
+            pending.done.set()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return dict(hits=self.hits, misses=self.misses, coalesced=self.coalesced,
+                        entries=len(self.results),
+                        hit_ratio=round(float(self.hits + self.coalesced) / lookups, 3) if lookups else None)
+
+""" shared by every profile hosted in the process """
+probe_cache = ProbeCache()
@@ -0,0 +1,119 @@
+import time
+import random
+import threading
+
+def backoff_delay(interval, attempt, factor, max_interval, jitter):
+    """ the delay before the retry following `attempt` failures: the
+        interval grows by `factor` each time up to `max_interval`, and is
+        shortened by up to `jitter` percent at random so the resources
+        failing together do not retry together """
+    delay = interval * factor ** max(attempt - 1, 0)
+    delay = min(delay, max(interval, max_interval))
+    if jitter:
+        delay *= 1 - random.random() * jitter / 100.0
+    return delay
+
+class RecoveryLimiter(object):
+    """ paces the recoveries of a profile: a token bucket lets RecoverRate
+        recoveries a minute through, RecoverBurst at once; a circuit
+        breaker pauses all recoveries for RecoverBreakerPause seconds once
+        more than RecoverBreaker percent of the resources have failed within
+        RecoverBreakerWindow seconds, as they do when something they share
+        is down and recovering them one by one does not help """
+    def __init__(self, general, log=None, name=""):
+        self.lock = threading.Lock()
+        self.log = log
+        self.name = name
+        self.resource_count = 0
+        self.failures = {} # resource name => time of its last failure
+        self.open_until = 0
+        self.trips = 0
+        self.deferred = 0 # recoveries which had to wait
+        self.tokens = None
+        self.token_time = time.time()
+        self.configure(general)
+
+    def configure(self, general):
+        with self.lock:
+            self.rate = general.RecoverRate / 60.0 # tokens a second
+            self.burst = general.RecoverBurst
+            self.breaker = general.RecoverBreaker
+            self.window = general.RecoverBreakerWindow
+            self.pause = general.RecoverBreakerPause
+            if self.tokens is None or self.tokens > self.burst:
+                self.tokens = float(self.burst)
+
+    def set_resources(self, count):
+        with self.lock:
+            self.resource_count = count
+
+    def refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.token_time) * self.rate)
+        self.token_time = now
+
+    def failed(self, res_name):
+        """ a resource is to be recovered; may trip the breaker """
+        now = time.time()
+        with self.lock:
+            self.failures[res_name] = now
+            if self.breaker <= 0 or now < self.open_until:
+                return
+            since = now - self.window
+            self.failures = dict((name, t) for name, t in self.failures.items() if t >= since)
+            failed = len(self.failures)
+            if failed < 2 or failed * 100 <= self.breaker * self.resource_count:
+                return
+            self.open_until = now + self.pause
+            self.trips += 1
+            self.failures = {}
+        if self.log:
+            self.log.error("[{}:*] {} of {} resources failed within {}s, recoveries paused for {}s".format(
+                self.name, failed, self.resource_count, self.window, self.pause))
+
+    def paused(self):
+        """ returns the seconds the breaker still pauses the recoveries, or 0 """
+        now = time.time()
+        with self.lock:
+            if now < self.open_until:
+                self.deferred += 1
+                return self.open_until - now
+            return 0
+
+    def acquire(self):
+        """ takes a token; returns 0 if the recovery may run now, or the
+            seconds to wait before it does. The token is reserved for the
+            recovery meanwhile, so the waiting ones are let through in order
+            at the pace of the bucket and need not ask again """
+        now = time.time()
+        with self.lock:
+            if self.rate <= 0:
+                return 0
+            self.refill(now)
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            self.deferred += 1
+            return -self.tokens / self.rate
+
+    def release(self):
+        """ gives back the token of a recovery given up before it ran """
+        with self.lock:
+            if self.rate > 0:
+                self.tokens = min(float(self.burst), self.tokens + 1)
+
+    def state(self):
+        """ the limiter as reported over the control socket """
+        now = time.time()
+        with self.lock:
+            self.refill(now)
+            return dict(
+                rate=int(round(self.rate * 60)),
+                burst=self.burst,
+                tokens=round(max(self.tokens, 0), 2) if self.rate > 0 else None,
+                waiting=max(int(-self.tokens // 1), 0) if self.rate > 0 else 0,
+                deferred=self.deferred,
+                breaker="open" if now < self.open_until else "closed",
+                breaker_closes_in=round(self.open_until - now, 1) if now < self.open_until else None,
+                breaker_trips=self.trips,
+                recent_failures=len([t for t in self.failures.values() if t >= now - self.window]))
@@ -5,9 +5,16 @@ import subprocess
 import signal
 import psutil
 import time
+import glob
 import tempfile
 from log import LogDebug, LogInfo, LogError, LogFatal
 from common import _enum_, admin_dir
+from scheduler import scheduler, spawn_limiter
+from recovery import backoff_delay
+from probe import probe_cache
+from metrics import Series, parse_monitor_output, max_metrics
+from tracing import STATUS_OK, STATUS_ERROR
+from plugin import load_plugin, PluginContext, PluginCall, TIMEOUT_CODE
 
 MachineState = _enum_(
     "BEGIN",
@@ -30,19 +37,96 @@ ResourceState = _enum_(
     "NONE"
 )
 
+""" machine states in which the state of a resource is settled """
+settled_states = [MachineState.IDLE, MachineState.MONITOR]
+
+""" the machine states a restored resource begins in """
+restored_states = {
+    ResourceState.STARTED: MachineState.STARTED,
+    ResourceState.STOPPED: MachineState.STOPPED,
+    ResourceState.FAILED:  MachineState.FAILED,
+}
+
+counter_names = [
+    "starts", "start_failures", "stops", "stop_failures", "monitors", "monitor_failures",
+    "threshold_hits", "recovers", "recover_failures", "alerts", "ignored_polls"
+]
+
+""" the files RAs write their messages and monitor values into """
+message_file_prefixes = ["msg", "value"]
+
+def message_file(prefix):
+    """ an empty file for the RA to write into; it is named after the pid of
+        the daemon so the files left by a killed daemon can be told """
+    fd, filename = tempfile.mkstemp(prefix="{}-{}-".format(prefix, os.getpid()), suffix=".tmp", dir=admin_dir)
+    os.close(fd)
+    return filename
+
+def read_message_file(filename):
+    """ returns the content and removes the file """
+    try:
+        with open(filename, "r") as f:
+            return f.read()
+    except IOError:
+        return ""
+    finally:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+""" files without a pid in their name, left by the earlier versions, are
+    removed once this old; a running daemon of such a version may still be
+    using the newer ones """
+unowned_file_max_age = 86400
+
+def remove_stale_message_files():
+    """ removes the files of the daemons which are gone; those of another
+        daemon still running, e.g. of another profile, are left alone """
+    now = time.time()
+    for prefix in message_file_prefixes:
+        for filename in glob.glob("{}/{}-*.tmp".format(admin_dir, prefix)):
+            parts = os.path.basename(filename).split("-")
+            pid = int(parts[1]) if len(parts) == 3 and parts[1].isdigit() else None
+            if pid is None:
+                remove_if_older(filename, now - unowned_file_max_age)
+            elif pid != os.getpid() and not psutil.pid_exists(pid):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+    for filename in glob.glob(admin_dir + "/tmp*.tmp"):
+        remove_if_older(filename, now - unowned_file_max_age)
+
+def remove_if_older(filename, cutoff):
+    try:
+        if os.path.getmtime(filename) < cutoff:
+            os.remove(filename)
+    except OSError:
+        pass
+
 class Command(object):
+    """ runs the RA commands of a state; it holds no file and shares the
+        locks of its resource, so that it is cheap to create """
+    __slots__ = ["res", "pid", "timer", "abort", "call"]
+
+    devnull = None # the output of the RAs is not used
+
     def __init__(self, res):
         self.res = res
-        self.script = res.config.Path
         self.pid = None
         self.timer = None
-        self.cancel_lock = threading.Lock()
-        self.res_lock = res.machine_lock
-        self.tmpfile = tempfile.NamedTemporaryFile(mode="w+", prefix="msg-", suffix=".tmp", dir=admin_dir);
         self.abort = False
+        self.call = None # the PluginCall being run
 
     @staticmethod
     def kill(pid):
+        """ the RA runs in a process group of its own, killed in one go """
+        try:
+            os.killpg(pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
         try:
             process = psutil.Process(pid)
             plist = [process] + process.children(recursive=True)
@@ -51,7 +135,7 @@ class Command(object):
             pass
 
     def cancel(self):
-        with self.cancel_lock:
+        with self.res.command_lock:
             self.abort = True
             timer = self.timer # intends to keep the reference to timer object
             if timer:
@@ -59,11 +143,18 @@ class Command(object):
             if self.pid:
                 self.res.debug("kill pending command")
                 Command.kill(self.pid)
+            if self.call:
+                self.res.debug("cancel pending plugin call")
+                self.call.cancel()
 
     def run(self, command, timeout, env={}):
         def kill(pid):
             self.res.error("'{}' command timeout ({}s), forcibly kill it".format(command, timeout))
+            if span:
+                kill_span = tracer.start("kill", span, {"resmon.resource": self.res.config.Name, "resmon.pid": pid})
             Command.kill(pid)
+            if span:
+                tracer.end(kill_span, STATUS_ERROR, {"resmon.timeout": timeout})
 
         def terminate_thread():
             msg = "'{}' command is cancelled".format(command)
@@ -71,46 +162,140 @@ class Command(object):
             self.res.debug("thread '{}' is terminated".format(threading.current_thread().name))
             raise SystemExit(msg)
 
+        if self.res.config.Plugin is not None:
+            return self.run_plugin(command, timeout, env)
         ret = -1
-        with self.res_lock:
+        if Command.devnull is None:
+            Command.devnull = open(os.devnull, "w")
+        tracer = self.res.tracer
+        span = None
+        if tracer:
+            span = tracer.start("command " + command, tracer.current() or self.res.state_span,
+                                {"resmon.resource": self.res.config.Name, "resmon.command": command})
+        with self.res.machine_lock:
             self.res.debug("execute '{}' command".format(command))
-            with self.cancel_lock:
-                if self.abort:
-                    terminate_thread()
-                try:
-                    argv = [self.script, command]
-                    env["RESMOND_MESSAGE_FILE"] = self.tmpfile.name
-                    start_time = time.time()
-                    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, env=env)
-                    self.pid = proc.pid
-                    self.timer = threading.Timer(timeout, kill, [self.pid])
-                    self.timer.start()
-                except:
-                    self.res.error("failed to issue '{}' command".format(command))
-                    return 1
-            """ leave cancel-lock """
-
-            ret = proc.wait()
-            self.timer.cancel()
-            self.timer = None
-            self.pid = None
-
+            if not spawn_limiter.acquire(lambda: self.abort):
+                if span:
+                    tracer.end(span, STATUS_ERROR, {"resmon.cancelled": True})
+                terminate_thread()
+            try:
+                with self.res.command_lock:
+                    if self.abort:
+                        if span:
+                            tracer.end(span, STATUS_ERROR, {"resmon.cancelled": True})
+                        terminate_thread()
+                    msg_file = None # mkstemp may fail too, e.g. out of descriptors
+                    try:
+                        config = self.res.config
+                        argv = [config.Path, command]
+                        msg_file = message_file("msg")
+                        env = dict(env, RESMOND_MESSAGE_FILE=msg_file, RESMOND_RESOURCE=config.Name)
+                        if config.Instance is not None:
+                            env["RESMOND_INSTANCE"] = str(config.Instance)
+                        start_time = time.time()
+                        proc = subprocess.Popen(argv, stdout=Command.devnull, stderr=Command.devnull, close_fds=True, env=env,
+                                                preexec_fn=os.setpgrp)
+                        self.pid = proc.pid
+                        self.res.running_command = (command, proc.pid, start_time)
+                        self.timer = scheduler.call_later(timeout, kill, self.pid, name=self.res.name)
+                    except:
+                        self.res.error("failed to issue '{}' command".format(command))
+                        if msg_file:
+                            read_message_file(msg_file)
+                        if span:
+                            tracer.end(span, STATUS_ERROR, {"resmon.exit_code": 1})
+                        return 1
+                """ leave cancel-lock """
+
+                ret = proc.wait()
+                self.timer.cancel()
+                self.timer = None
+                self.pid = None
+                self.res.running_command = None
+            finally:
+                spawn_limiter.release()
+
+        msg = read_message_file(msg_file)
+        if span:
+            tracer.end(span, STATUS_OK if ret == 0 else STATUS_ERROR,
+                       {"resmon.exit_code": ret, "resmon.queue_wait_ms": (start_time - span.start) * 1000,
+                        "resmon.cancelled": self.abort or None})
         if self.abort:
             terminate_thread()
         elapsed_time = time.time() - start_time
         self.res.debug("'{}' command returns {}; spent {:.3f}s".format(command, ret, elapsed_time))
-        msg = self.tmpfile.read()
         if msg:
             self.res.debug("returned message: {}".format(msg))
         return ret
 
+    def run_plugin(self, command, timeout, env):
+        """ the method of the plugin is called on a plugin worker; on timeout
+            it is asked to return and given up on """
+        def terminate_thread():
+            msg = "'{}' command is cancelled".format(command)
+            self.res.debug(msg)
+            raise SystemExit(msg)
+
+        tracer = self.res.tracer
+        span = None
+        if tracer:
+            span = tracer.start("plugin " + command, tracer.current() or self.res.state_span,
+                                {"resmon.resource": self.res.config.Name, "resmon.command": command})
+        with self.res.machine_lock:
+            self.res.debug("call '{}' of plugin".format(command))
+            with self.res.command_lock:
+                if self.abort:
+                    terminate_thread()
+                start_time = time.time()
+                try:
+                    method = getattr(self.res.plugin_object(), command)
+                except Exception as e:
+                    self.res.error("failed to load plugin '{}': {}".format(self.res.config.Plugin, e))
+                    method = None
+                if method:
+                    call = PluginCall(PluginContext(self.res.config.Name, self.res.config.Instance, command, timeout))
+                    if self.res.plugin_pool.submit(call.run, method, env.get("RESMOND_MONITOR_VALUE_FILE")):
+                        self.call = call
+                        self.res.running_command = (command, None, start_time)
+                    else:
+                        self.res.error("no plugin worker takes '{}' command".format(command))
+            if self.call is None:
+                ret = 1
+            else:
+                if not self.call.wait():
+                    self.call.cancel()
+                ret = self.call.code
+                if ret == TIMEOUT_CODE and not self.abort:
+                    self.res.error("'{}' plugin call timeout ({}s), it is asked to return".format(command, timeout))
+            with self.res.command_lock:
+                call, self.call = self.call, None
+                self.res.running_command = None
+
+        if call and call.error:
+            self.res.error("'{}' plugin call fails: {}".format(command, call.error))
+        if span:
+            tracer.end(span, STATUS_OK if ret == 0 else STATUS_ERROR, {"resmon.exit_code": ret,
+                       "resmon.cancelled": self.abort or None})
+        if self.abort:
+            terminate_thread()
+        self.res.debug("'{}' plugin call returns {}; spent {:.3f}s".format(command, ret, time.time() - start_time))
+        return ret
+
 class BaseState(object):
+    __slots__ = ["res", "config"]
+
     def __init__(self, res):
         self.res = res
         self.config = res.config
-        self.info = res.info
-        self.debug = res.debug
-        self.error = res.error
+
+    def info(self, *args):
+        self.res.info(*args)
+
+    def debug(self, *args):
+        self.res.debug(*args)
+
+    def error(self, *args):
+        self.res.error(*args)
 
     def enter(self):
         NotImplementedError("enter is not implemented")
@@ -118,8 +303,14 @@ class BaseState(object):
     def leave(self):
         pass
 
+    def reconfigure(self, config):
+        """ called when the config of the resource is reloaded; the new
+            values take effect from the next command or timer """
+        self.config = config
+
 def SimpleMethodState(fn):
     class simple_class(BaseState):
+        __slots__ = []
         def __init__(self, res):
             super(simple_class, self).__init__(res)
         def enter(self):
@@ -153,6 +344,8 @@ def ExitState(self):
     pass
 
 class BeginState(BaseState):
+    __slots__ = ["command"]
+
     def __init__(self, res):
         super(BeginState, self).__init__(res)
         self.command = None
@@ -172,60 +365,81 @@ class BeginState(BaseState):
                     self.res.state = MachineState.STOPPED
 
         self.command = Command(self.res)
-        timer = threading.Timer(0, begin_task, [])
-        timer.start()
+        timer = scheduler.call_later(0, begin_task, name=self.res.name)
 
     def leave(self):
         if self.command:
             self.command.cancel()
 
 class MonitorState(BaseState):
+    __slots__ = ["timer", "lock", "history", "left_counter", "command",
+                 "history_max", "history_min", "initial_counter", "rules"]
+
     def __init__(self, res):
         super(MonitorState, self).__init__(res)
         self.timer = None
         self.lock = threading.Lock()
         self.history = []
+        self.left_counter = 0
+        self.command = None
+        self.apply_config()
+
+    def apply_config(self):
         self.history_max = self.config.MonitorThresholdTimes[1]
         self.history_min = self.config.MonitorThresholdTimes[0]
-        self.left_counter = 0
+        self.rules = [rule.evaluator() for rule in self.config.rules]
         if self.config.Monitor is True:
             self.initial_counter = self.config.MonitorTimes
             if self.initial_counter == 9999:
                 self.initial_counter = 2 ** 63
         else:
             self.initial_counter = 0
-        self.command = None
+
+    def reconfigure(self, config):
+        """ the history survives, trimmed to the new window, and so does the
+            state of the rules unless they are changed """
+        with self.lock:
+            rules = self.rules
+            self.config = config
+            self.apply_config()
+            if [evaluator.rule.text for evaluator in rules] == config.MonitorRule:
+                self.rules = rules
+            if len(self.history) > self.history_max:
+                self.history = self.history[-self.history_max:]
 
     def enter(self):
         def do_monitor_command():
-            tmp_file = tempfile.NamedTemporaryFile(mode="w+", suffix=".tmp", dir=admin_dir);
-            if tmp_file is None:
+            try:
+                value_file = message_file("value")
+            except (IOError, OSError):
                 self.error("cannot create intermediate file for 'monitor' command")
-                return False, None
+                return False, None, None
 
-            env = { "RESMOND_MONITOR_VALUE_FILE": tmp_file.name }
-            ret_code = self.command.run("monitor", self.config.MonitorTimeout, env)
+            env = { "RESMOND_MONITOR_VALUE_FILE": value_file }
+            try:
+                ret_code = self.command.run("monitor", self.config.MonitorTimeout, env)
+            finally:
+                content = read_message_file(value_file)
             if ret_code != 0:
-                return False, None
-
-            tmp_file.seek(0)
-            content = tmp_file.read()
-            value = None if (content is None) else content.split("\n")[0]
-            if value and value.isdigit():
-                self.debug("received monitor value: {}".format(value))
-                return True, int(value)
-            else:
-                self.error("'monitor' receives invalid value '{}'".format("null" if value is None else str(value)))
-                return False, None
-
-        def do_action_on_failure():
+                return False, None, None
+
+            try:
+                value, metrics = parse_monitor_output(content)
+            except ValueError:
+                self.error("'monitor' receives invalid value '{}'".format(content.strip() if content else "null"))
+                return False, None, None
+            self.debug("received monitor value: {}{}".format(value,
+                "".join(" {}={}".format(k, v) for k, v in sorted(metrics.items()))))
+            return True, value, metrics
+
+        def do_action_on_failure(reason):
             """ Go to recover and pause monitor """
             if self.config.Action == "recover":
                 self.error("recovering resource now")
                 self.res.state = MachineState.RECOVER
             elif self.config.Action == "alert":
                 self.error("alerting for resource failure")
-                self.res.do_alert()
+                self.res.do_alert(reason)
                 # MONITOR => FAILED
                 self.res.state = MachineState.FAILED
             else:
@@ -234,16 +448,61 @@ class MonitorState(BaseState):
                 self.res.state = MachineState.STARTED # go on and just like nothing happened
 
         def monitor_task():
+            """ each poll is a trace of its own, the command it runs and the
+                states it leads to are in it """
+            tracer = self.res.tracer
+            if tracer is None:
+                return poll_task(None)
+            span = tracer.start("monitor poll", None, {"resmon.resource": self.config.Name})
+            tracer.set_current(span)
+            try:
+                poll_task(span)
+            finally:
+                tracer.set_current(None)
+                tracer.end(span)
+
+        def poll_task(span):
             self.timer = None
             start_time = time.time()
+            throttle = None if self.config.Critical else self.res.throttle
+            factor = throttle.current() if throttle else 1.0
             self.debug("monitor resource")
-            ret, value = do_monitor_command()
+            self.res.count("monitors")
+            if self.config.MonitorCache:
+                """ the result may be the one of another resource probing the same target """
+                key = (self.config.Path, self.config.MonitorCacheKey)
+                result = probe_cache.get(key, self.config.MonitorCache, do_monitor_command, lambda: self.command.abort)
+                if result is None:
+                    return # the state is left
+                ret, value, metrics = result
+            else:
+                ret, value, metrics = do_monitor_command()
             if ret is False:
+                self.res.count("monitor_failures")
                 value = self.config.MonitorDefault
+                if (factor > 1 and self.config.IgnoreThrottledTimeouts
+                        and time.time() - start_time >= self.config.MonitorTimeout):
+                    """ the host is too busy to tell anything of the resource """
+                    self.res.count("ignored_polls")
+                    self.error("'monitor' command timed out while the host is overloaded, the poll is ignored")
+                    schedule_next(start_time, factor)
+                    return
                 self.error("failed to run 'monitor' command, use '{}' by default".format(value))
+            self.res.monitored(value, metrics)
             hit = (value >= self.config.MonitorThreshold)
             if hit:
                 self.error("monitor return value ({}) exceeds threshold ({})".format(value, self.config.MonitorThreshold))
+            if self.rules:
+                samples = dict(metrics or {}, value=value)
+                now = time.time()
+                for evaluator in self.rules:
+                    if evaluator.update(now, samples):
+                        hit = True
+                        self.error("monitor rule '{}' holds: {}".format(evaluator.rule.text, evaluator.explain()))
+            if hit:
+                self.res.count("threshold_hits")
+            if span:
+                span.attributes.update({"resmon.value": value, "resmon.hit": hit, "resmon.monitor_ok": ret})
             """ Check if the history meets the least requirement to perform action """
             self.history += [hit]
             if len(self.history) > self.history_max:
@@ -251,11 +510,18 @@ class MonitorState(BaseState):
             if len(self.history) >= self.history_min:
                 hits = [1 for h in self.history if h is True]
                 if len(hits) >= self.history_min:
-                    self.error("exceeded threshold {} times in the most recent {} monitors".format(len(hits), len(self.history)))
+                    reason = "exceeded threshold {} times in the most recent {} monitors".format(len(hits), len(self.history))
+                    self.error(reason)
                     self.history = []
-                    do_action_on_failure()
+                    self.res.trace_cause = span
+                    do_action_on_failure(reason)
                     return
-            """ Schedule next timer for monitor """
+            schedule_next(start_time, factor)
+
+        def schedule_next(start_time, factor):
+            """ Schedule next timer for monitor, later while the host is
+                overloaded unless the resource is critical """
+            interval = self.config.MonitorInterval * factor
             with self.lock:
                 self.left_counter -= 1
                 if self.left_counter <= 0:
@@ -263,10 +529,9 @@ class MonitorState(BaseState):
                     self.res.state = MachineState.IDLE
                     return
                 elapsed_time = time.time() - start_time
-                delay = self.config.MonitorInterval - elapsed_time
+                delay = interval - elapsed_time
                 if delay < 0: delay = 0
-                self.timer = threading.Timer(delay, monitor_task, [])
-                self.timer.start()
+                self.timer = scheduler.call_later(delay, monitor_task, name=self.res.name)
 
         self.left_counter = self.initial_counter
         if self.left_counter == 0:
@@ -276,8 +541,7 @@ class MonitorState(BaseState):
         self.info("resource is under monitoring")
         self.command = Command(self.res)
         delay = self.config.MonitorDelay
-        self.timer = threading.Timer(delay, monitor_task, [])
-        self.timer.start()
+        self.timer = scheduler.call_later(delay, monitor_task, name=self.res.name)
 
     def leave(self):
         with self.lock:
@@ -288,23 +552,77 @@ class MonitorState(BaseState):
                 self.timer.cancel()
 
 class RecoverState(BaseState):
+    __slots__ = ["retry_max", "lock", "timer", "command", "abort", "retry", "reserved"]
+
     def __init__(self, res):
         super(RecoverState, self).__init__(res)
         self.retry_max = res.config.RecoverRetryTimes
         self.lock = threading.Lock()
         self.timer = None
         self.command = None
+        self.abort = False
+        self.retry = 0
+        self.reserved = False # holds a token of the profile's limiter
+
+    def reconfigure(self, config):
+        self.config = config
+        self.retry_max = config.RecoverRetryTimes
+
+    def reserve(self, limiter):
+        """ takes a token for the recovery, given back by leave() if the
+            recovery never runs; returns None once the state is left """
+        with self.lock:
+            if self.abort:
+                return None
+            self.reserved = True
+        return limiter.acquire()
+
+    def retry_delay(self, elapsed_time):
+        config = self.config
+        delay = backoff_delay(config.RecoverRetryInterval, self.retry, config.RetryBackoff,
+                              config.RetryMaxInterval, config.RetryJitter)
+        return max(delay - elapsed_time, 0)
+
+    def schedule(self, delay, task, *args):
+        with self.lock:
+            if self.abort:
+                return False
+            self.timer = scheduler.call_later(delay, task, *args, name=self.res.name)
+            return True
 
     def enter(self):
         def recover_task():
+            limiter = self.res.recovery_limiter
+            if limiter:
+                wait = limiter.paused()
+                if wait > 0:
+                    if self.schedule(wait, recover_task):
+                        self.info("recovery is paused by the profile's breaker for {:.3f}s".format(wait))
+                    return
+                """ a token already reserved lets the recovery through in
+                    its turn without asking again """
+                if not self.reserved:
+                    wait = self.reserve(limiter)
+                    if wait is None:
+                        return
+                    if wait > 0:
+                        if self.schedule(wait, recover_task):
+                            self.info("recovery is held back by the profile's rate limit for {:.3f}s".format(wait))
+                        return
+            with self.lock:
+                if self.abort:
+                    return
+                self.reserved = False # spent by this recovery
             start_time = time.time()
             self.debug("recover resource")
+            self.res.count("recovers")
             ret = self.command.run("recover", self.config.RecoverTimeout)
             if ret == 0:
                 self.info("resource is recovered successfully")
                 # RECOVER => STARTED
                 self.res.state = MachineState.STARTED
                 return
+            self.res.count("recover_failures")
 
             self.retry += 1
             if self.retry >= self.retry_max:
@@ -314,24 +632,19 @@ class RecoverState(BaseState):
                 return
 
             """ Schedule next timer for monitor """
-            with self.lock:
-                if self.abort:
-                    return
-                elapsed_time = time.time() - start_time
-                delay = self.config.RecoverRetryInterval - elapsed_time
-                if delay < 0:
-                    delay = 0
+            delay = self.retry_delay(time.time() - start_time)
+            if self.schedule(delay, recover_task):
                 self.error("failed to recover resource, retry in {:.3f}s later".format(delay))
-                self.timer = threading.Timer(delay, recover_task, [])
-                self.timer.start()
 
         self.res.res_state = ResourceState.FAILED
         self.info("resource is to be recovered")
+        if self.res.recovery_limiter:
+            self.res.recovery_limiter.failed(self.res.name)
         self.command = Command(self.res)
         self.abort = False
         self.retry = 0
-        self.timer = threading.Timer(0, recover_task, [])
-        self.timer.start()
+        self.reserved = False
+        self.timer = scheduler.call_later(0, recover_task, name=self.res.name)
 
 
     def leave(self):
@@ -341,25 +654,43 @@ class RecoverState(BaseState):
                 self.command.cancel()
             if self.timer:
                 self.timer.cancel()
+            if self.reserved:
+                """ the recovery waiting for its turn is given up """
+                self.reserved = False
+                if self.res.recovery_limiter:
+                    self.res.recovery_limiter.release()
 
 class AutoStartState(BaseState):
+    __slots__ = ["retry_max", "timer", "lock", "command", "abort"]
+
     def __init__(self, res):
         super(AutoStartState, self).__init__(res)
         self.retry_max = res.config.StartRetryTimes
         self.timer = None
         self.lock = threading.Lock()
         self.command = None
+        self.abort = False
+
+    def reconfigure(self, config):
+        self.config = config
+        self.retry_max = config.StartRetryTimes
 
     def enter(self):
         def start_task(retry):
             start_time = time.time()
             self.debug("start resource")
-            ret = self.command.run("start", self.config.StartTimeout)
+            self.res.count("starts")
+            try:
+                ret = self.command.run("start", self.config.StartTimeout)
+            finally:
+                if self.res.start_gate:
+                    self.res.start_gate.release(self.res)
             if ret == 0:
                 self.info("resource is started successfully")
                 # AUTOSTART => STARTED
                 self.res.state = MachineState.STARTED
                 return
+            self.res.count("start_failures")
 
             if retry >= self.retry_max:
                 self.error("failed to start resource for {} times, resource aborted!".format(self.retry_max))
@@ -371,19 +702,38 @@ class AutoStartState(BaseState):
             with self.lock:
                 if self.abort:
                     return
-                elapsed_time = time.time() - start_time
-                delay = self.config.StartRetryInterval - elapsed_time
-                if delay < 0:
-                    delay = 0
+                config = self.config
+                delay = backoff_delay(config.StartRetryInterval, retry, config.RetryBackoff,
+                                      config.RetryMaxInterval, config.RetryJitter)
+                delay = max(delay - (time.time() - start_time), 0)
                 self.error("failed to start resource, retry in {:.3f}s later".format(delay))
-                self.timer = threading.Timer(delay, start_task, [retry + 1])
-                self.timer.start()
+                self.timer = scheduler.call_later(delay, request_start, retry + 1, name=self.res.name)
+
+        def admitted(error, retry):
+            """ called by the start gate once the dependencies are settled """
+            with self.lock:
+                if self.abort:
+                    return
+                if error is None:
+                    self.timer = scheduler.call_later(0, start_task, retry, name=self.res.name)
+                    return
+            self.error("{}, resource aborted!".format(error))
+            # AUTOSTART => FAILED
+            self.res.state = MachineState.FAILED
+
+        def request_start(retry):
+            if self.res.start_gate is None:
+                start_task(retry)
+                return
+            waits = self.config.Requires + self.config.After
+            if retry == 1 and waits:
+                self.info("wait for {} to start first".format(", ".join(waits)))
+            self.res.start_gate.admit(self.res, lambda error: admitted(error, retry))
 
         self.command = Command(self.res)
         self.abort = False
         self.info("resource is to be auto started")
-        self.timer = threading.Timer(self.config.StartDelay, start_task, [1])
-        self.timer.start()
+        self.timer = scheduler.call_later(self.config.StartDelay, request_start, 1, name=self.res.name)
 
     def leave(self):
         with self.lock:
@@ -392,8 +742,12 @@ class AutoStartState(BaseState):
                 self.command.cancel()
             if self.timer:
                 self.timer.cancel()
+        if self.res.start_gate:
+            self.res.start_gate.cancel(self.res)
 
 class StartState(BaseState):
+    __slots__ = ["command"]
+
     def __init__(self, res):
         super(StartState, self).__init__(res)
         self.command = None
@@ -401,25 +755,28 @@ class StartState(BaseState):
     def enter(self):
         def start_task():
             self.info("start resource")
+            self.res.count("starts")
             ret = self.command.run("start", self.config.StartTimeout)
             if ret == 0:
                 self.info("resource is started successfully")
                 # START => STARTED
                 self.res.state = MachineState.STARTED
             else:
+                self.res.count("start_failures")
                 self.error("failed to start resource")
                 # START => FAILED
                 self.res.state = MachineState.FAILED
 
         self.command = Command(self.res)
-        timer = threading.Timer(0, start_task, [])
-        timer.start()
+        timer = scheduler.call_later(0, start_task, name=self.res.name)
 
     def leave(self):
         if self.command:
             self.command.cancel()
 
 class StopState(BaseState):
+    __slots__ = ["command"]
+
     def __init__(self, res):
         super(StopState, self).__init__(res)
         self.command = None
@@ -427,32 +784,59 @@ class StopState(BaseState):
     def enter(self):
         def stop_task():
             self.debug("stop resource")
+            self.res.count("stops")
             ret = self.command.run("stop", self.config.StartTimeout)
             if ret == 0:
                 self.info("resource is stopped successfully")
             else:
+                self.res.count("stop_failures")
                 self.error("failed to stop resource")
             # STOP => STOPPED
             self.res.state = MachineState.STOPPED
 
         self.command = Command(self.res)
-        timer = threading.Timer(0, stop_task, [])
-        timer.start()
+        timer = scheduler.call_later(0, stop_task, name=self.res.name)
 
     def leave(self):
         if self.command:
             self.command.cancel()
 
 class ResourceMachine(threading.Thread):
+    role = "resource" # of the thread, for INTROSPECT
+
     def __init__(self, profile, res_config):
         name = profile.name + ":" + res_config.Name
         super(ResourceMachine, self).__init__(name=name)
         self.name = name
         self.config = res_config
+        self.log = profile.logfile
         self.machine_lock = threading.Lock()
+        self.command_lock = threading.Lock()
         self.sem = threading.Semaphore(0)
+        self.state_lock = threading.Lock()
         self._res_state = ResourceState.NONE
         self._mac_state = None
+        self.states = {}
+        self.counters = dict.fromkeys(counter_names, 0)
+        self.created_time = time.time()
+        self.state_time = None
+        self.res_state_time = None
+        self.last_monitor = None # (timestamp, value) of the last monitor poll
+        self.listeners = []
+        self.metrics = {} # metric name => Series
+        self.metrics_lock = threading.Lock()
+        self.start_gate = None # set by the profile to order auto starts
+        self.recovery_limiter = None # set by the profile to pace recoveries
+        self.alerts = None # the AlertDispatcher of the profile
+        self.restored = None # the snapshot entry the resource begins with
+        self.verify_timer = None
+        self.running_command = None # (command, pid, start time) of the RA being run
+        self.tracer = None # the Tracer of the profile if TraceFile is set
+        self.plugin_pool = None # the workers of the profile running Plugin commands
+        self.throttle = None # the Throttle of the profile scaling monitor intervals
+        self.plugin = None # the instance of the Plugin class, made on first use
+        self.state_span = None # the span of the current state
+        self.trace_cause = None # the span leading to the next state, e.g. a monitor poll
 
     @property
     def state(self):
@@ -460,8 +844,13 @@ class ResourceMachine(threading.Thread):
 
     @state.setter
     def state(self, state):
-        self._mac_state = state
+        with self.state_lock:
+            if self._mac_state == MachineState.EXIT:
+                return # a task finishing after cancel() must not revive the machine
+            self._mac_state = state
+            self.state_time = time.time()
         self.sem.release()
+        self.notify("machine_state", machine_state=MachineState.rev_map[state])
 
     @property
     def res_state(self):
@@ -471,46 +860,211 @@ class ResourceMachine(threading.Thread):
     def res_state(self, state):
         if state != self._res_state:
             self._res_state = state
+            self.res_state_time = time.time()
             self.info("resource is {}".format(ResourceState.rev_map[state]))
+            self.notify("state", state=ResourceState.rev_map[state])
 
     def info(self, *args):
-        LogInfo("[{}] ".format(self.name), *args)
+        self.log.info("[{}] ".format(self.name), *args)
 
     def debug(self, *args):
-        LogDebug("[{}] ".format(self.name), *args)
+        self.log.debug("[{}] ".format(self.name), *args)
 
     def error(self, *args):
-        LogError("[{}] ".format(self.name), *args)
+        self.log.error("[{}] ".format(self.name), *args)
 
     def cancel(self):
+        verify_timer = self.verify_timer
+        if verify_timer:
+            verify_timer.cancel()
         self.state = MachineState.EXIT
 
-    def do_alert(self):
-        self.info("alert for resource failure, not implemented")
-
-    def run(self):
-        self.states = {
-            MachineState.BEGIN:     BeginState(self),
-            MachineState.START:     StartState(self),
-            MachineState.STOP:      StopState(self),
-            MachineState.STARTED:   StartedState(self),
-            MachineState.STOPPED:   StoppedState(self),
-            MachineState.AUTOSTART: AutoStartState(self),
-            MachineState.FAILED:    FailedState(self),
-            MachineState.MONITOR:   MonitorState(self),
-            MachineState.RECOVER:   RecoverState(self),
-            MachineState.IDLE:      IdleState(self),
-            MachineState.EXIT:      ExitState(self)
-        }
-
-        def get_state_obj(state):
-            if state in self.states:
-                return self.states[state]
-            self.debug("state class is undefined for {}".format(MachineState.rev_map[state]))
+    def count(self, name):
+        self.counters[name] += 1
+
+    def reconfigure(self, config):
+        """ apply a reloaded config in place, keeping the state, the monitor
+            history and the counters """
+        monitor_changed = (config.Monitor != self.config.Monitor or
+                           config.MonitorTimes != self.config.MonitorTimes)
+        self.config = config
+        for obj in self.states.values():
+            obj.reconfigure(config)
+        with self.metrics_lock:
+            if not config.MetricSamples:
+                self.metrics = {}
+            for series in self.metrics.values():
+                if series.capacity != config.MetricSamples:
+                    series.resize(config.MetricSamples)
+        self.info("resource is reconfigured")
+        if not monitor_changed:
+            return
+        if self.state == MachineState.MONITOR:
+            """ restart or stop monitoring as the new config says """
+            self.state = MachineState.STARTED
+        elif self.state == MachineState.IDLE and self.res_state == ResourceState.STARTED and config.Monitor:
+            self.state = MachineState.MONITOR
+
+    def add_listener(self, listener):
+        """ listener(res, event) is called on the thread causing the event;
+            it must be cheap and must not block """
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        self.listeners = [l for l in self.listeners if l is not listener]
+
+    def notify(self, event, **fields):
+        listeners = self.listeners
+        if not listeners:
+            return
+        fields.update(event=event, resource=self.name, time=time.time())
+        for listener in listeners:
+            try:
+                listener(self, fields)
+            except Exception as e:
+                self.error("error in event listener: ", e)
+
+    def monitored(self, value, metrics=None):
+        now = time.time()
+        self.last_monitor = (now, value)
+        if self.config.MetricSamples:
+            self.record_metrics(now, value, metrics)
+        if metrics:
+            self.notify("monitor", value=value, metrics=metrics)
+        else:
+            self.notify("monitor", value=value)
+
+    def record_metrics(self, when, value, metrics):
+        """ the monitor value is kept as the metric 'value' """
+        capacity = self.config.MetricSamples
+        with self.metrics_lock:
+            for name, number in [("value", value)] + sorted((metrics or {}).items()):
+                series = self.metrics.get(name)
+                if series is None:
+                    if len(self.metrics) >= max_metrics:
+                        continue
+                    series = self.metrics[name] = Series(capacity)
+                series.add(when, number)
+
+    def metric_windows(self, since):
+        """ {metric: values sampled since the time} """
+        with self.metrics_lock:
+            return dict((name, series.window(since)) for name, series in self.metrics.items())
+
+    def monitor_history(self):
+        monitor = self.states.get(MachineState.MONITOR)
+        return list(monitor.history) if monitor else []
+
+    def summary(self):
+        """ the structured view of the resource for control commands """
+        last_monitor = self.last_monitor
+        return dict(
+            name = self.name,
+            state = ResourceState.rev_map[self.res_state],
+            machine_state = MachineState.rev_map[self.state] if self.state is not None else None,
+            state_since = self.res_state_time,
+            machine_state_since = self.state_time,
+            last_monitor_value = last_monitor[1] if last_monitor else None,
+            last_monitor_time = last_monitor[0] if last_monitor else None,
+            history = self.monitor_history(),
+            counters = dict(self.counters),
+            created = self.created_time)
+
+    def snapshot(self):
+        """ the state to be restored by a restarted daemon, None if the
+            resource is in the middle of something """
+        if self.state not in settled_states or self.res_state not in restored_states:
             return None
+        last_monitor = self.last_monitor
+        return dict(state = ResourceState.rev_map[self.res_state],
+                    since = self.res_state_time,
+                    counters = dict(self.counters),
+                    history = self.monitor_history(),
+                    last_monitor = list(last_monitor) if last_monitor else None)
+
+    def restore(self, entry, verify_delay):
+        """ called before the thread starts: the resource begins in the
+            state of the snapshot entry instead of probing its status, which
+            is verified verify_delay seconds later """
+        res_state = ResourceState.map.get(entry.get("state"))
+        if res_state not in restored_states:
+            return False
+        for name, value in entry.get("counters", {}).items():
+            if name in self.counters:
+                self.counters[name] = value
+        if entry.get("last_monitor"):
+            self.last_monitor = tuple(entry["last_monitor"])
+        self._res_state = res_state
+        self.res_state_time = entry.get("since")
+        self.restored = entry
+        self.verify_timer = scheduler.call_later(verify_delay, self.verify_restored, name=self.name)
+        return True
+
+    def verify_restored(self):
+        """ a resource found otherwise than restored begins again as if the
+            daemon had just started """
+        self.verify_timer = None
+        if self.state not in settled_states:
+            return # changed since, by a command or the monitor
+        ret = Command(self).run("status", self.config.StatusTimeout)
+        started = (ret == 0)
+        if started == (self.res_state == ResourceState.STARTED):
+            self.debug("restored state is verified")
+            return
+        if self.state in settled_states:
+            self.info("restored state is outdated, check the resource again")
+            self.state = MachineState.BEGIN
+
+    def do_alert(self, reason):
+        """ the alert is queued to the sinks of the profile """
+        self.count("alerts")
+        if self.alerts is None or not self.alerts.alert(self, reason):
+            self.info("alert for resource failure, no AlertSink is configured")
+
+    def plugin_object(self):
+        """ raises what loading or instantiating the plugin raises """
+        plugin = self.plugin
+        if plugin is None or plugin[0] != self.config.Plugin:
+            plugin = (self.config.Plugin, load_plugin(self.config.Plugin)(self.config.Name, self.config.Instance))
+            self.plugin = plugin
+        return plugin[1]
+
+    def trace_state(self, state):
+        """ ends the span of the state left and begins the one of the state
+            entered, as a child of what led to it; monitoring and idling
+            begin new traces """
+        span, cause = self.state_span, self.trace_cause
+        self.trace_cause = None
+        if span:
+            self.tracer.end(span)
+        if state == MachineState.EXIT:
+            self.state_span = None
+            return
+        parent = None if state in (MachineState.MONITOR, MachineState.IDLE) else (cause or span)
+        self.state_span = self.tracer.start("state " + MachineState.rev_map[state], parent,
+                                            {"resmon.resource": self.config.Name})
+
+    def state_object(self, state):
+        """ the state objects are created on first use, most resources never
+            enter most states """
+        obj = self.states.get(state)
+        if obj is None:
+            state_class = state_classes.get(state)
+            if state_class is None:
+                self.debug("state class is undefined for {}".format(MachineState.rev_map[state]))
+                return None
+            obj = self.states[state] = state_class(self)
+        return obj
 
+    def run(self):
         self.debug("thread is created for resource")
-        self.state = MachineState.BEGIN
+        if self.restored:
+            self.info("resource is restored as {}".format(self.restored["state"]))
+            monitor = self.state_object(MachineState.MONITOR)
+            monitor.history = [bool(h) for h in self.restored.get("history", [])][-monitor.history_max:]
+            self.state = restored_states[self._res_state]
+        else:
+            self.state = MachineState.BEGIN
         last_state = None
 
         while self.state != MachineState.EXIT:
@@ -518,15 +1072,31 @@ class ResourceMachine(threading.Thread):
             """ leave the previous state """
             if last_state:
                 self.debug("leave {} state".format(MachineState.rev_map[last_state]))
-                obj = get_state_obj(last_state)
+                obj = self.state_object(last_state)
                 if obj:
                     obj.leave()
             last_state = self.state
+            if self.tracer:
+                self.trace_state(last_state)
 
             """ enter the previous state """
             self.debug("enter {} state".format(MachineState.rev_map[self.state]))
-            obj = get_state_obj(self.state)
+            obj = self.state_object(self.state)
             if obj:
                 obj.enter()
 
         self.debug("exiting thread, bye!")
+
+state_classes = {
+    MachineState.BEGIN:     BeginState,
+    MachineState.START:     StartState,
+    MachineState.STOP:      StopState,
+    MachineState.STARTED:   StartedState,
+    MachineState.STOPPED:   StoppedState,
+    MachineState.AUTOSTART: AutoStartState,
+    MachineState.FAILED:    FailedState,
+    MachineState.MONITOR:   MonitorState,
+    MachineState.RECOVER:   RecoverState,
+    MachineState.IDLE:      IdleState,
+    MachineState.EXIT:      ExitState
+}
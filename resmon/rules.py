@@ -0,0 +1,305 @@
+import re
+import math
+import bisect
+import collections
+
+"""
+    MonitorRule expressions, e.g. p95(latency_ms,5m)>200&&rising(queue,1m)>0
+
+    rule       := conjunction ("||" conjunction)*
+    conjunction:= comparison ("&&" comparison)*
+    comparison := term (">" | ">=" | "<" | "<=" | "==" | "!=") number
+    term       := metric | function "(" metric "," duration ")"
+
+    A metric is one the monitor reports, or "value" for the monitor value;
+    a bare metric is its last sample. Durations are seconds, or a number
+    with s, m or h. The functions:
+
+    avg(m,D)    mean of the samples of the last D
+    min(m,D)    least sample of the last D
+    max(m,D)    greatest sample of the last D
+    pNN(m,D)    NN-th percentile of the samples of the last D, e.g. p95
+    rate(m,D)   change per second over the last D
+    ewma(m,H)   exponentially weighted mean, of which H is the half-life
+    rising(m,H) change per second of ewma(m,H) at the last sample
+
+    Rules are compiled when the config is loaded; each resource updates its
+    own state of them once per poll, in a time independent of the window
+    for all but the percentiles, which take a binary search.
+"""
+
+token_regex = re.compile("\\s*(?:(-?\\d+(?:\\.\\d+)?[smh]?)|([_a-zA-Z][\\w.]*)|(&&|\\|\\||>=|<=|==|!=|[()<>,]))")
+percentile_regex = re.compile("^p(\\d{1,2})$")
+duration_units = dict(s=1, m=60, h=3600)
+
+comparators = {
+    ">":  lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<":  lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+}
+
+class RuleError(ValueError):
+    pass
+
+class Last(object):
+    __slots__ = ["current"]
+
+    def __init__(self, arg):
+        self.current = None
+
+    def update(self, when, value):
+        self.current = value
+
+    def value(self):
+        return self.current
+
+class Window(object):
+    """ the samples of the last `arg` seconds """
+    __slots__ = ["span", "samples"]
+
+    def __init__(self, arg):
+        self.span = arg
+        self.samples = collections.deque()
+
+    def update(self, when, value):
+        self.samples.append((when, value))
+        since = when - self.span
+        while self.samples[0][0] < since:
+            self.expire(*self.samples.popleft())
+        self.added(value)
+
+    def expire(self, when, value):
+        pass
+
+    def added(self, value):
+        pass
+
+class Average(Window):
+    __slots__ = ["total"]
+
+    def __init__(self, arg):
+        super(Average, self).__init__(arg)
+        self.total = 0.0
+
+    def added(self, value):
+        self.total += value
+
+    def expire(self, when, value):
+        self.total -= value
+
+    def value(self):
+        return self.total / len(self.samples) if self.samples else None
+
+class Extreme(Window):
+    """ min or max by a monotonic deque of the candidates """
+    __slots__ = ["candidates", "better"]
+
+    def __init__(self, arg, better):
+        super(Extreme, self).__init__(arg)
+        self.candidates = collections.deque()
+        self.better = better
+
+    def added(self, value):
+        while self.candidates and not self.better(self.candidates[-1], value):
+            self.candidates.pop()
+        self.candidates.append(value)
+
+    def expire(self, when, value):
+        if self.candidates and self.candidates[0] == value:
+            self.candidates.popleft()
+
+    def value(self):
+        return self.candidates[0] if self.candidates else None
+
+class Quantile(Window):
+    """ the samples of the window kept sorted too """
+    __slots__ = ["ordered", "q"]
+
+    def __init__(self, arg, q):
+        super(Quantile, self).__init__(arg)
+        self.ordered = []
+        self.q = q
+
+    def added(self, value):
+        bisect.insort(self.ordered, value)
+
+    def expire(self, when, value):
+        del self.ordered[bisect.bisect_left(self.ordered, value)]
+
+    def value(self):
+        if not self.ordered:
+            return None
+        rank = int(math.ceil(self.q / 100.0 * len(self.ordered)))
+        return self.ordered[min(max(rank, 1), len(self.ordered)) - 1]
+
+class Rate(Window):
+    __slots__ = []
+
+    def value(self):
+        if len(self.samples) < 2:
+            return None
+        (t0, v0), (t1, v1) = self.samples[0], self.samples[-1]
+        return (v1 - v0) / (t1 - t0) if t1 > t0 else None
+
+class Ewma(object):
+    __slots__ = ["half_life", "mean", "last_time", "slope"]
+
+    def __init__(self, arg):
+        self.half_life = arg
+        self.mean = None
+        self.last_time = None
+        self.slope = None
+
+    def update(self, when, value):
+        if self.mean is None:
+            self.mean = float(value)
+        else:
+            elapsed = max(when - self.last_time, 0)
+            previous = self.mean
+            self.mean += (1 - 0.5 ** (elapsed / self.half_life)) * (value - self.mean)
+            self.slope = (self.mean - previous) / elapsed if elapsed > 0 else self.slope
+        self.last_time = when
+
+    def value(self):
+        return self.mean
+
+class Rising(Ewma):
+    __slots__ = []
+
+    def value(self):
+        return self.slope
+
+functions = {
+    "avg":    Average,
+    "min":    lambda arg: Extreme(arg, lambda kept, new: kept <= new),
+    "max":    lambda arg: Extreme(arg, lambda kept, new: kept >= new),
+    "rate":   Rate,
+    "ewma":   Ewma,
+    "rising": Rising,
+}
+
+def term_class(function):
+    m = percentile_regex.match(function)
+    if m:
+        q = int(m.group(1))
+        return lambda arg: Quantile(arg, q)
+    return functions.get(function)
+
+def parse_duration(text):
+    if text[-1] in duration_units:
+        return float(text[:-1]) * duration_units[text[-1]]
+    return float(text)
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        m = token_regex.match(text, pos)
+        if not m or m.end() == pos:
+            raise RuleError("unexpected '{}'".format(text[pos:]))
+        number, name, symbol = m.groups()
+        tokens.append(("number", number) if number else ("name", name) if name else ("symbol", symbol))
+        pos = m.end()
+    return tokens
+
+class Rule(object):
+    """ a compiled MonitorRule; shared by the resources of the config, each
+        keeping its own state in an evaluator """
+    def __init__(self, text):
+        self.text = text
+        self.terms = [] # (text, metric, factory, argument)
+        self.clauses = [] # [[(term index, comparator, bound)]], OR of ANDs
+        self.parse(tokenize(text))
+
+    def parse(self, tokens):
+        tokens = list(tokens)
+        def take(kind=None, value=None):
+            if not tokens:
+                raise RuleError("unexpected end of rule")
+            token = tokens.pop(0)
+            if (kind and token[0] != kind) or (value and token[1] != value):
+                raise RuleError("expect {} instead of '{}'".format(value or kind, token[1]))
+            return token[1]
+
+        def term():
+            name = take("name")
+            if not tokens or tokens[0] != ("symbol", "("):
+                return name, name, Last, None
+            factory = term_class(name)
+            if factory is None:
+                raise RuleError("unknown function '{}'".format(name))
+            take("symbol", "(")
+            metric = take("name")
+            take("symbol", ",")
+            duration = take("number")
+            take("symbol", ")")
+            arg = parse_duration(duration)
+            if arg <= 0:
+                raise RuleError("'{}' must be positive".format(duration))
+            return "{}({},{})".format(name, metric, duration), metric, factory, arg
+
+        clause = []
+        while True:
+            text, metric, factory, arg = term()
+            operator = take("symbol")
+            if operator not in comparators:
+                raise RuleError("expect a comparison instead of '{}'".format(operator))
+            bound = take("number")
+            if bound[-1] in duration_units:
+                raise RuleError("'{}' is not a number".format(bound))
+            self.terms.append((text, metric, factory, arg))
+            clause.append((len(self.terms) - 1, operator, float(bound)))
+            if not tokens:
+                break
+            joint = take("symbol")
+            if joint == "||":
+                self.clauses.append(clause)
+                clause = []
+            elif joint != "&&":
+                raise RuleError("expect && or || instead of '{}'".format(joint))
+        self.clauses.append(clause)
+
+    def evaluator(self):
+        return RuleEvaluator(self)
+
+class RuleEvaluator(object):
+    """ the state of a rule for one resource """
+    __slots__ = ["rule", "terms"]
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.terms = [factory(arg) for text, metric, factory, arg in rule.terms]
+
+    def update(self, when, samples):
+        """ samples: {metric: number} of a poll; returns True if the rule
+            holds after it """
+        for (text, metric, factory, arg), term in zip(self.rule.terms, self.terms):
+            if metric in samples:
+                term.update(when, samples[metric])
+        return self.holds()
+
+    def holds(self):
+        for clause in self.rule.clauses:
+            for index, operator, bound in clause:
+                value = self.terms[index].value()
+                if value is None or not comparators[operator](value, bound):
+                    break
+            else:
+                return True
+        return False
+
+    def explain(self):
+        """ the values of the terms, for the log """
+        values = []
+        for (text, metric, factory, arg), term in zip(self.rule.terms, self.terms):
+            value = term.value()
+            values.append("{}={}".format(text, "none" if value is None else "{:g}".format(value)))
+        return ", ".join(values)
+
+def compile_rule(text):
+    """ raises RuleError """
+    return Rule(text)
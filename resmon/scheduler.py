@@ -0,0 +1,122 @@
+import time
+import heapq
+import threading
+import traceback
+from log import LogError
+
+class ScheduledTask(object):
+    def __init__(self, when, fn, args, name):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.name = name
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler(object):
+    """ a single thread keeping every pending timer of the process; a due
+        task runs on a thread of its own since it may block on a command.
+        It replaces one sleeping threading.Timer per pending timer. """
+    def __init__(self):
+        self.tasks = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = 0
+
+    def ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.loop, name="scheduler")
+            self.thread.role = "scheduler"
+            self.thread.daemon = True
+            self.thread.start()
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        """ returns a handle of which cancel() prevents the call if it has
+            not been started yet """
+        task = ScheduledTask(time.time() + max(0, delay), fn, args, kwargs.get("name"))
+        with self.cond:
+            heapq.heappush(self.tasks, task)
+            self.ensure_thread()
+            if self.tasks[0] is task:
+                self.cond.notify()
+        return task
+
+    def pending(self):
+        with self.cond:
+            return len([t for t in self.tasks if not t.cancelled])
+
+    def stats(self):
+        """ cancelled timers are kept until they are due or reach the head """
+        with self.cond:
+            cancelled = len([t for t in self.tasks if t.cancelled])
+            next_due = min([t.when for t in self.tasks if not t.cancelled] or [None])
+            return dict(pending=len(self.tasks) - cancelled, cancelled=cancelled, running=self.running,
+                        next_due_in=None if next_due is None else round(max(0, next_due - time.time()), 3))
+
+    def run_task(self, task):
+        with self.cond:
+            self.running += 1
+        try:
+            task.fn(*task.args)
+        except SystemExit:
+            pass # the way a cancelled command terminates its task
+        except Exception:
+            LogError("scheduled task raised an exception: ", traceback.format_exc())
+        finally:
+            with self.cond:
+                self.running -= 1
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while self.tasks and self.tasks[0].cancelled:
+                    heapq.heappop(self.tasks)
+                if not self.tasks:
+                    self.cond.wait()
+                    continue
+                delay = self.tasks[0].when - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                task = heapq.heappop(self.tasks)
+            th = threading.Thread(target=self.run_task, args=[task], name=task.name or "task")
+            th.role = "task"
+            th.daemon = True
+            th.start()
+
+class SpawnLimiter(object):
+    """ caps the commands executing at the same time in the process """
+    def __init__(self):
+        self.limit = 0
+        self.cond = threading.Condition()
+        self.active = 0
+
+    def set_limit(self, limit):
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    def acquire(self, aborted):
+        """ blocks until a slot is available; returns False if aborted()
+            becomes true while waiting """
+        with self.cond:
+            while self.limit > 0 and self.active >= self.limit:
+                if aborted():
+                    return False
+                self.cond.wait(0.5)
+            self.active += 1
+        return True
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+""" shared by every profile hosted in the process """
+scheduler = Scheduler()
+spawn_limiter = SpawnLimiter()
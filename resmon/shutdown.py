@@ -0,0 +1,71 @@
+import time
+from resource import Command, MachineState
+from bulk import BulkOperation
+
+""" seconds of the deadline kept for cancelling the machines after the
+    resources are stopped """
+cancel_margin = 5
+
+class ShutdownCoordinator(object):
+    """ brings the threads of a profile down before a deadline: with
+        StopOnExit=yes the resources are stopped first, in parallel and in
+        reverse dependency order, and the snapshot is saved; then every
+        thread is cancelled at once and all of them are waited for
+        together. What is still running at the deadline is reported and
+        its RA killed. """
+    def __init__(self, service, deadline):
+        self.service = service
+        self.deadline = deadline
+        self.profile = service.profile
+        self.log = service.log
+
+    def stop_resources(self):
+        general = self.profile.general
+        stop_deadline = self.deadline - min(cancel_margin, general.ShutdownTimeout / 4.0)
+        operation = BulkOperation(self.service.resources, False, general.BulkConcurrency, stop_deadline)
+        failed = []
+        for res, result in operation.run():
+            if result not in ("stopped", "already stopped"):
+                failed.append("{} ({})".format(res.name, result))
+        if failed:
+            self.log.error("[{}:*] failed to stop on exit: {}".format(self.profile.name, ", ".join(failed)))
+
+    def straggler(self, th):
+        """ describes a thread which did not terminate in time """
+        running_command = getattr(th, "running_command", None)
+        state = getattr(th, "state", None)
+        description = th.name
+        if state is not None:
+            description += " in {}".format(MachineState.rev_map.get(state, state))
+        if running_command:
+            command, pid, start_time = running_command
+            if pid is None:
+                description += ", '{}' plugin call running for {:.1f}s".format(command, time.time() - start_time)
+            else:
+                description += ", '{}' command (pid {}) running for {:.1f}s".format(command, pid, time.time() - start_time)
+        return description
+
+    def run(self):
+        """ returns the threads still alive at the deadline """
+        if self.profile.general.StopOnExit:
+            self.stop_resources()
+        """ after the resources are stopped, or the snapshot would restore
+            them as they were before """
+        if self.profile.general.SnapshotInterval > 0:
+            self.service.save_snapshot()
+
+        threads = list(self.service.threads)
+        for th in threads:
+            th.cancel()
+        for th in threads:
+            th.join(max(0, self.deadline - time.time()))
+
+        stragglers = [th for th in threads if th.is_alive()]
+        if stragglers:
+            self.log.error("[{}:*] shutdown deadline reached, still running: {}".format(
+                self.profile.name, "; ".join(self.straggler(th) for th in stragglers)))
+            for th in stragglers:
+                running_command = getattr(th, "running_command", None)
+                if running_command and running_command[1] is not None:
+                    Command.kill(running_command[1])
+        return stragglers
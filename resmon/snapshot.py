@@ -0,0 +1,50 @@
+import os
+import json
+import time
+import hashlib
+from common import admin_dir
+
+snapshot_version = 1
+
+def snapshot_path(profile_name):
+    return admin_dir + "/profile-{}.state".format(profile_name)
+
+def config_digest(config):
+    """ a restored state is only trusted for the same config """
+    return hashlib.sha1(repr(sorted(config.as_dict().items()))).hexdigest()
+
+def write_snapshot(filename, resources):
+    """ writes the state of the settled resources, atomically """
+    entries = {}
+    for res in resources:
+        entry = res.snapshot()
+        if entry is not None:
+            entry["config"] = config_digest(res.config)
+            entries[res.config.Name] = entry
+    data = dict(version=snapshot_version, time=time.time(), resources=entries)
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(tmp_filename, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+    return len(entries)
+
+def read_snapshot(filename, max_age):
+    """ returns {resource name: entry} of a snapshot younger than max_age
+        seconds, or {} """
+    try:
+        with open(filename, "r") as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != snapshot_version:
+        return {}
+    if not time.time() - max_age <= data.get("time", 0) <= time.time():
+        return {}
+    return data.get("resources", {})
@@ -0,0 +1,204 @@
+import os
+import sys
+import glob
+import signal
+import threading
+import time
+import traceback
+import log
+from log import LogFatal
+from common import admin_dir
+from config import collect_config, ConfigError, default_log
+from daemon import ProfileService, create_folder, print_error
+from scheduler import spawn_limiter
+from worker import WorkerPool
+
+class HostedProfile(object):
+    def __init__(self, filename, stamp, service):
+        self.filename = filename
+        self.stamp = stamp
+        self.service = service
+
+class Supervisor(object):
+    """ hosts the profiles of all the config files in a directory in one
+        process; every profile keeps its own name, socket, lock and log, while
+        the scheduler, the command pools and the spawn limit are shared """
+    scan_interval = 5
+    command_workers = 8
+    bulk_workers = 2
+
+    def __init__(self, config_dir, max_commands=0):
+        self.config_dir = config_dir
+        self.max_commands = max_commands
+        self.hosted = {} # config filename => HostedProfile
+        self.exit_event = threading.Event()
+        self.wake_event = threading.Event() # ends the wait for the next scan
+        self.reload_requested = False
+        self.workers = WorkerPool("supervisor:commands", Supervisor.command_workers, 256)
+        self.fast_lane = WorkerPool("supervisor:fast-commands", 2, 256)
+        self.bulk_lane = WorkerPool("supervisor:bulk-commands", Supervisor.bulk_workers, 256)
+        self.log = log.LogFile(open(default_log, "a", 0), 2, default_log)
+        def signal_handler(signal, frame):
+            self.log.info("[supervisor] signal is caught, terminating process")
+            self.exit_event.set()
+            self.wake_event.set()
+        def reload_handler(signal, frame):
+            self.reload_requested = True
+            self.wake_event.set()
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+        signal.signal(signal.SIGHUP, reload_handler)
+
+    def config_files(self):
+        """ returns {filename: (mtime, size)} of the profile configs """
+        files = {}
+        for filename in glob.glob(os.path.join(self.config_dir, "*.conf")):
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            files[filename] = (st.st_mtime, st.st_size)
+        return files
+
+    def load(self, filename, stamp):
+        """ hosts the profile of a file; a file which fails is logged and
+            skipped without affecting the other profiles """
+        try:
+            profile = collect_config(filename)
+        except ConfigError as e:
+            self.log.error("[supervisor] failed to load '{}', it is skipped".format(filename))
+            for line in e.messages:
+                self.log.error("[supervisor] {}".format(line))
+            return
+        except Exception:
+            self.log.error("[supervisor] failed to load '{}', it is skipped: {}".format(
+                filename, traceback.format_exc().strip().split("\n")[-1]))
+            return
+        for line in profile.messages:
+            self.log.info("[supervisor] {}".format(line))
+        for hosted in self.hosted.values():
+            if hosted.service.profile.name == profile.name:
+                self.log.error("[supervisor] profile '{}' of '{}' is already hosted from '{}'".format(
+                    profile.name, filename, hosted.filename))
+                return
+        if len(profile.resources) == 0:
+            self.log.info("[supervisor] no resource specified in profile '{}', it is skipped".format(profile.name))
+            return
+
+        service = ProfileService(profile, self.workers, self.fast_lane, self.bulk_lane)
+        try:
+            if service.acquire() is False:
+                self.log.error("[supervisor] process for profile '{}' is already running".format(profile.name))
+                return
+        except SystemExit:
+            self.log.error("[supervisor] unable to obtain the lock of profile '{}'".format(profile.name))
+            return
+        try:
+            service.prepare()
+            service.start()
+        except Exception:
+            self.log.error("[supervisor] failed to start profile '{}' of '{}', it is skipped: {}".format(
+                profile.name, filename, traceback.format_exc().strip().split("\n")[-1]))
+            self.log.debug(traceback.format_exc())
+            try:
+                service.stop(time.time())
+            except Exception:
+                service.lock.release()
+            return
+        self.hosted[filename] = HostedProfile(filename, stamp, service)
+        self.log.info("[supervisor] profile '{}' is hosted from '{}'".format(profile.name, filename))
+
+    def unload(self, filename):
+        hosted = self.hosted.pop(filename)
+        hosted.service.stop()
+        self.log.info("[supervisor] profile '{}' is removed".format(hosted.service.profile.name))
+
+    def shutdown(self):
+        """ stops every profile at the same time, each within its own
+            ShutdownTimeout; returns the threads still running """
+        stragglers = []
+        def stop(hosted):
+            stragglers.extend(hosted.service.stop())
+        hosted_profiles = self.hosted.values()
+        self.hosted = {}
+        threads = [threading.Thread(target=stop, args=[hosted], name=hosted.service.profile.name + ":shutdown")
+                   for hosted in hosted_profiles]
+        for th in threads:
+            th.start()
+        timeout = max([h.service.profile.general.ShutdownTimeout for h in hosted_profiles] or [0]) + 1
+        deadline = time.time() + timeout
+        for th in threads:
+            th.join(max(0, deadline - time.time()))
+        return stragglers + [th for th in threads if th.is_alive()]
+
+    def scan(self):
+        files = self.config_files()
+        for filename in self.hosted.keys():
+            if filename not in files:
+                self.unload(filename)
+            elif files[filename] != self.hosted[filename].stamp:
+                hosted = self.hosted[filename]
+                if hosted.stamp is not None: # None on SIGHUP, logged already
+                    self.log.info("[supervisor] '{}' is changed, reload its profile".format(filename))
+                succeeded, messages = hosted.service.reload()
+                hosted.stamp = files[filename]
+                if hosted.service.renamed:
+                    """ a renamed profile is a different one, restart it """
+                    self.unload(filename)
+        for filename in sorted(files.keys()):
+            if filename not in self.hosted:
+                self.load(filename, files[filename])
+
+    def start(self):
+        create_folder(admin_dir)
+        if not os.path.isdir(self.config_dir):
+            print_error("{} is not a directory, exit on error!".format(self.config_dir))
+
+        ret = os.fork()
+        if ret != 0: # in parent process...
+            print "Process {} is created for supervising '{}'".format(ret, self.config_dir)
+            sys.exit(0)
+
+        try:
+            self.run()
+        except Exception as e:
+            LogFatal(traceback.format_exc())
+
+    def run(self):
+        self.log.info("[supervisor] process {} spawned for '{}'".format(os.getpid(), self.config_dir))
+        spawn_limiter.set_limit(self.max_commands)
+        self.workers.start()
+        self.fast_lane.start()
+        self.bulk_lane.start()
+
+        """ files which failed to load are retried once they change """
+        failed = {}
+        while not self.exit_event.is_set():
+            if self.reload_requested:
+                """ SIGHUP reloads every hosted profile and retries the
+                    files which failed, changed or not """
+                self.reload_requested = False
+                self.log.info("[supervisor] reload is requested, rescan '{}'".format(self.config_dir))
+                for hosted in self.hosted.values():
+                    hosted.stamp = None
+                failed = {}
+            files = self.config_files()
+            for filename, stamp in failed.items():
+                if files.get(filename) != stamp:
+                    del failed[filename]
+            known = dict((f, h.stamp) for f, h in self.hosted.items())
+            known.update(failed)
+            if known != files:
+                self.scan()
+                for filename, stamp in files.items():
+                    if filename not in self.hosted:
+                        failed[filename] = stamp
+            self.wake_event.wait(Supervisor.scan_interval)
+            self.wake_event.clear()
+
+        stragglers = self.shutdown()
+        self.workers.cancel()
+        self.fast_lane.cancel()
+        self.bulk_lane.cancel()
+        self.log.info("[supervisor] main thread terminated")
+        os._exit(1 if stragglers else 0)
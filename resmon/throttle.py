@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+
+""" a sample of the host load is reused for this many seconds """
+sample_ttl = 1.0
+
+pressure_resources = ["cpu", "memory", "io"]
+
+def read_loadavg():
+    """ the 1-minute load average per CPU, in percent """
+    try:
+        with open("/proc/loadavg") as f:
+            load1 = float(f.read().split()[0])
+        return load1 * 100 / (os.sysconf("SC_NPROCESSORS_ONLN") or 1)
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def read_pressure(resource):
+    """ the "some avg10" of /proc/pressure/RESOURCE, the percent of the last
+        10 seconds some task stalled on it; None without PSI """
+    try:
+        with open("/proc/pressure/" + resource) as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    for field in fields[1:]:
+                        name, sep, value = field.partition("=")
+                        if name == "avg10":
+                            return float(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def read_memory_available():
+    """ MemAvailable in percent of MemTotal """
+    try:
+        values = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, sep, rest = line.partition(":")
+                if name in ("MemTotal", "MemAvailable"):
+                    values[name] = int(rest.split()[0])
+        return values["MemAvailable"] * 100.0 / values["MemTotal"]
+    except (IOError, OSError, ValueError, KeyError, ZeroDivisionError):
+        return None
+
+class LoadSampler(object):
+    """ the load of the host, read on demand by the monitors of all the
+        profiles of the process and shared for sample_ttl seconds, so there
+        is no thread for it and the files are read once a second at most """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.time = 0
+        self.load = None
+
+    def sample(self):
+        with self.lock:
+            now = time.time()
+            if now - self.time >= sample_ttl:
+                self.load = dict(load=read_loadavg(), memory_available=read_memory_available(),
+                                 pressure=dict((r, read_pressure(r)) for r in pressure_resources))
+                self.time = now
+            return self.load
+
+class Throttle(object):
+    """ the factor the monitor intervals of a profile are scaled by: 1 while
+        the host is within the limits of the profile, the worst ratio of a
+        load to its limit beyond them, ThrottleMaxFactor at most """
+    def __init__(self, general, log, name):
+        self.log = log
+        self.name = name
+        self.lock = threading.Lock()
+        self.factor = 1.0
+        self.reason = None
+        self.since = None
+        self.throttled_time = 0.0
+        self.configure(general)
+
+    def configure(self, general):
+        self.load_limit = general.ThrottleLoad
+        self.pressure_limit = general.ThrottlePressure
+        self.memory_limit = general.ThrottleMemory
+        self.max_factor = general.ThrottleMaxFactor
+        self.enabled = bool(self.load_limit or self.pressure_limit or self.memory_limit)
+        with self.lock:
+            if not self.enabled and self.since:
+                self.throttled_time += time.time() - self.since
+                self.factor, self.reason, self.since = 1.0, None, None
+
+    def ratios(self, load):
+        """ yields (ratio, description) of each limit exceeded """
+        if self.load_limit and load["load"] is not None and load["load"] > self.load_limit:
+            yield load["load"] / self.load_limit, "load {:.0f}% of CPUs".format(load["load"])
+        if self.pressure_limit:
+            for resource, stalled in sorted(load["pressure"].items()):
+                if stalled is not None and stalled > self.pressure_limit:
+                    yield stalled / self.pressure_limit, "{} pressure {:.1f}%".format(resource, stalled)
+        available = load["memory_available"]
+        if self.memory_limit and available is not None and available < self.memory_limit:
+            yield self.memory_limit / max(available, 0.1), "memory available {:.1f}%".format(available)
+
+    def current(self):
+        """ returns the factor for a monitor interval starting now """
+        if not self.enabled:
+            return 1.0
+        exceeded = list(self.ratios(load_sampler.sample()))
+        factor, reason = 1.0, None
+        if exceeded:
+            ratio, reason = max(exceeded)
+            factor = min(float(self.max_factor), round(ratio, 1))
+        with self.lock:
+            now = time.time()
+            if (factor > 1) != (self.factor > 1):
+                if factor > 1:
+                    self.since = now
+                    self.log.info("[{}:*] host is overloaded ({}), monitor intervals are scaled by {}".format(
+                        self.name, reason, factor))
+                else:
+                    self.throttled_time += now - self.since
+                    self.log.info("[{}:*] host load is within limits again after {:.0f}s, monitor intervals are restored".format(
+                        self.name, now - self.since))
+                    self.since = None
+            self.factor, self.reason = factor, reason
+        return factor
+
+    def state(self):
+        with self.lock:
+            throttled_time = self.throttled_time + (time.time() - self.since if self.since else 0)
+            return dict(enabled=self.enabled, factor=self.factor, reason=self.reason,
+                        throttled_for=round(time.time() - self.since, 1) if self.since else None,
+                        throttled_time=round(throttled_time, 1), load=load_sampler.load)
+
+""" shared by every profile hosted in the process """
+load_sampler = LoadSampler()
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import binascii
+import threading
+
+""" OTLP status codes """
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+""" OTLP span kind of everything the daemon does itself """
+SPAN_KIND_INTERNAL = 1
+
+def random_id(size):
+    return binascii.b2a_hex(os.urandom(size))
+
+def attribute(key, value):
+    if isinstance(value, bool):
+        typed = dict(boolValue=value)
+    elif isinstance(value, (int, long)):
+        typed = dict(intValue=str(value))
+    elif isinstance(value, float):
+        typed = dict(doubleValue=value)
+    else:
+        typed = dict(stringValue=str(value))
+    return dict(key=key, value=typed)
+
+class Span(object):
+    __slots__ = ["name", "trace_id", "span_id", "parent_id", "start", "attributes"]
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else random_id(16)
+        self.span_id = random_id(8)
+        self.parent_id = parent.span_id if parent else ""
+        self.start = time.time()
+        self.attributes = dict(attributes)
+
+class Tracer(object):
+    """ writes a span per state a resource is in, per monitor poll and per
+        RA command, as OTLP/JSON lines to TraceFile: each line is an
+        ExportTraceServiceRequest of one span. A monitor poll begins a
+        trace; the states it leads to, their commands and the kill of a
+        command timing out are its descendants, so a trace shows what
+        happened from the detection of a failure to the recovery. """
+    def __init__(self, filename, profile_name):
+        self.filename = filename
+        self.profile_name = profile_name
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.fp = None
+        self.resource = dict(attributes=[attribute("service.name", "resmond"),
+                                         attribute("resmon.profile", profile_name),
+                                         attribute("process.pid", os.getpid())])
+
+    def open(self):
+        """ raises IOError """
+        self.fp = open(self.filename, "a", 1)
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+
+    def start(self, name, parent=None, attributes={}):
+        return Span(name, parent, attributes)
+
+    def end(self, span, status=STATUS_UNSET, attributes={}):
+        end = time.time()
+        attributes = dict(span.attributes, **attributes)
+        record = dict(
+            traceId=span.trace_id,
+            spanId=span.span_id,
+            parentSpanId=span.parent_id,
+            name=span.name,
+            kind=SPAN_KIND_INTERNAL,
+            startTimeUnixNano=str(int(span.start * 1e9)),
+            endTimeUnixNano=str(int(end * 1e9)),
+            attributes=[attribute(key, value) for key, value in sorted(attributes.items()) if value is not None],
+            status=dict(code=status))
+        line = json.dumps(dict(resourceSpans=[dict(
+            resource=self.resource,
+            scopeSpans=[dict(scope=dict(name="resmon"), spans=[record])])]), separators=(",", ":"))
+        with self.lock:
+            if self.fp:
+                self.fp.write(line + "\n")
+
+    def current(self):
+        """ the span the calling thread works for, e.g. a monitor poll """
+        return getattr(self.local, "span", None)
+
+    def set_current(self, span):
+        self.local.span = span
@@ -0,0 +1,84 @@
+import threading
+import time
+import traceback
+import Queue
+from log import LogError
+
+class WorkerPool(object):
+    """ a fixed number of threads serving a bounded queue of jobs """
+    def __init__(self, name, size, max_queue=0):
+        self.name = name
+        self.size = size
+        self.queue = Queue.Queue(max_queue)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.busy = 0
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            for i in range(self.size):
+                th = threading.Thread(target=self.work, name="{} worker-{}".format(self.name, i))
+                th.role = "worker"
+                th.daemon = True
+                self.threads.append(th)
+                th.start()
+
+    def submit(self, fn, *args):
+        """ returns False if the pool is stopped or its queue is full """
+        if not self.running:
+            return False
+        try:
+            self.queue.put_nowait((fn, args))
+        except Queue.Full:
+            return False
+        return True
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return dict(name=self.name, size=self.size, running=self.running, busy=self.busy, queued=self.queue.qsize())
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            fn, args = job
+            with self.lock:
+                self.busy += 1
+            try:
+                fn(*args)
+            except Exception:
+                LogError("[{}] job raised an exception: ".format(self.name), traceback.format_exc())
+            finally:
+                with self.lock:
+                    self.busy -= 1
+
+    def cancel(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        """ a stop marker per thread; a full queue must not block the caller,
+            so the jobs no one is to run any more make room for them """
+        markers = 0
+        while markers < len(self.threads):
+            try:
+                self.queue.put_nowait(None)
+                markers += 1
+            except Queue.Full:
+                try:
+                    if self.queue.get_nowait() is None:
+                        markers -= 1
+                except Queue.Empty:
+                    pass
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        for th in self.threads:
+            th.join(None if deadline is None else max(0, deadline - time.time()))